@@ -1,7 +1,9 @@
 # Arpegiattors
 
 import random
+from array import array
 from itertools import cycle
+from collections import Counter, OrderedDict
 from pprint import pformat
 
 from zope.interface import Interface, Attribute, implements
@@ -16,7 +18,8 @@ __all__ = [
     'IArp', 'IndexedArp', 'AscArp', 'DescArp', 'OrderedArp', 'RevOrderedArp',
     'RandomArp', 'ArpSwitcher', 'OctaveArp', 'Adder', 'PhraseRecordingArp',
     'Paradiddle', 'SingleParadiddle', 'DoubleParadiddle', 'TripleParadiddle',
-    'ParadiddleDiddle', 'ArpMap', 'PatternArp', 'ChordPatternArp'
+    'ParadiddleDiddle', 'ArpMap', 'PatternArp', 'ChordPatternArp',
+    'PhraseSnapshot'
 ]
 
 
@@ -53,29 +56,91 @@ class BaseArp(object):
         raise NotImplementedError
 
 
+def _ascending(numbers):
+    return sorted(numbers)
+
+
+def _descending(numbers):
+    return sorted(numbers, reverse=True)
+
+
+_numeric = (int, float)
+_sortable = (int, float, list, tuple)
+
+# (sort, values, types of values) -> sorted values; most recently used last
+_sortCache = OrderedDict()
+_sortCacheSize = 64
+
+
 def sortNumeric(values, sort=None):
+    """
+    Sort the numbers (and chords) in C{values} with C{sort} (ascending by
+    default), placing them at the positions of numbers in C{values}; other
+    values keep their position. Results are cached for recently seen values.
+    """
     if sort is None:
-        sort = lambda l: list(sorted(l))
-    numbers = [v for v in values if type(v) in (int, float, list, tuple)]
-    numbers = sort(numbers)
-    newvalues = []
-    for v in values:
-        if type(v) in (int, float):
-            newvalues.append(numbers.pop(0))
-        else:
-            newvalues.append(v)
+        sort = _ascending
+    try:
+        key = (sort, tuple(values), tuple([type(v) for v in values]))
+        cached = _sortCache.pop(key)
+    except TypeError:
+        key = None
+    except KeyError:
+        pass
+    else:
+        _sortCache[key] = cached
+        return list(cached)
+    numbers = iter(sort([v for v in values if type(v) in _sortable]))
+    newvalues = [(numbers.next() if type(v) in _numeric else v)
+                 for v in values]
+    if key is not None:
+        _sortCache[key] = newvalues
+        if len(_sortCache) > _sortCacheSize:
+            _sortCache.popitem(last=False)
+        return list(newvalues)
     return newvalues
 
 
+def _cycleTable(values):
+    """
+    Make a lookup table of C{values}: an C{array('h')} if all values are
+    small integers, otherwise a C{list}.
+    """
+    for v in values:
+        if type(v) is not int or not -32768 <= v <= 32767:
+            return list(values)
+    return array('h', values)
+
+
 class IndexedArp(BaseArp):
+    """
+    An arp cycling through its sorted values by C{direction}. Values without
+    callables are compiled into a table on reset so a call is one lookup.
+    The table is checked against C{values} as it is played, and recompiled
+    if they have been changed in place.
+    """
     index = 0
     count = 0
     direction = 1
+    _source = None
+    _table = None
+    _tableFor = None
 
     def sort(self, values):
         raise NotImplementedError
 
     def reset(self, values):
+        """
+        Reset values. Resetting with the values already being played is a
+        noop which keeps the index.
+        """
+        source = list(values)
+        if self._source == source:
+            return
+        self._source = source
+        self._reset(values)
+
+    def _reset(self, values):
         values = self.sort(values)
         self.count = len(values)
         if self.values:
@@ -88,12 +153,36 @@ class IndexedArp(BaseArp):
             elif self.index >= self.count:
                 self.index = self.index % self.count
         self.values = values
+        self._compile()
+
+    def _compile(self):
+        values = self.values
+        self._table = None
+        for v in values:
+            if callable(v):
+                break
+        else:
+            if values:
+                self._table = _cycleTable(values)
+        self._tableFor = values if self._table is not None else None
 
     def __call__(self):
+        if self._tableFor is self.values and self.index < self.count:
+            index = self.index
+            v = self._table[index]
+            try:
+                unchanged = self.values[index] == v
+            except IndexError:
+                unchanged = False
+            if unchanged:
+                self.index = (index + self.direction) % self.count
+                return v
+            # The values were changed in place
+            self._compile()
         if not self.values:
             return
         if self.index >= len(self.values):
-            self.reset(self.values)
+            self._reset(self.values)
         v = self.values[self.index]
         self.index += self.direction
         self.index = self.index % self.count
@@ -109,7 +198,7 @@ class AscArp(IndexedArp):
 class DescArp(IndexedArp):
 
     def sort(self, values):
-        return sortNumeric(values, lambda l: list(reversed(sorted(l))))
+        return sortNumeric(values, _descending)
 
 
 class OrderedArp(IndexedArp):
@@ -126,22 +215,66 @@ def RevOrderedArp(values=()):
 
 
 class RandomArp(BaseArp):
+    """
+    Play values in random order without repeating a value until every value
+    has been played. An alternate random number stream (see bl.rng) can be
+    given as C{rng}.
+
+    Values are kept in a shuffle bag: undrawn values at the front, drawn
+    values at the back. A draw swaps a random undrawn value to the boundary
+    and a finished cycle is refilled by moving the boundary, so both are
+    constant time. On reset() values which are still present keep their
+    place in the current cycle; new values join the undrawn ones.
+    """
+    _bag = ()
+    _remaining = 0
+
+    def __init__(self, values=(), rng=None):
+        self.rng = rng
+        BaseArp.__init__(self, values)
 
     def reset(self, values):
-        self._current = list(values)
-        self._next = []
         self.count = len(values)
         self.values = values
+        try:
+            self._merge(values)
+        except TypeError:
+            # Unhashable values (chords as lists) - start a fresh cycle
+            self._bag = list(values)
+            self._remaining = len(self._bag)
+
+    def _merge(self, values):
+        wanted = Counter(values)
+        undrawn = []
+        drawn = []
+        for (i, v) in enumerate(self._bag):
+            if wanted[v] > 0:
+                wanted[v] -= 1
+                if i < self._remaining:
+                    undrawn.append(v)
+                else:
+                    drawn.append(v)
+        for v in values:
+            if wanted[v] > 0:
+                wanted[v] -= 1
+                undrawn.append(v)
+        self._bag = undrawn + drawn
+        self._remaining = len(undrawn)
 
     def __call__(self):
-        if not self._current:
-            self._current = self._next
-        if not self._current:
-            return
-        l = len(self._current)
-        index = random.randint(0, l - 1)
-        next = self._current.pop(index)
-        self._next.append(next)
+        bag = self._bag
+        remaining = self._remaining
+        if not remaining:
+            remaining = len(bag)
+            if not remaining:
+                return
+        rng = self.rng or random
+        index = rng.randint(0, remaining - 1)
+        remaining -= 1
+        next = bag[index]
+        bag[index] = bag[remaining]
+        bag[remaining] = next
+        self._remaining = remaining
         return next
 
 
@@ -158,32 +291,73 @@ class PatternArp(BaseArp):
         [60, 60, 60, 69, 67, 63, 67, 69, 60, 63, 60]
     """
 
+    _table = None
+    _patternValues = None
+    _position = 0
+
     def __init__(self, values=(), pattern=(0,)):
         BaseArp.__init__(self, values)
         self.resetPattern(pattern)
 
+    def reset(self, values):
+        BaseArp.reset(self, values)
+        self._compileTable()
+
     def resetPattern(self, pattern):
         """
         Reset the pattern ugen. If pattern is not a callable then it is
-        coerced to cycle(pattern).next.
+        coerced to cycle(pattern).next. A pattern given as a non-empty
+        C{list} or C{tuple} is compiled with the values into a table of
+        notes, unless it produces chords.
         """
-        if not callable(pattern):
+        self._patternValues = None
+        if type(pattern) in (list, tuple) and pattern:
+            self._patternValues = list(pattern)
+            self._position = 0
+        elif not callable(pattern):
             pattern = cycle(pattern).next
         self._pattern = pattern
+        self._compileTable()
 
     def coerce(self, note):
         return note
 
-    def __call__(self):
-        if not self.values:
+    def _compileTable(self):
+        self._table = None
+        if not self.values or self._patternValues is None:
+            return
+        try:
+            notes = [self._lookup(p) for p in self._patternValues]
+        except (IndexError, TypeError):
             return
-        p = self._pattern()
+        for note in notes:
+            # Chords are built afresh for each call
+            if type(note) is list:
+                return
+        self._table = _cycleTable(notes)
+
+    def _lookup(self, p):
         if type(p) in (tuple, list):
             next = [self.values[i] for i in p]
         else:
             next = self.values[p]
         return self.coerce(next)
 
+    def __call__(self):
+        table = self._table
+        if table is not None:
+            position = self._position
+            self._position = (position + 1) % len(table)
+            return table[position]
+        if not self.values:
+            return
+        if self._patternValues is not None:
+            p = self._patternValues[self._position]
+            self._position = (self._position + 1) % len(self._patternValues)
+        else:
+            p = self._pattern()
+        return self._lookup(p)
+
 
 class ChordPatternArp(PatternArp):
     """
@@ -266,9 +440,23 @@ class ParadiddleDiddle(Paradiddle):
 
 
 class OctaveArp(ArpSwitcher):
+    """
+    Shift values from C{arp} up (or down with C{direction} -1) an octave after
+    each cycle of values, over C{octaves} octaves, optionally oscillating.
+
+    When C{arp} is an L{IndexedArp} with a compiled table, the whole cycle of
+    the octave arp is compiled into a table too on the first call after
+    construction, reset(), switch() or setting C{octaves}, C{oscillate},
+    C{direction}, C{currentOctave} or C{index}. The table is recompiled if C{arp} is reset or its
+    direction is changed; the index of C{arp} is kept up to date as the
+    table is played.
+    """
+    # Longest table to compile
+    maxTable = 4096
 
     def __init__(self, arp, values=None, octaves=3, direction=1,
                  oscillate=False):
+        self._table = None
         ArpSwitcher.__init__(self, arp, values)
         self.octaves = octaves
         self.currentOctave = 0
@@ -278,22 +466,138 @@ class OctaveArp(ArpSwitcher):
         self.direction = direction
         self.oscillate = oscillate
 
+    def _setOctaves(self, octaves):
+        self._sync()
+        self._octaves = octaves
+
+    octaves = property(lambda self: self._octaves, _setOctaves)
+
+    def _setOscillate(self, oscillate):
+        self._sync()
+        self._oscillate = oscillate
+
+    oscillate = property(lambda self: self._oscillate, _setOscillate)
+
+    def _stateProperty(position, name):
+        # A property for part of our state: read from the table's states while
+        # a table is played; setting it syncs and drops the table
+        def get(self):
+            if self._table:
+                return self._states[self._position - 1][position]
+            return getattr(self, name)
+
+        def set(self, value):
+            self._sync()
+            setattr(self, name, value)
+
+        return property(get, set)
+
+    index = _stateProperty(1, '_index')
+    currentOctave = _stateProperty(2, '_currentOctave')
+    direction = _stateProperty(3, '_direction')
+    del _stateProperty
+
+    def reset(self, values):
+        self._sync()
+        ArpSwitcher.reset(self, values)
+
+    def switch(self, arp):
+        self._sync()
+        ArpSwitcher.switch(self, arp)
+
     def __call__(self):
+        table = self._table
+        arp = self.arp
+        if table is None:
+            table = self._compileTable()
+        elif table:
+            position = self._position
+            values = arp.values
+            try:
+                # The value the arp would play next
+                unchanged = (values[self._arpIndexes[position - 1]] ==
+                             self._arpValues[position])
+            except IndexError:
+                unchanged = False
+            if not (unchanged and values is self._tableValues and
+                    arp.direction == self._tableDirection):
+                # The arp was reset, its values changed in place or its
+                # direction changed since compiling
+                self._sync()
+                if values is self._tableValues:
+                    arp._compile()
+                table = self._compileTable()
+        if not table:
+            return self._step()
+        position = self._position
+        self._position = (position + 1) % len(table)
+        arp.index = self._arpIndexes[position]
+        return table[position]
+
+    def _state(self):
+        return (self.arp.index, self._index, self._currentOctave,
+                self._direction)
+
+    def _restore(self, state):
+        (self.arp.index, self._index, self._currentOctave,
+         self._direction) = state
+
+    def _compileTable(self):
+        # False: don't try again until reset or switch
+        self._table = False
+        arp = self.arp
+        if (not self.count or not isinstance(arp, IndexedArp) or
+                arp._tableFor is not arp.values):
+            return
+        start = self._state()
+        notes = []
+        states = []
+        try:
+            while len(notes) < self.maxTable:
+                notes.append(self._step())
+                states.append(self._state())
+                if states[-1] == start:
+                    self._table = _cycleTable(notes)
+                    self._states = states
+                    self._arpIndexes = [state[0] for state in states]
+                    self._arpValues = [arp.values[index] for index
+                                       in self._arpIndexes[-1:] +
+                                       self._arpIndexes[:-1]]
+                    self._tableValues = arp.values
+                    self._tableDirection = arp.direction
+                    self._position = 0
+                    break
+        except TypeError:
+            pass
+        self._restore(start)
+        return self._table
+
+    def _sync(self):
+        # Bring our state up to date with the table position. The arp's index
+        # is kept up to date as the table is played (and may since have been
+        # rescaled by a reset of the arp), so it's left alone.
+        if self._table:
+            (ignored, self._index, self._currentOctave,
+             self._direction) = self._states[self._position - 1]
+        self._table = None
+
+    def _step(self):
         if not self.count:
             return
         v = exhaustCall(self.arp())
         if v is not None:
-            v += (self.currentOctave * 12)
-        self.index += 1
-        self.index = self.index % self.count
-        if self.index == 0:
-            self.currentOctave += self.direction
-            if self.octaves:
-                self.currentOctave = self.currentOctave % (self.octaves + 1)
-                if self.oscillate and self.currentOctave in (0, self.octaves):
-                    self.direction *= -1
+            v += (self._currentOctave * 12)
+        self._index += 1
+        self._index = self._index % self.count
+        if self._index == 0:
+            self._currentOctave += self._direction
+            octaves = self._octaves
+            if octaves:
+                self._currentOctave = self._currentOctave % (octaves + 1)
+                if self._oscillate and self._currentOctave in (0, octaves):
+                    self._direction *= -1
             else:
-                self.currentOctave = 0
+                self._currentOctave = 0
         return v
 
 
@@ -316,87 +620,186 @@ class ArpMap(ArpSwitcher):
         return self.func(exhaustCall(self.arp()))
 
 
+class _Tape(object):
+    """
+    A columnar ring buffer of recorded notes. At most C{capacity} notes are
+    kept; older notes are overwritten.
+
+    The columns are arrays of integers until a value which does not fit is
+    recorded (a C{None} rest, a float or a large number), when they are
+    turned into lists.
+    """
+    _columns = ('whens', 'notes', 'velocities', 'onTicks', 'sustains')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.whens = array('l', [0]) * capacity
+        self.notes = array('h', [0]) * capacity
+        self.velocities = array('h', [0]) * capacity
+        self.onTicks = array('l', [0]) * capacity
+        # sustain or -1 if unknown
+        self.sustains = array('l', [-1]) * capacity
+        # note -> serial of its latest noteon
+        self.lastSerials = {}
+        self.count = 0
+        self.elapsed = 0
+        self.dirty = False
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def _toLists(self):
+        for name in self._columns:
+            setattr(self, name, list(getattr(self, name)))
+
+    def noteOn(self, when, note, velocity, ticks):
+        slot = self.count % self.capacity
+        try:
+            self.whens[slot] = when
+            self.notes[slot] = note
+            self.velocities[slot] = velocity
+            self.onTicks[slot] = ticks
+        except (TypeError, OverflowError):
+            self._toLists()
+            return self.noteOn(when, note, velocity, ticks)
+        self.sustains[slot] = -1
+        self.lastSerials[note] = self.count
+        self.count += 1
+
+    def noteOff(self, note, ticks):
+        """
+        Set the sustain of the latest noteon of C{note}, returning C{False} if
+        there was none.
+        """
+        serial = self.lastSerials.get(note)
+        if serial is None:
+            return False
+        if serial >= self.count - self.capacity:
+            slot = serial % self.capacity
+            sustain = ticks - self.onTicks[slot]
+            try:
+                self.sustains[slot] = sustain
+            except (TypeError, OverflowError):
+                self._toLists()
+                self.sustains[slot] = sustain
+        return True
+
+
+class PhraseSnapshot(object):
+    """
+    A read-only sequence of C{(when, note, velocity, sustain)} tuples viewing
+    the notes on a tape, without copying them. Notes without a known sustain
+    are sustained to the end of the phrase.
+
+    As it is a view, a sustain set on the tape after the snapshot was taken
+    (by a late noteoff) shows in it too. Use C{list(snapshot)} for a copy.
+    """
+
+    def __init__(self, tape):
+        self._tape = tape
+        self._length = len(tape)
+        self._first = tape.count - self._length
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if type(index) is slice:
+            return [self[i] for i in range(*index.indices(self._length))]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('phrase index out of range')
+        tape = self._tape
+        slot = (self._first + index) % tape.capacity
+        when = tape.whens[slot]
+        sustain = tape.sustains[slot]
+        if sustain <= 0:
+            sustain = tape.elapsed - when
+        return (when, tape.notes[slot], tape.velocities[slot], sustain)
+
+    def __iter__(self):
+        for index in xrange(self._length):
+            yield self[index]
+
+    def __eq__(self, other):
+        try:
+            if len(other) != self._length:
+                return False
+        except TypeError:
+            return NotImplemented
+        for (mine, theirs) in zip(self, other):
+            if mine != theirs:
+                return False
+        return True
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(list(self))
+
+
 class PhraseRecordingArp(BaseArp):
+    """
+    An arp which records notes played (see recordNoteOn and recordNoteOff)
+    and returns the phrase recorded since the previous call as a
+    L{PhraseSnapshot}. If nothing was recorded the previous phrase is
+    returned again. Snapshots are views of the recorded notes which may be
+    shared between calls, so callers which keep phrases should copy them.
+
+    The tape holds at most C{capacity} notes per phrase; beyond that the
+    oldest notes of the phrase are dropped.
+    """
 
-    def __init__(self, clock=None):
+    def __init__(self, clock=None, capacity=4096):
         self.clock = getClock(clock)
+        self.capacity = capacity
         self._phraseStartTicks = self.clock.ticks
-        self._last_tape = None
-        self._tape = {}
-        self._eraseTape()
+        self._lastTape = None
+        self._tape = _Tape(capacity)
+        self.elapsed = 0
         self.phrase = []
 
     def __call__(self):
-        self.elapsed = self._phraseStartTicks = self.clock.ticks
-        self._resetRecording()
-        return list(self.phrase)
-
-    def _resetRecording(self):
-        whens = self._tape['whens']
-        notes = self._tape['notes']
-        velocities = self._tape['velocities']
-        sustains = self._tape['sustains']
-        indexes = self._tape['indexes']
+        ticks = self.clock.ticks
+        self.elapsed = ticks - self._phraseStartTicks
+        self._phraseStartTicks = ticks
+        tape = self._tape
+        if len(tape):
+            tape.elapsed = self.elapsed
+            self._lastTape = tape
+            self._tape = _Tape(self.capacity)
+            self.phrase = PhraseSnapshot(tape)
+        elif self._lastTape is not None and self._lastTape.dirty:
+            self.phrase = PhraseSnapshot(self._lastTape)
         if DEBUG:
-            log.msg('>tape===\n%s' % pformat(self._tape))
-        self._eraseTape()
-        if not whens and (self._last_tape and self._last_tape['dirty']):
-            whens = self._last_tape['whens']
-            notes = self._last_tape['notes']
-            velocities = self._last_tape['velocities']
-            sustains = self._last_tape['sustains']
-            indexes = self._last_tape['indexes']
-            self._last_tape['dirty'] = True
-        if whens:
-            sus = [None] * len(whens)
-            for (ontick, onnote, sustain) in sustains:
-                index = indexes.get((ontick, onnote))
-                if index is not None:
-                    sus[index] = sustain
-                else:
-                    log.err(ValueError(
-                        'no index for tick=%s note=%s' % (ontick, onnote)))
-            self.phrase = zip(whens, notes, velocities, sus)
-            self.phrase = [
-                (w, n, v, s or self.elapsed - w)
-                for (w, n, v, s) in self.phrase
-            ]
-            if DEBUG:
-                log.msg('>phrase===\n%s' % pformat(self.phrase))
-
-    def _eraseTape(self):
-        if self._tape and self._tape['whens']:
-            self._last_tape = dict(self._tape)
-            self._last_tape['dirty'] = False
-        self._tape = {'whens': [], 'notes': [], 'velocities': [],
-                      'sustains': [], 'indexes': {}, 'last_ticks': {}}
+            log.msg('>phrase===\n%s' % pformat(list(self.phrase)))
+        return self.phrase
 
     def recordNoteOn(self, note, velocity=100, ticks=None):
         if ticks is None:
             ticks = self.clock.ticks
-        self._tape['indexes'][(self.clock.ticks, note)] = len(
-                                                        self._tape['notes'])
-        self._tape['last_ticks'][note] = self.clock.ticks
-        self._tape['notes'].append(note)
-        self._tape['velocities'].append(velocity)
-        self._tape['whens'].append(ticks - self._phraseStartTicks)
+        self._tape.noteOn(ticks - self._phraseStartTicks, note, velocity,
+                          self.clock.ticks)
 
     def recordNoteOff(self, note):
-        tape = self._tape
-        last = tape['last_ticks'].get(note, None)
-        if last is None:
-            if self._last_tape:
-                last = self._last_tape['last_ticks'].get(note, None)
-                debug('got last tick from past recording: %s' % last)
-                if last is None:
-                    log.err(ValueError(
-                            'woops, i have not seen noteon event in current '
-                            'or last phrase for note: %s' % note))
-                    return
-            tape = self._last_tape
-            tape['dirty'] = True
-        sustain = self.clock.ticks - last
-        tape['sustains'].append((last, note, sustain))
+        ticks = self.clock.ticks
+        if self._tape.noteOff(note, ticks):
+            return
+        tape = self._lastTape
+        if tape is None or not tape.noteOff(note, ticks):
+            log.err(ValueError(
+                    'woops, i have not seen noteon event in current '
+                    'or last phrase for note: %s' % note))
+            return
+        debug('got noteon from past recording for note: %s' % note)
+        tape.dirty = True
 
 
 class Adder(ArpSwitcher):
@@ -0,0 +1,131 @@
+"""
+Block-generating ugens.
+
+NumPy variants of the ugens in bl.ugen which produce C{n} values at a time
+with one vectorised call to C{block(n)} - useful for offline renders and
+lookahead buffers which need a measure of values at once. L{BlockReader}
+adapts a block ugen back to an ordinary per-event ugen.
+
+Example:
+
+    >>> r = RandomBlock(60, 64, 67, rng=clock.rng('lead'))
+    >>> r.block(96)
+    array([64, 60, 67, ...])
+    >>> player = Player(piano, BlockReader(r), interval=(1, 16))
+"""
+import random
+
+import numpy
+
+from bl.ugen import Weight
+
+
+__all__ = ['CycleBlock', 'OscillateBlock', 'RandomBlock', 'RandomWalkBlock',
+           'WeightBlock', 'BlockReader']
+
+
+def _randomState(rng):
+    if rng is None:
+        rng = random
+    return numpy.random.RandomState(rng.getrandbits(32))
+
+
+class CycleBlock(object):
+
+    def __init__(self, *c):
+        self.values = numpy.array(c)
+        self.index = 0
+
+    def block(self, n):
+        indexes = (self.index + numpy.arange(n)) % len(self.values)
+        self.index = (self.index + n) % len(self.values)
+        return self.values[indexes]
+
+
+class OscillateBlock(CycleBlock):
+
+    def __init__(self, *c):
+        CycleBlock.__init__(self, *(list(c) + list(reversed(c[1:-1]))))
+
+
+class RandomBlock(object):
+
+    def __init__(self, *c, **kw):
+        self.values = numpy.array(c)
+        self.random = _randomState(kw.get('rng'))
+
+    def block(self, n):
+        return self.values[self.random.randint(0, len(self.values), n)]
+
+
+class RandomWalkBlock(object):
+    """
+    The walk is generated unfolded - direction flips with probability 1/2
+    at every step - and then folded back into range, which reflects off both
+    ends exactly as L{bl.ugen.RandomWalk} does.
+    """
+
+    def __init__(self, sounds, startIndex=None, rng=None):
+        self.values = numpy.array(sounds)
+        self.random = _randomState(rng)
+        if startIndex is None:
+            startIndex = self.random.randint(0, len(sounds))
+        self.position = startIndex
+        self.direction = 1
+
+    def block(self, n):
+        last = len(self.values) - 1
+        if not last:
+            return self.values[numpy.zeros(n, dtype=int)]
+        flips = numpy.where(self.random.randint(0, 2, n), -1, 1)
+        directions = self.direction * numpy.cumprod(flips)
+        steps = numpy.concatenate(([0], numpy.cumsum(directions)))
+        positions = self.position + steps
+        self.position = positions[-1] % (2 * last)
+        self.direction = directions[-1]
+        positions = positions[:-1] % (2 * last)
+        return self.values[numpy.where(positions > last,
+                                       2 * last - positions, positions)]
+
+
+class WeightBlock(Weight):
+    """
+    A L{bl.ugen.Weight} which can also draw blocks from its alias table.
+    """
+
+    def __init__(self, *weights, **kw):
+        Weight.__init__(self, *weights, **kw)
+        self.random = _randomState(kw.get('rng'))
+
+    def block(self, n):
+        if self._table is None:
+            self._table = self._build()
+        if not self._table:
+            return numpy.array([None] * n)
+        count, prob, alias = self._table
+        u = self.random.random_sample(n) * count
+        indexes = u.astype(int)
+        indexes = numpy.where(u - indexes >= numpy.take(prob, indexes),
+                              numpy.take(alias, indexes), indexes)
+        return numpy.array(self._notes)[indexes]
+
+
+class BlockReader(object):
+    """
+    A per-event ugen which reads values in turn from blocks of C{size}
+    generated by the block ugen C{ugen}.
+    """
+
+    def __init__(self, ugen, size=96):
+        self.ugen = ugen
+        self.size = size
+        self._block = []
+        self._cursor = 0
+
+    def __call__(self):
+        if self._cursor == len(self._block):
+            self._block = self.ugen.block(self.size).tolist()
+            self._cursor = 0
+        v = self._block[self._cursor]
+        self._cursor += 1
+        return v
@@ -0,0 +1,146 @@
+"""
+Fused arp combinator chains.
+
+Stacking arps - ArpMap(func, OctaveArp(Adder(AscArp(...)))) - costs a call,
+attribute lookups and type checks per layer for every note. A L{Chain} builds
+the same pipeline from combinators and compiles it into a single generated
+function, so a chain several stages deep costs about as much as the arp at
+its source.
+
+Example:
+
+    >>> arp = Chain(AscArp(), [60, 64, 67]).add(2).octave(2).map(float)
+    >>> [arp() for i in range(4)]
+    [62.0, 66.0, 69.0, 74.0]
+    >>> arp.reset([48, 52, 55])
+    >>> arp.switch(DescArp())
+"""
+import random
+
+from zope.interface import implements
+
+from bl.arp import IArp
+from bl.utils import exhaustCall
+
+
+__all__ = ['Chain']
+
+
+class Chain(object):
+    """
+    An arp wrapping the arp C{arp} with a pipeline of stages added by calling
+    the combinator methods, each of which returns the chain:
+
+        map(func): C{func(value)}
+        add(amount): value plus C{amount} (a number or a ugen); lists are
+            added element-wise and C{None} passes through
+        octave(octaves, direction, oscillate): shift by octaves, moving to the
+            next octave after each cycle of values (as L{bl.arp.OctaveArp})
+        zip(*ugens): the tuple of the value followed by a value of each ugen
+        choose(*ugens, rng=None): the value or a value of one of the ugens,
+            chosen at random with equal probability
+
+    The chain is recompiled when stages are added, on reset() and on switch().
+    """
+    implements(IArp)
+
+    def __init__(self, arp, values=None):
+        if values is None:
+            values = arp.values
+        self.arp = arp
+        self._stages = []
+        self.reset(values)
+
+    def reset(self, values):
+        self.values = values
+        self.count = len(values)
+        self.arp.reset(values)
+        self._compile()
+
+    def switch(self, arp):
+        arp.reset(self.values)
+        self.arp = arp
+        self._compile()
+
+    def __call__(self):
+        return self._fn()
+
+    def map(self, func):
+        return self._addStage('map', func)
+
+    def add(self, amount):
+        return self._addStage('add', amount)
+
+    def octave(self, octaves=3, direction=1, oscillate=False):
+        # [index, currentOctave, direction] survives recompiling
+        state = [0, octaves if direction == -1 else 0, direction]
+        return self._addStage('octave', (state, octaves, oscillate))
+
+    def zip(self, *ugens):
+        return self._addStage('zip', ugens)
+
+    def choose(self, *ugens, **kw):
+        rng = kw.get('rng') or random
+        return self._addStage('choose', (ugens, rng))
+
+    def _addStage(self, kind, arg):
+        self._stages.append((kind, arg))
+        self._compile()
+        return self
+
+    def _compile(self):
+        namespace = {'_arp': self.arp, '_x': exhaustCall,
+                     '_sequence': (list, tuple)}
+        lines = ['def _chain():',
+                 '    v = _arp()',
+                 '    while callable(v):',
+                 '        v = v()']
+        write = lines.append
+        for (i, (kind, arg)) in enumerate(self._stages):
+            name = '_s%d' % i
+            namespace[name] = arg
+            if kind == 'map':
+                write('    v = %s(v)' % name)
+            elif kind == 'add':
+                write('    if v is not None:')
+                if callable(arg):
+                    write('        a = _x(%s)' % name)
+                else:
+                    write('        a = %s' % name)
+                write('        if type(v) in _sequence:')
+                write('            v = [a + e for e in v]')
+                write('        else:')
+                write('            v = a + v')
+            elif kind == 'octave':
+                (state, octaves, oscillate) = arg
+                namespace[name] = state
+                if not self.count:
+                    write('    return None')
+                    continue
+                write('    if v is not None:')
+                write('        v += %s[1] * 12' % name)
+                write('    %s[0] += 1' % name)
+                write('    if %s[0] >= %d:' % (name, self.count))
+                write('        %s[0] = 0' % name)
+                if octaves:
+                    write('        %s[1] = (%s[1] + %s[2]) %% %d' % (
+                          name, name, name, octaves + 1))
+                    if oscillate:
+                        write('        if %s[1] in (0, %d):' % (
+                              name, octaves))
+                        write('            %s[2] *= -1' % name)
+                else:
+                    write('        %s[1] = 0' % name)
+            elif kind == 'zip':
+                write('    v = (v,%s)' % ''.join(
+                      ' _x(%s[%d]),' % (name, k) for k in range(len(arg))))
+            elif kind == 'choose':
+                (ugens, rng) = arg
+                namespace[name] = ugens
+                namespace[name + 'random'] = rng.random
+                write('    k = int(%srandom() * %d)' % (name, len(ugens) + 1))
+                write('    if k:')
+                write('        v = _x(%s[k - 1])' % name)
+        write('    return v')
+        exec '\n'.join(lines) in namespace
+        self._fn = namespace['_chain']
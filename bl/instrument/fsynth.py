@@ -1,18 +1,25 @@
 from pprint import pformat
 import os
+from collections import deque
 from warnings import warn
 
 from zope.interface import implements
 
+from twisted.internet import defer, threads
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
 from fluidsynth import Synth
 
 from bl.utils import getClock
-from bl.instrument.interfaces import IMIDIInstrument
+from bl.instrument.interfaces import (IMIDIInstrument, CC_VIBRATO, CC_PAN,
+                                     CC_EXPRESSION, CC_SUSTAIN, CC_REVERB,
+                                     CC_CHORUS)
 
 
 __all__ = ['SynthRouter', 'SynthPool', 'StereoPool', 'QuadPool',
-           'NConnectionPool', 'Instrument', 'MultiInstrument', 'Layer',
-           'suggestDefaultPool']
+           'NConnectionPool', 'ChannelAllocator', 'Instrument',
+           'AsyncInstrument', 'MultiInstrument', 'Layer', 'suggestDefaultPool']
 
 
 class SynthRouter:
@@ -27,13 +34,83 @@ class SynthRouter:
         return self.connections[key]
 
 
-class SynthPool:
+class ChannelAllocator:
+    """
+    Keeps track of the channels of a synth in use. allocate() hands out the
+    lowest free channel; claim() marks a channel chosen by the caller as in
+    use. A channel is free again once each allocate or claim of it has been
+    released.
+    """
+
+    def __init__(self, channels=16):
+        self.channels = channels
+        self._users = [0] * channels
+
+    def allocate(self):
+        """
+        Return the lowest free channel, or None if all are in use.
+        """
+        users = self._users
+        for channel in range(self.channels):
+            if not users[channel]:
+                users[channel] = 1
+                return channel
+
+    def claim(self, channel):
+        if 0 <= channel < self.channels:
+            self._users[channel] += 1
 
-    def __init__(self, router, reactor=None, audiodev=None):
+    def release(self, channel):
+        if 0 <= channel < self.channels and self._users[channel]:
+            self._users[channel] -= 1
+
+    @property
+    def free(self):
+        return self._users.count(0)
+
+
+class SynthPool:
+    """
+    A pool of synths, one per connection of the router, which loads
+    soundfonts for instruments.
+
+    Each synth keeps a cache of the soundfonts loaded on it, keyed by path
+    and modification time, so instruments sharing a soundfont share one copy
+    of it. A soundfont is unloaded when the last instrument using it is
+    released (see L{releaseSoundFont}). The attributes C{cacheHits} and
+    C{cacheMisses} count loads served from and added to the cache.
+
+    Soundfonts can also be loaded on a thread pool with
+    L{loadSoundFontAsync}, so that loading a large soundfont doesn't hold
+    up the clock.
+
+    Channels are handed out by a L{ChannelAllocator} per synth, of
+    C{channelsPerSynth} channels, and are reused once released (see
+    L{releaseChannel}). When all channels of a connection's synth are in
+    use, instruments spill over to an additional synth for the connection,
+    made as needed and kept in C{spill}.
+    """
+
+    def __init__(self, router, reactor=None, audiodev=None,
+                 channelsPerSynth=16):
         self.router = router
         self.pool = {}
+        self.spill = {}
         self.settings = {}
-        self._channel_gen = {}
+        self.channelsPerSynth = channelsPerSynth
+        # synth -> ChannelAllocator
+        self._allocators = {}
+        # synth -> connection
+        self._connections = {}
+        # synth -> {(path, mtime): [sfid, refcount]}
+        self._soundfonts = {}
+        # synth -> {sfid: (path, mtime)}
+        self._sfkeys = {}
+        # synth -> {(path, mtime): [(deferred, channel, bank, preset)]}
+        self._loading = {}
+        self._threadpool = None
+        self.cacheHits = 0
+        self.cacheMisses = 0
         if reactor is None:
             reactor = getClock()
         self.reactor = reactor
@@ -47,8 +124,8 @@ class SynthPool:
         if self.audiodev is None:
             self.audiodev = self.reactor.synthAudioDevice
         for connection in self.pool:
-            fs = self.pool[connection]
-            fs.start(self.audiodev)
+            for fs in self.synths(connection):
+                fs.start(self.audiodev)
 
     def synthObject(self, connection='mono'):
         if connection not in self.router.connections:
@@ -56,37 +133,262 @@ class SynthPool:
         if connection in self.pool:
             fs = self.pool[connection]
         else:
-            gain, samplerate = self.settings.get(connection, (0.5, 44100))
-            fs = self.router.connections[connection](gain=gain,
-                                                     samplerate=samplerate)
-
-            def seq():
-                curr = 0
-                while 1:
-                    yield curr
-                    curr += 1
-
-            self._channel_gen[fs] = seq()
-            self.pool[connection] = fs
-            if self.reactor.running:
-                fs.start(self.audiodev)
+            fs = self.pool[connection] = self._newSynth(connection)
         return fs
 
-    def loadSoundFont(self, synth, sf2path, channel=None, bank=0, preset=0):
+    def synths(self, connection):
+        """
+        Return the synths of a connection: its synth followed by any it
+        has spilled over to.
+        """
+        if connection not in self.pool:
+            return []
+        return [self.pool[connection]] + self.spill.get(connection, [])
+
+    def _newSynth(self, connection):
+        gain, samplerate = self.settings.get(connection, (0.5, 44100))
+        fs = self.router.connections[connection](gain=gain,
+                                                 samplerate=samplerate)
+        self._allocators[fs] = ChannelAllocator(self.channelsPerSynth)
+        self._connections[fs] = connection
+        if self.reactor.running:
+            fs.start(self.audiodev)
+        return fs
+
+    def _allocator(self, synth):
+        # Synths from outside the pool get an allocator on first use
+        allocator = self._allocators.get(synth)
+        if allocator is None:
+            allocator = self._allocators[synth] = ChannelAllocator(
+                self.channelsPerSynth)
+        return allocator
+
+    def allocateChannel(self, synth, channel=None):
+        """
+        Allocate a channel for an instrument on C{synth}, returning the
+        synth and the channel. If C{channel} is given, it is claimed on
+        C{synth}. Otherwise the lowest free channel of the first of the
+        connection's synths with one free is allocated, adding a synth to
+        the connection if none has.
+        """
+        if channel is not None:
+            self._allocator(synth).claim(channel)
+            return (synth, channel)
+        connection = self._connections.get(synth)
+        candidates = [synth]
+        if connection is not None:
+            candidates.extend(fs for fs in self.synths(connection)
+                              if fs is not synth)
+        for fs in candidates:
+            channel = self._allocator(fs).allocate()
+            if channel is not None:
+                return (fs, channel)
+        if connection is None:
+            raise ValueError('No free channels on synth %r' % (synth,))
+        fs = self._newSynth(connection)
+        self.spill.setdefault(connection, []).append(fs)
+        return (fs, self._allocators[fs].allocate())
+
+    def releaseChannel(self, synth, channel):
+        """
+        Release a channel allocated or claimed by L{allocateChannel}.
+        """
+        if synth in self._allocators:
+            self._allocators[synth].release(channel)
+
+    def _takeChannel(self, synth, channel):
         if channel is None:
-            channel = self._channel_gen[synth].next()
-        sfid = synth.sfload(sf2path)
+            channel = self._allocator(synth).allocate()
+            if channel is None:
+                raise ValueError('No free channels on synth %r' % (synth,))
+        else:
+            self._allocator(synth).claim(channel)
+        return channel
+
+    def loadSoundFont(self, synth, sf2path, channel=None, bank=0, preset=0):
+        """
+        Select C{bank} and C{preset} of the soundfont at C{sf2path} on
+        C{channel} (by default the next free channel) of C{synth}, loading
+        the soundfont unless the synth already has it. Returns the soundfont
+        id and the channel. Each load should be balanced by calls to
+        L{releaseSoundFont} and L{releaseChannel}.
+        """
+        channel = self._takeChannel(synth, channel)
+        return self._loadSoundFont(synth, sf2path, channel, bank, preset)
+
+    def _loadSoundFont(self, synth, sf2path, channel, bank, preset):
+        if sf2path is None:
+            sfid = synth.sfload(sf2path)
+        else:
+            sfid = self._cachedLoad(synth, sf2path)
         synth.program_select(channel, sfid, bank, preset)
         return sfid, channel
 
+    def _cacheKey(self, sf2path):
+        try:
+            mtime = os.path.getmtime(sf2path)
+        except OSError:
+            mtime = None
+        return (os.path.abspath(sf2path), mtime)
+
+    def _cachedLoad(self, synth, sf2path):
+        key = self._cacheKey(sf2path)
+        cache = self._soundfonts.setdefault(synth, {})
+        entry = cache.get(key)
+        if entry is not None:
+            self.cacheHits += 1
+            entry[1] += 1
+            return entry[0]
+        self.cacheMisses += 1
+        sfid = synth.sfload(sf2path)
+        cache[key] = [sfid, 1]
+        self._sfkeys.setdefault(synth, {})[sfid] = key
+        return sfid
+
+    def loadSoundFontAsync(self, synth, sf2path, channel=None, bank=0,
+                           preset=0, threadpool=None):
+        """
+        Like L{loadSoundFont}, but call C{synth.sfload} on a thread of
+        C{threadpool} (by default a single thread owned by the pool) if the
+        soundfont isn't cached. Loads of the same soundfont wait on one
+        sfload. Returns a Deferred which fires with the soundfont id and
+        the channel on the clock's thread.
+        """
+        channel = self._takeChannel(synth, channel)
+        return self._loadSoundFontAsync(synth, sf2path, channel, bank, preset,
+                                        threadpool)
+
+    def _loadSoundFontAsync(self, synth, sf2path, channel, bank, preset,
+                            threadpool):
+        if sf2path is None:
+            return defer.succeed(
+                self._loadSoundFont(synth, sf2path, channel, bank, preset))
+        key = self._cacheKey(sf2path)
+        entry = self._soundfonts.get(synth, {}).get(key)
+        if entry is not None:
+            self.cacheHits += 1
+            entry[1] += 1
+            synth.program_select(channel, entry[0], bank, preset)
+            return defer.succeed((entry[0], channel))
+        loading = self._loading.setdefault(synth, {})
+        if key in loading:
+            self.cacheHits += 1
+        else:
+            self.cacheMisses += 1
+            loading[key] = []
+            if threadpool is None:
+                threadpool = self._getThreadPool()
+            d = threads.deferToThreadPool(self.reactor, threadpool,
+                                          synth.sfload, sf2path)
+            d.addBoth(self._loadedAsync, synth, key)
+        d = defer.Deferred()
+        loading[key].append((d, channel, bank, preset))
+        return d
+
+    def _loadedAsync(self, result, synth, key):
+        waiting = self._loading[synth].pop(key)
+        if isinstance(result, Failure):
+            for (d, channel, bank, preset) in waiting:
+                d.errback(result)
+            return
+        sfid = result
+        cache = self._soundfonts.setdefault(synth, {})
+        if key in cache:
+            # Loaded synchronously in the meantime; keep that copy
+            synth.sfunload(sfid)
+            sfid = cache[key][0]
+            cache[key][1] += len(waiting)
+        else:
+            cache[key] = [sfid, len(waiting)]
+            self._sfkeys.setdefault(synth, {})[sfid] = key
+        for (d, channel, bank, preset) in waiting:
+            synth.program_select(channel, sfid, bank, preset)
+            d.callback((sfid, channel))
+
+    def _getThreadPool(self):
+        if self._threadpool is None:
+            self._threadpool = ThreadPool(1, 1, 'SynthPool')
+            self._threadpool.start()
+            reactor = getattr(self.reactor, 'reactor', self.reactor)
+            reactor.addSystemEventTrigger('during', 'shutdown',
+                                          self._threadpool.stop)
+        return self._threadpool
+
+    def retainSoundFont(self, synth, sfid):
+        """
+        Take another reference to a soundfont loaded by L{loadSoundFont},
+        to be released with L{releaseSoundFont}. Soundfonts which were not
+        loaded from the cache are left alone.
+        """
+        key = self._sfkeys.get(synth, {}).get(sfid)
+        if key is not None:
+            self._soundfonts[synth][key][1] += 1
+
+    def releaseSoundFont(self, synth, sfid):
+        """
+        Release a soundfont loaded by L{loadSoundFont}, unloading it from
+        C{synth} if no instrument uses it any more. Soundfonts which were not
+        loaded from the cache are left alone.
+        """
+        key = self._sfkeys.get(synth, {}).get(sfid)
+        if key is None:
+            return
+        entry = self._soundfonts[synth][key]
+        entry[1] -= 1
+        if not entry[1]:
+            del self._soundfonts[synth][key]
+            del self._sfkeys[synth][sfid]
+            synth.sfunload(sfid)
+
+    def loadedSoundFonts(self, synth):
+        """
+        Return a dict mapping the C{(path, mtime)} of each cached soundfont
+        loaded on C{synth} to its soundfont id and reference count.
+        """
+        return dict((key, tuple(entry)) for (key, entry)
+                    in self._soundfonts.get(synth, {}).iteritems())
+
     def connectInstrument(self, synth, instr, sfpath=None,
                          channel=None, bank=0, preset=0, sfid=None):
+        """
+        Load a soundfont and register it with C{instr}. The instrument's
+        C{synth} is set to the synth it was allocated a channel on, which
+        is another synth of the same connection if C{synth} is full.
+
+        If C{sfid} is given, the instrument shares that soundfont (taking a
+        reference to it) rather than loading one, on C{channel} (by default
+        0), which is claimed.
+        """
         if sfid is not None:
-            return instr.registerSoundfont(sfid, channel or 0)
-        sfid, channel = self.loadSoundFont(synth, sfpath, channel, bank,
-                                           preset)
+            self.retainSoundFont(synth, sfid)
+            (synth, channel) = self.allocateChannel(synth, channel or 0)
+            return instr.registerSoundfont(sfid, channel)
+        (synth, channel) = self.allocateChannel(synth, channel)
+        instr.synth = synth
+        sfid, channel = self._loadSoundFont(synth, sfpath, channel, bank,
+                                            preset)
         instr.registerSoundfont(sfid, channel)
 
+    def connectInstrumentAsync(self, synth, instr, sfpath, channel=None,
+                               bank=0, preset=0, threadpool=None):
+        """
+        Load a soundfont with L{loadSoundFontAsync} and register it with
+        C{instr}, allocating a channel as L{connectInstrument} does. The
+        channel is registered at once with a soundfont id of None. Returns
+        a Deferred which fires with C{instr}.
+        """
+        (synth, channel) = self.allocateChannel(synth, channel)
+        instr.synth = synth
+        instr.registerSoundfont(None, channel)
+        d = self._loadSoundFontAsync(synth, sfpath, channel, bank, preset,
+                                     threadpool)
+
+        def register((sfid, channel)):
+            instr.registerSoundfont(sfid, channel)
+            return instr
+
+        return d.addCallback(register)
+
 
 def MonoPool():
     router = SynthRouter(mono=Synth)
@@ -111,15 +413,6 @@ def NConnectionPool(*p, **synth_factories):
 
 defaultPool = StereoPool()
 
-CC_VIBRATO = 1
-CC_VOLUME = 7
-CC_PAN = 10
-CC_EXPRESSION = 11
-CC_SUSTAIN = 64
-CC_REVERB = 91
-CC_CHORUS = 93
-
-
 class ChordPlayerMixin(object):
 
     clock = None
@@ -189,18 +482,24 @@ class Instrument(ChordPlayerMixin):
 
     def __init__(self, sfpath, synth=None, connection='mono',
                  channel=None, bank=0, preset=0, pool=None, clock=None):
+        self._setup(sfpath, synth, connection, channel, bank, preset, pool,
+                    clock)
+        self.pool.connectInstrument(self.synth, self, sfpath, channel=channel,
+                                    bank=bank, preset=preset)
+
+    def _setup(self, sfpath, synth, connection, channel, bank, preset, pool,
+               clock):
         if pool is None:
             pool = defaultPool
         if synth is None:
             synth = pool.synthObject(connection=connection)
         self.clock = getClock(clock)
+        self.pool = pool
         self.synth = synth
         self._file = os.path.basename(sfpath)
         self.sfpath = sfpath
         self._options = dict(sfpath=sfpath, connection=connection,
                              channel=channel, bank=bank, preset=preset)
-        pool.connectInstrument(self.synth, self, sfpath, channel=channel,
-                               bank=bank, preset=preset)
         self._max_velocity = 127
 
     def __str__(self):
@@ -211,13 +510,27 @@ class Instrument(ChordPlayerMixin):
         self.sfid = sfid
         self.channel = channel
 
+    def dispose(self):
+        """
+        Stop all notes and release the soundfont and the channel; the
+        instrument can't be played afterwards - events sent to it are
+        ignored, since its old channel may be given to another instrument.
+        """
+        if self.sfid is None:
+            return
+        self.stopall()
+        self.pool.releaseSoundFont(self.synth, self.sfid)
+        self.pool.releaseChannel(self.synth, self.channel)
+        self.sfid = None
+        self.channel = None
+
     def cap(self, maxVelocity):
         self._max_velocity = maxVelocity
 
     def noteon(self, note, velocity=80):
         if self.recorder is not None:
             self.recorder(self, 'noteon', note=note, velocity=velocity)
-        if note is None:
+        if note is None or self.channel is None:
             return
         velocity = min(velocity, self._max_velocity)
         self.synth.noteon(self.channel, note, velocity)
@@ -227,7 +540,7 @@ class Instrument(ChordPlayerMixin):
     def noteoff(self, note):
         if self.recorder is not None:
             self.recorder(self, 'noteoff', note=note)
-        if note is None:
+        if note is None or self.channel is None:
             return
         self.synth.noteoff(self.channel, note)
 
@@ -239,6 +552,8 @@ class Instrument(ChordPlayerMixin):
             self.recorder(self, 'controlChange', vibrato=vibrato, pan=pan,
                           expression=expression, sustain=sustain,
                           reverb=reverb, chorus=chorus, ignored=ignored)
+        if self.channel is None:
+            return
         if vibrato is not None:
             self.synth.cc(self.channel, CC_VIBRATO, vibrato)
         if pan is not None:
@@ -255,9 +570,121 @@ class Instrument(ChordPlayerMixin):
     def pitchBend(self, value):
         if self.recorder:
             self.recorder(self, 'pitchBend', value=value)
+        if self.channel is None:
+            return
         self.synth.pitch_bend(self.channel, value)
 
 
+class AsyncInstrument(Instrument):
+    """
+    An Instrument which loads its soundfont on a thread pool (see
+    L{SynthPool.loadSoundFontAsync}) rather than in the constructor, so it
+    can be made mid-set without stalling the clock. It can be played at
+    once: until the soundfont is loaded, events are queued - up to
+    C{queueSize}, after which they are dropped (and counted in C{dropped})
+    - and played when it is. By default events are dropped.
+
+    The Deferred C{ready} fires with the instrument once it is loaded. If the
+    instrument is disposed of before then, C{ready} fails with
+    C{CancelledError} and the instrument is never loaded: events sent to it
+    are dropped.
+
+    Example:
+
+        strings = AsyncInstrument('strings.sf2', queueSize=16)
+        player = Player(strings, Random(60, 64, 67), interval=(1, 4))
+        strings.ready.addCallback(lambda instr: player.resumePlaying())
+    """
+
+    def __init__(self, sfpath, synth=None, connection='mono',
+                 channel=None, bank=0, preset=0, pool=None, clock=None,
+                 queueSize=0, threadpool=None):
+        self._setup(sfpath, synth, connection, channel, bank, preset, pool,
+                    clock)
+        self.sfid = None
+        self.channel = channel
+        self.loaded = False
+        self.queueSize = queueSize
+        self.dropped = 0
+        self._queue = deque()
+        self._disposed = False
+        self.ready = self.pool.connectInstrumentAsync(
+            self.synth, self, sfpath, channel=channel, bank=bank,
+            preset=preset, threadpool=threadpool)
+        self.ready.addCallbacks(self._loaded, self._failed)
+
+    def _loaded(self, instr):
+        if self._disposed:
+            self.pool.releaseSoundFont(self.synth, self.sfid)
+            self.pool.releaseChannel(self.synth, self.channel)
+            self.sfid = None
+            self.channel = None
+            return Failure(defer.CancelledError(
+                '%s was disposed of while loading' % self.sfpath))
+        self.loaded = True
+        queue = self._queue
+        while queue:
+            (method, args, kw) = queue.popleft()
+            method(self, *args, **kw)
+        return self
+
+    def _failed(self, failure):
+        self.pool.releaseChannel(self.synth, self.channel)
+        self._queue.clear()
+        return failure
+
+    def _enqueue(self, method, *args, **kw):
+        if len(self._queue) < self.queueSize and not self._disposed:
+            self._queue.append((method, args, kw))
+        else:
+            self.dropped += 1
+
+    def noteon(self, note, velocity=80):
+        if not self.loaded:
+            return self._enqueue(Instrument.noteon, note, velocity)
+        Instrument.noteon(self, note, velocity)
+
+    playnote = noteon
+
+    def noteoff(self, note):
+        if not self.loaded:
+            return self._enqueue(Instrument.noteoff, note)
+        Instrument.noteoff(self, note)
+
+    stopnote = noteoff
+
+    def controlChange(self, vibrato=None, pan=None, expression=None,
+                      sustain=None, reverb=None, chorus=None, **other):
+        controls = dict(other, vibrato=vibrato, pan=pan,
+                        expression=expression, sustain=sustain,
+                        reverb=reverb, chorus=chorus)
+        if not self.loaded:
+            return self._enqueue(Instrument.controlChange, **controls)
+        Instrument.controlChange(self, **controls)
+
+    def pitchBend(self, value):
+        if not self.loaded:
+            return self._enqueue(Instrument.pitchBend, value)
+        Instrument.pitchBend(self, value)
+
+    def stopall(self):
+        if not self.loaded:
+            self._queue.clear()
+            return
+        Instrument.stopall(self)
+
+    def dispose(self):
+        """
+        Dispose of the instrument - if it is still loading, the soundfont
+        and the channel are released as soon as it has loaded.
+        """
+        if not self.loaded:
+            self._disposed = True
+            self._queue.clear()
+            return
+        Instrument.dispose(self)
+
+
 class MultiInstrument(ChordPlayerMixin):
 
     def __init__(self, instrumentMapping, strict=True):
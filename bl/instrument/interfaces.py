@@ -1,6 +1,27 @@
 from zope.interface import Interface, Attribute
 
 
+# Control change numbers
+CC_VIBRATO = 1
+CC_VOLUME = 7
+CC_PAN = 10
+CC_EXPRESSION = 11
+CC_SUSTAIN = 64
+CC_REVERB = 91
+CC_CHORUS = 93
+
+# Control change numbers by IMIDIInstrument.controlChange keyword
+CONTROLS = {
+    'vibrato': CC_VIBRATO,
+    'volume': CC_VOLUME,
+    'pan': CC_PAN,
+    'expression': CC_EXPRESSION,
+    'sustain': CC_SUSTAIN,
+    'reverb': CC_REVERB,
+    'chorus': CC_CHORUS,
+}
+
+
 class Instrument(Interface):
     """
     Abstract interface for Instruments: Wrappers around various
@@ -74,3 +95,30 @@ class IMIDIInstrument(Interface):
 
         @param value: The pitch bend amount [0,127]
         """
+
+
+class IVoiceManager(IMIDIInstrument):
+    """
+    A MIDI instrument which tracks sounding voices: it caps polyphony and
+    manages note releases with a single release queue.
+    """
+
+    polyphony = Attribute("""
+        Maximum number of voices sounding at once or None for no limit.
+        """)
+
+    activeVoices = Attribute("""
+        Number of voices currently sounding.
+        """)
+
+    steals = Attribute("""
+        Number of voices stopped early to make room for new ones.
+        """)
+
+    def releaseLater(note, ticks):
+        """
+        Release the most recently played voice for note after ticks.
+
+        @param note: The note [0,127] or a list of notes
+        @param ticks: Ticks before sending "Note Off"
+        """
@@ -14,18 +14,25 @@ class MockSynth(object):
         self.gain = gain
         self.samplerate = samplerate
         self.sfonts = {}
+        self.events = []
 
-    def noteon(self, note, velocity):
-        pass
+    def noteon(self, channel, note, velocity):
+        self.events.append(('noteon', channel, note, velocity))
 
-    def noteoff(self, note):
-        pass
+    def noteoff(self, channel, note):
+        self.events.append(('noteoff', channel, note))
+
+    def cc(self, channel, control, value):
+        self.events.append(('cc', channel, control, value))
 
     def sfload(self, path):
         sfid = nextid.next()
         self.sfonts[sfid] = (None, None, None, path)
         return sfid
 
+    def sfunload(self, sfid, update_midi_preset=0):
+        del self.sfonts[sfid]
+
     def program_select(self, channel, sfid, bank, preset):
         (_, _, _, path) = self.sfonts[sfid]
         self.sfonts[sfid] = (channel, bank, preset, path)
@@ -1,7 +1,13 @@
+import os
+
 from zope.interface.verify import verifyClass, verifyObject
 
+from twisted.internet import defer
 from twisted.trial.unittest import TestCase
+from twisted.python.failure import Failure
 
+from bl.testlib import ClockRunner, TestReactor
+from bl.scheduler import BeatClock, Tempo
 from bl.instrument.interfaces import IMIDIInstrument
 from bl.instrument import fsynth
 
@@ -12,6 +18,8 @@ Synth = synthmodule.Synth
 SynthRouter = fsynth.SynthRouter
 SynthPool = fsynth.SynthPool
 Instrument = fsynth.Instrument
+AsyncInstrument = fsynth.AsyncInstrument
+ChannelAllocator = fsynth.ChannelAllocator
 MultiInstrument = fsynth.MultiInstrument
 Layer = fsynth.Layer
 
@@ -105,6 +113,134 @@ class SynthPoolTests(TestCase):
         self.assertEquals(instr.channel, 7)
 
 
+class ChannelAllocatorTests(TestCase):
+
+    def test_allocate(self):
+        allocator = ChannelAllocator(3)
+        self.assertEquals([allocator.allocate() for i in range(4)],
+                          [0, 1, 2, None])
+        allocator.release(1)
+        self.assertEquals(allocator.free, 1)
+        self.assertEquals(allocator.allocate(), 1)
+
+    def test_claim(self):
+        allocator = ChannelAllocator(3)
+        allocator.claim(0)
+        allocator.claim(0)
+        allocator.claim(9)
+        self.assertEquals(allocator.allocate(), 1)
+        allocator.release(0)
+        self.assertEquals(allocator.allocate(), 2)
+        allocator.release(0)
+        allocator.release(0)
+        allocator.release(9)
+        self.assertEquals(allocator.free, 1)
+        self.assertEquals(allocator.allocate(), 0)
+
+
+class ChannelSpillTests(TestCase):
+
+    def setUp(self):
+        self.patch(fsynth, 'Synth', Synth)
+        self.router = SynthRouter(mono=Synth, left=Synth)
+        self.pool = SynthPool(self.router, channelsPerSynth=2)
+
+    def tearDown(self):
+        synthmodule.nextid = synthmodule._nextid(0)
+
+    def instrument(self, connection='mono'):
+        return Instrument('sf2/instrument.sf2', connection=connection,
+                          pool=self.pool)
+
+    def test_spill(self):
+        synth = self.pool.synthObject()
+        instrs = [self.instrument() for i in range(5)]
+        self.assertEquals([instr.channel for instr in instrs],
+                          [0, 1, 0, 1, 0])
+        synths = self.pool.synths('mono')
+        self.assertEquals(len(synths), 3)
+        self.assertIdentical(synths[0], synth)
+        self.assertEquals([synths.index(instr.synth) for instr in instrs],
+                          [0, 0, 1, 1, 2])
+        # Spill synths are made with the connection's settings
+        self.assertEquals(synths[2].gain, 0.5)
+        self.assertEquals(self.pool.synths('left'), [])
+        self.assertIdentical(self.pool.synthObject(), synth)
+
+    def test_reuse(self):
+        instrs = [self.instrument() for i in range(3)]
+        instrs[1].dispose()
+        instr = self.instrument()
+        self.assertIdentical(instr.synth, instrs[1].synth)
+        self.assertEquals(instr.channel, 1)
+        instrs[1].dispose()
+        self.assertEquals(len(self.pool.synths('mono')), 2)
+
+    def test_explicit_channel(self):
+        instr = Instrument('sf2/instrument.sf2', channel=0, pool=self.pool)
+        self.assertEquals(instr.channel, 0)
+        self.assertEquals(self.instrument().channel, 1)
+        instr.dispose()
+        self.assertEquals(self.instrument().channel, 0)
+
+    def test_unpooled_synth(self):
+        synth = Synth()
+        self.pool.loadSoundFont(synth, 'sound.sf2')
+        self.pool.loadSoundFont(synth, 'sound.sf2')
+        self.assertRaises(ValueError, self.pool.loadSoundFont, synth,
+                          'sound.sf2')
+
+
+class SoundFontCacheTests(TestCase):
+
+    def setUp(self):
+        self.router = SynthRouter(left=Synth, right=Synth, mono=Synth)
+        self.pool = SynthPool(self.router)
+        self.path = self.mktemp()
+        open(self.path, 'w').close()
+
+    def tearDown(self):
+        synthmodule.nextid = synthmodule._nextid(0)
+
+    def test_shared(self):
+        synth = self.pool.synthObject()
+        self.assertEquals(self.pool.loadSoundFont(synth, self.path), (0, 0))
+        self.assertEquals(self.pool.loadSoundFont(synth, self.path, preset=3),
+                          (0, 1))
+        self.assertEquals(self.pool.cacheMisses, 1)
+        self.assertEquals(self.pool.cacheHits, 1)
+        self.assertEquals(len(synth.sfonts), 1)
+        # Each synth has its own cache
+        other = self.pool.synthObject(connection='left')
+        self.assertEquals(self.pool.loadSoundFont(other, self.path), (1, 0))
+        self.assertEquals(self.pool.cacheMisses, 2)
+
+    def test_release(self):
+        synth = self.pool.synthObject()
+        self.pool.loadSoundFont(synth, self.path)
+        self.pool.loadSoundFont(synth, self.path)
+        (key,) = self.pool.loadedSoundFonts(synth)
+        self.assertEquals(self.pool.loadedSoundFonts(synth), {key: (0, 2)})
+        self.pool.releaseSoundFont(synth, 0)
+        self.assertEquals(self.pool.loadedSoundFonts(synth), {key: (0, 1)})
+        self.assertIn(0, synth.sfonts)
+        self.pool.releaseSoundFont(synth, 0)
+        self.assertEquals(self.pool.loadedSoundFonts(synth), {})
+        self.assertEquals(synth.sfonts, {})
+        # Unknown soundfont ids are ignored
+        self.pool.releaseSoundFont(synth, 0)
+        self.pool.releaseSoundFont(synth, 99)
+        self.assertEquals(self.pool.loadSoundFont(synth, self.path), (1, 2))
+        self.assertEquals(self.pool.cacheMisses, 2)
+
+    def test_modified(self):
+        synth = self.pool.synthObject()
+        self.pool.loadSoundFont(synth, self.path)
+        os.utime(self.path, (0, 0))
+        self.assertEquals(self.pool.loadSoundFont(synth, self.path)[0], 1)
+        self.assertEquals(self.pool.cacheMisses, 2)
+
+
 class InstrumentTests(TestCase):
 
     def setUp(self):
@@ -128,6 +264,59 @@ class InstrumentTests(TestCase):
         self.assertEquals(instr1.sfid, 1)
         self.assertEquals(instr1.channel, 1)
 
+    def test_dispose(self):
+        instr1 = Instrument('sf2/instrument.sf2')
+        instr2 = Instrument('sf2/instrument.sf2')
+        self.assertEquals((instr1.sfid, instr2.sfid), (0, 0))
+        self.assertEquals(fsynth.defaultPool.cacheHits, 1)
+        instr1.dispose()
+        self.assertIdentical(instr1.sfid, None)
+        self.assertEquals(instr2.synth.sfonts.keys(), [0])
+        instr1.dispose()
+        instr2.dispose()
+        self.assertEquals(instr2.synth.sfonts, {})
+
+    def test_play_after_dispose(self):
+        instr1 = Instrument('sf2/instrument.sf2')
+        instr1.dispose()
+        instr2 = Instrument('sf2/instrument.sf2')
+        self.assertEquals(instr2.channel, 0)
+        del instr2.synth.events[:]
+        instr1.noteon(60, 100)
+        instr1.noteoff(60)
+        instr1.controlChange(pan=64, sustain=127)
+        instr1.pitchBend(8192)
+        instr1.stopall()
+        self.assertEquals(instr2.synth.events, [])
+
+    def test_dispose_shared_sfid(self):
+        pool = fsynth.defaultPool
+        instr1 = Instrument('sf2/instrument.sf2')
+        instr2 = Instrument('sf2/instrument2.sf2')
+        pool.connectInstrument(instr1.synth, instr2, sfid=instr1.sfid)
+        self.assertEquals(instr2.sfid, 0)
+        instr2.dispose()
+        self.assertIn(0, instr1.synth.sfonts)
+        (key,) = [key for (key, (sfid, refs))
+                  in pool.loadedSoundFonts(instr1.synth).items() if sfid == 0]
+        self.assertEquals(pool.loadedSoundFonts(instr1.synth)[key], (0, 1))
+        instr1.dispose()
+        self.assertNotIn(0, instr1.synth.sfonts)
+
+    def test_dispose_shared_channel(self):
+        pool = fsynth.defaultPool
+        instr1 = Instrument('sf2/instrument.sf2')
+        instr2 = Instrument('sf2/instrument2.sf2')
+        instr3 = TestInstrument()
+        pool.connectInstrument(instr1.synth, instr3, sfid=instr1.sfid)
+        self.assertEquals(instr3.channel, 0)
+        pool.releaseChannel(instr1.synth, instr3.channel)
+        # instr1 still has channel 0
+        instr4 = Instrument('sf2/instrument.sf2')
+        self.assertEquals(instr4.channel, 2)
+        instr2.dispose()
+        self.assertEquals(Instrument('sf2/instrument.sf2').channel, 1)
+
     def test_instrumentIsConnectedCorrectly(self):
         fsynth.defaultPool.bindSettings('mono', gain=0.2)
         fsynth.defaultPool.bindSettings('left', gain=0.3)
@@ -140,6 +329,121 @@ class InstrumentTests(TestCase):
         self.assertEquals(instr_right.synth.gain, 0.4)
 
 
+class FakeThreadPool:
+
+    def __init__(self):
+        self.calls = []
+
+    def callInThreadWithCallback(self, onResult, f, *a, **kw):
+        self.calls.append((onResult, f, a, kw))
+
+    def runCalls(self):
+        calls = self.calls
+        self.calls = []
+        for (onResult, f, a, kw) in calls:
+            try:
+                result = f(*a, **kw)
+            except:
+                onResult(False, Failure())
+            else:
+                onResult(True, result)
+
+
+class AsyncInstrumentTests(TestCase, ClockRunner):
+
+    def setUp(self):
+        self.clock = BeatClock(Tempo(120), reactor=TestReactor())
+        self.router = SynthRouter(mono=Synth)
+        self.pool = SynthPool(self.router, reactor=self.clock)
+        self.threadpool = FakeThreadPool()
+
+    def tearDown(self):
+        synthmodule.nextid = synthmodule._nextid(0)
+
+    def instrument(self, sfpath='sf2/instrument.sf2', **kw):
+        return AsyncInstrument(sfpath, pool=self.pool, clock=self.clock,
+                               threadpool=self.threadpool, **kw)
+
+    def test_iface(self):
+        verifyObject(IMIDIInstrument, self.instrument())
+
+    def test_load(self):
+        instr = self.instrument(queueSize=2)
+        loaded = []
+        instr.ready.addCallback(loaded.append)
+        instr.noteon(60, 100)
+        instr.controlChange(pan=10)
+        instr.noteoff(60)
+        self.assertEquals((instr.loaded, instr.dropped), (False, 1))
+        self.assertEquals((instr.sfid, instr.channel), (None, 0))
+        self.assertEquals(instr.synth.sfonts, {})
+        # Loaded on the thread, registered on the next tick
+        self.threadpool.runCalls()
+        self.assertEquals(instr.synth.sfonts.keys(), [0])
+        self.failIf(loaded)
+        self.runTicks(1)
+        self.assertEquals(loaded, [instr])
+        self.assertEquals((instr.sfid, instr.channel), (0, 0))
+        self.assertEquals(instr.synth.events, [('noteon', 0, 60, 100),
+                                               ('cc', 0, 10, 10)])
+        instr.noteoff(60)
+        self.assertEquals(instr.synth.events[-1], ('noteoff', 0, 60))
+
+    def test_drop(self):
+        instr = self.instrument()
+        instr.noteon(60, 100)
+        self.threadpool.runCalls()
+        self.runTicks(1)
+        self.assertEquals(instr.dropped, 1)
+        self.failIf(instr.synth.events)
+
+    def test_shared_load(self):
+        instr1 = self.instrument()
+        instr2 = self.instrument(preset=2)
+        self.assertEquals(len(self.threadpool.calls), 1)
+        self.threadpool.runCalls()
+        self.runTicks(1)
+        self.assertEquals((instr1.sfid, instr1.channel), (0, 0))
+        self.assertEquals((instr2.sfid, instr2.channel), (0, 1))
+        self.assertEquals((self.pool.cacheMisses, self.pool.cacheHits), (1, 1))
+        instr3 = self.instrument()
+        self.failIf(self.threadpool.calls)
+        self.assert_(instr3.loaded)
+        self.assertEquals((self.pool.cacheMisses, self.pool.cacheHits), (1, 2))
+
+    def test_dispose_while_loading(self):
+        instr = self.instrument(queueSize=4)
+        instr.noteon(60, 100)
+        failures = []
+        instr.ready.addErrback(failures.append)
+        instr.dispose()
+        self.threadpool.runCalls()
+        self.runTicks(1)
+        self.assertIdentical(instr.sfid, None)
+        self.assertEquals(instr.synth.sfonts, {})
+        failures[0].trap(defer.CancelledError)
+        self.failIf(instr.loaded)
+        instr.noteon(60, 100)
+        self.assertEquals(instr.dropped, 1)
+        self.failIf(instr.synth.events)
+        self.assertEquals(self.instrument().channel, 0)
+
+    def test_load_failure(self):
+        def sfload(path):
+            raise IOError('No such file')
+
+        self.pool.synthObject().sfload = sfload
+        instr = self.instrument()
+        failures = []
+        instr.ready.addErrback(failures.append)
+        self.threadpool.runCalls()
+        self.runTicks(1)
+        self.assertEquals(len(failures), 1)
+        failures[0].trap(IOError)
+        self.failIf(instr.loaded)
+        self.assertEquals(self.instrument().channel, 0)
+
+
 class MockInstrument:
 
     def __init__(self):
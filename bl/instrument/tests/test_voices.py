@@ -0,0 +1,142 @@
+from itertools import cycle
+
+from zope.interface.verify import verifyObject
+
+from twisted.trial.unittest import TestCase
+
+from bl.scheduler import BeatClock, Tempo
+from bl.testlib import ClockRunner, TestReactor, TestInstrument
+from bl.orchestra.midi import Player, ChordPlayer
+from bl.instrument.interfaces import IVoiceManager
+from bl.instrument.voices import (VoiceManager, STEAL_OLDEST, STEAL_QUIETEST,
+                                  STEAL_RETRIGGER)
+
+
+class VoiceManagerTests(TestCase, ClockRunner):
+
+    def setUp(self):
+        self.clock = BeatClock(Tempo(135), reactor=TestReactor())
+        self.instr = TestInstrument(self.clock)
+
+    def test_iface(self):
+        verifyObject(IVoiceManager, VoiceManager(self.instr, clock=self.clock))
+
+    def test_invalid_steal_policy(self):
+        self.assertRaises(ValueError, VoiceManager, self.instr, 4, 'loudest',
+                          self.clock)
+
+    def test_unlimited_polyphony(self):
+        voices = VoiceManager(self.instr, clock=self.clock)
+        for note in range(32):
+            voices.noteon(note, 100)
+        self.assertEquals(voices.activeVoices, 32)
+        self.assertEquals(voices.steals, 0)
+        voices.noteoff(3)
+        self.assertEquals(voices.activeVoices, 31)
+        self.assertEquals(self.instr.stops, [('note', 0, 3)])
+        # Not sounding: ignored
+        voices.noteoff(3)
+        self.assertEquals(self.instr.stops, [('note', 0, 3)])
+
+    def test_steal_oldest(self):
+        voices = VoiceManager(self.instr, 2, STEAL_OLDEST, self.clock)
+        voices.noteon(60, 100)
+        voices.noteon(64, 20)
+        voices.noteon(67, 100)
+        self.assertEquals(voices.activeVoices, 2)
+        self.assertEquals(voices.steals, 1)
+        self.assertEquals(self.instr.stops, [('note', 0, 60)])
+
+    def test_steal_quietest(self):
+        voices = VoiceManager(self.instr, 3, STEAL_QUIETEST, self.clock)
+        voices.noteon(60, 100)
+        voices.noteon(64, 20)
+        voices.noteon(67, 20)
+        voices.noteon(71, 100)
+        voices.noteon(72, 100)
+        self.assertEquals(voices.steals, 2)
+        self.assertEquals(self.instr.stops, [('note', 0, 64), ('note', 0, 67)])
+
+    def test_steal_retrigger(self):
+        voices = VoiceManager(self.instr, 3, STEAL_RETRIGGER, self.clock)
+        voices.noteon(60, 100)
+        voices.noteon(64, 100)
+        voices.noteon(60, 90)
+        self.assertEquals(voices.activeVoices, 2)
+        self.assertEquals(voices.steals, 1)
+        self.assertEquals(self.instr.stops, [('note', 0, 60)])
+        voices.noteon(67, 100)
+        voices.noteon(71, 100)
+        self.assertEquals(voices.steals, 2)
+        self.assertEquals(self.instr.stops, [('note', 0, 60), ('note', 0, 64)])
+
+    def test_releaseLater(self):
+        voices = VoiceManager(self.instr, clock=self.clock)
+        voices.noteon(60, 100)
+        voices.releaseLater(60, 12)
+        voices.noteon(64, 100)
+        voices.releaseLater(64, 6)
+        voices.chordon([67, 71], 100)
+        voices.releaseLater([67, 71], 24)
+        self.runTicks(24)
+        self.assertEquals(self.instr.stops,
+                          [('note', 6, 64), ('note', 12, 60),
+                           ('note', 24, 67), ('note', 24, 71)])
+        self.assertEquals(voices.activeVoices, 0)
+
+    def test_stolen_voice_is_not_released_again(self):
+        voices = VoiceManager(self.instr, 1, STEAL_RETRIGGER, self.clock)
+        voices.noteon(60, 100)
+        voices.releaseLater(60, 12)
+        self.runTicks(6)
+        voices.noteon(60, 100)
+        voices.releaseLater(60, 12)
+        self.runTicks(12)
+        self.assertEquals(self.instr.stops, [('note', 6, 60), ('note', 18, 60)])
+
+    def test_stopall(self):
+        voices = VoiceManager(self.instr, clock=self.clock)
+        voices.chordon([60, 64, 67], 100)
+        voices.releaseLater(60, 12)
+        voices.stopall()
+        self.runTicks(24)
+        self.assertEquals(self.instr.stops,
+                          [('note', 0, 60), ('note', 0, 64), ('note', 0, 67)])
+
+
+class VoiceManagedPlayerTests(TestCase, ClockRunner):
+
+    def setUp(self):
+        self.clock = BeatClock(Tempo(135), reactor=TestReactor())
+        self.instr = TestInstrument(self.clock)
+        self.dtt = self.clock.meter.dtt
+
+    def test_player_releases_through_voice_manager(self):
+        voices = VoiceManager(self.instr, 2, clock=self.clock)
+        player = Player(voices, cycle([0, 1]).next,
+                        velocity=cycle([120]).next,
+                        release=cycle([36]).next,
+                        clock=self.clock, interval=self.dtt(1, 8))
+        player.resumePlaying()
+        self.runTicks(48)
+        self.assertEquals(len(self.instr.plays), 5)
+        # Each new note steals the oldest of two voices before release
+        self.assertEquals(self.instr.stops,
+                          [('note', 24, 0), ('note', 36, 1), ('note', 48, 0)])
+        self.assertEquals(voices.steals, 3)
+        self.assertEquals(voices.activeVoices, 2)
+        self.assertEquals(voices._releaseCall.getTime(), 60)
+
+    def test_chord_player(self):
+        voices = VoiceManager(self.instr, clock=self.clock)
+        player = ChordPlayer(voices, cycle([[60, 64]]).next,
+                             velocity=cycle([100]).next,
+                             release=cycle([12]).next,
+                             clock=self.clock, interval=self.dtt(1, 4))
+        player.resumePlaying()
+        self.runTicks(24)
+        self.assertEquals(self.instr.plays,
+                          [('note', 0, 60, 100), ('note', 0, 64, 100),
+                           ('note', 24, 60, 100), ('note', 24, 64, 100)])
+        self.assertEquals(self.instr.stops,
+                          [('note', 12, 60), ('note', 12, 64)])
@@ -0,0 +1,188 @@
+"""
+Voice management for MIDI instruments.
+
+A VoiceManager wraps an instrument, keeping a table of sounding voices with a
+configurable maximum polyphony. When the table is full a voice is stolen
+according to the steal policy:
+
+    STEAL_OLDEST: stop the voice that started first
+    STEAL_QUIETEST: stop the voice with the lowest velocity (oldest first
+        on ties)
+    STEAL_RETRIGGER: stop a sounding voice of the same note before playing it
+        again; otherwise steal the oldest voice
+
+Releases (see releaseLater) are kept in one queue ordered by tick and
+serviced by a single delayed call on the clock.
+
+Example:
+
+    piano = VoiceManager(Instrument(sf2('piano.sf2')), polyphony=8)
+    player = Player(piano, Random(60, 64, 67), release=C(48, 24),
+                    interval=(1, 16))
+"""
+import heapq
+from collections import OrderedDict
+
+from zope.interface import implements
+
+from bl.utils import getClock
+from bl.instrument.interfaces import IVoiceManager
+
+
+__all__ = ['VoiceManager', 'STEAL_OLDEST', 'STEAL_QUIETEST',
+           'STEAL_RETRIGGER']
+
+
+STEAL_OLDEST = 'oldest'
+STEAL_QUIETEST = 'quietest'
+STEAL_RETRIGGER = 'retrigger'
+
+
+class VoiceManager(object):
+    implements(IVoiceManager)
+
+    def __init__(self, instr, polyphony=None, steal=STEAL_OLDEST, clock=None):
+        """
+        @param instr: The wrapped L{IMIDIInstrument}
+        @param polyphony: Maximum voices sounding at once (None for no limit)
+        @param steal: The steal policy: one of STEAL_OLDEST, STEAL_QUIETEST or
+        STEAL_RETRIGGER
+        @param clock: A L{BeatClock} (defaults to global default clock)
+        """
+        if steal not in (STEAL_OLDEST, STEAL_QUIETEST, STEAL_RETRIGGER):
+            raise ValueError('Unknown steal policy: %r' % (steal,))
+        self.instr = instr
+        self.polyphony = polyphony
+        self.steal = steal
+        self.clock = getClock(clock)
+        self.steals = 0
+        self._serial = 0
+        # serial -> [note, velocity, releasing]; iteration is oldest first
+        self._voices = OrderedDict()
+        # heap of (tick, serial)
+        self._releases = []
+        self._releaseCall = None
+
+    @property
+    def channel(self):
+        return getattr(self.instr, 'channel', None)
+
+    @property
+    def activeVoices(self):
+        return len(self._voices)
+
+    def noteon(self, note, velocity=80):
+        if note is None:
+            return self.instr.noteon(note, velocity)
+        if self.steal == STEAL_RETRIGGER:
+            serial = self._find(note)
+            if serial is not None:
+                self._steal(serial)
+        if self.polyphony is not None:
+            while self._voices and len(self._voices) >= self.polyphony:
+                self._steal(self._victim())
+        self._serial += 1
+        self._voices[self._serial] = [note, velocity, False]
+        self.instr.noteon(note, velocity)
+
+    playnote = noteon
+
+    def noteoff(self, note):
+        """
+        Stop the oldest sounding voice for note. This is a noop if no voice
+        for note is sounding (for example, if it was stolen).
+        """
+        serial = self._find(note)
+        if serial is not None:
+            self._stop(serial)
+
+    stopnote = noteoff
+
+    def chordon(self, notes, velocity=80):
+        for note in notes:
+            self.noteon(note, velocity)
+
+    playchord = chordon
+
+    def chordoff(self, notes):
+        for note in notes:
+            self.noteoff(note)
+
+    stopchord = chordoff
+
+    def stopall(self):
+        """
+        Stop all sounding voices and forget pending releases.
+        """
+        for serial in list(self._voices):
+            self._stop(serial)
+        self._releases = []
+        self._scheduleRelease()
+
+    def controlChange(self, vibrato=None, pan=None, expression=None,
+                      sustain=None, reverb=None, chorus=None, **other):
+        self.instr.controlChange(vibrato=vibrato, pan=pan,
+                                 expression=expression, sustain=sustain,
+                                 reverb=reverb, chorus=chorus, **other)
+
+    def pitchBend(self, value):
+        self.instr.pitchBend(value)
+
+    def releaseLater(self, note, ticks):
+        if type(note) in (list, tuple):
+            for n in note:
+                self.releaseLater(n, ticks)
+            return
+        serial = self._find(note, newest=True, releasing=False)
+        if serial is None:
+            return
+        self._voices[serial][2] = True
+        heapq.heappush(self._releases, (self.clock.ticks + ticks, serial))
+        self._scheduleRelease()
+
+    def _find(self, note, newest=False, releasing=None):
+        serials = self._voices.keys()
+        if newest:
+            serials.reverse()
+        for serial in serials:
+            voice = self._voices[serial]
+            if voice[0] == note and releasing in (None, voice[2]):
+                return serial
+
+    def _victim(self):
+        if self.steal == STEAL_QUIETEST:
+            return min(self._voices,
+                       key=lambda serial: self._voices[serial][1])
+        return next(iter(self._voices))
+
+    def _steal(self, serial):
+        self.steals += 1
+        self._stop(serial)
+
+    def _stop(self, serial):
+        note = self._voices.pop(serial)[0]
+        self.instr.noteoff(note)
+
+    def _scheduleRelease(self):
+        call = self._releaseCall
+        if not self._releases:
+            if call is not None and call.active():
+                call.cancel()
+            self._releaseCall = None
+            return
+        when = self._releases[0][0]
+        if call is not None and call.active():
+            if call.getTime() <= when:
+                return
+            call.cancel()
+        self._releaseCall = self.clock.callLater(
+            max(0, when - self.clock.ticks), self._release)
+
+    def _release(self):
+        self._releaseCall = None
+        ticks = self.clock.ticks
+        while self._releases and self._releases[0][0] <= ticks:
+            (when, serial) = heapq.heappop(self._releases)
+            if serial in self._voices:
+                self._stop(serial)
+        self._scheduleRelease()
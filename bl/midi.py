@@ -1,16 +1,130 @@
-import pypm
+import os
+import json
+import math
+import time
+import threading
+from collections import deque
+
+if os.environ.get('BL_MIDI_BACKEND') == 'virtual':
+    # In-process loopback devices instead of PortMidi (see bl.virtualmidi)
+    from bl import virtualmidi as pypm
+else:
+    import pypm
+
+from zope.interface import implements
+
+from twisted.python import log
 
 from bl.utils import getClock
 from bl.debug import debug
+from bl.instrument.interfaces import IMIDIInstrument, CONTROLS
+
+__all__ = ['setBackend', 'init', 'initialize', 'rescan', 'getInput',
+           'getOutput', 'printDeviceSummary', 'DeviceHandle',
+           'ClockSender', 'MidiDispatcher', 'ThreadedMidiDispatcher',
+           'MidiReader', 'TickStamper', 'FUNCTIONS', 'ChordHandler',
+           'MonitorHandler', 'NoteEventHandler', 'MidiOutInstrument',
+           'interestStatuses', 'handlerStatuses', 'buildRoutes']
+
+
+def setBackend(backend):
+    """
+    Use C{backend} - pypm or a module with the same API, such as
+    L{bl.virtualmidi} - for all MIDI input and output. This should be called
+    before anything is initialized or opened. The backend can also be set to
+    bl.virtualmidi by setting the environment variable C{BL_MIDI_BACKEND} to
+    C{virtual}, in which case pypm need not be installed.
+    """
+    global pypm
+    pypm = backend
+
+
+class DeviceHandle(object):
+    """
+    A pypm Input or Output which PypmWrapper can reopen when devices come
+    and go. Reads from and writes to a device which is not connected are
+    dropped. Other attributes are those of the underlying C{stream}.
+
+    Outputs are opened with a latency of C{latency} milliseconds. PortMidi
+    only honours the timestamps of events written to outputs with a
+    non-zero latency; with zero latency they are sent at once.
+    """
+
+    def __init__(self, kind, devno, name=None, latency=0):
+        self.kind = kind
+        self.name = name
+        self.latency = latency
+        self.devno = None
+        self.stream = None
+        self._lock = threading.Lock()
+        self.reopen(devno)
+
+    @property
+    def connected(self):
+        return self.stream is not None
+
+    def reopen(self, devno):
+        """
+        Close the stream and open device C{devno} (unless it is None).
+        """
+        with self._lock:
+            self._close()
+            self.devno = devno
+            if devno is not None:
+                if self.kind == 'input':
+                    self.stream = pypm.Input(devno)
+                else:
+                    self.stream = pypm.Output(devno, self.latency)
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        stream = self.stream
+        self.stream = None
+        close = getattr(stream, 'Close', None)
+        if close is not None:
+            close()
+
+    def Read(self, length):
+        with self._lock:
+            if self.stream is None:
+                return []
+            return self.stream.Read(length)
+
+    def Poll(self):
+        with self._lock:
+            return self.stream is not None and self.stream.Poll()
+
+    def Write(self, events):
+        with self._lock:
+            if self.stream is not None:
+                self.stream.Write(events)
+
+    def __getattr__(self, name):
+        if name == 'stream':
+            raise AttributeError(name)
+        return getattr(self.stream, name)
+
 
-__all__ = ['init', 'initialize', 'getInput', 'getOutput', 'printDeviceSummary',
-           'ClockSender', 'MidiDispatcher', 'FUNCTIONS', 'ChordHandler',
-           'MonitorHandler', 'NoteEventHandler']
+# Index of the is input and is output flags in pypm device info
+_infoIndex = {'input': 2, 'output': 3}
 
 
 class PypmWrapper:
     """
     Simple wrapper around pypm calls which caches inputs and outputs.
+
+    Devices plugged in or out after initialization are found by rescan().
+    Inputs and outputs opened by name are then reopened on the new device
+    numbers - or closed until the device comes back - so they keep working
+    across a reconnect.
+
+    If C{cachePath} is set, the name to device number index is saved there
+    and used at the next initialization instead of querying every device,
+    as long as the number of devices is unchanged. Cached entries are
+    checked when a device is opened by name.
     """
 
     initialized = False
@@ -19,7 +133,9 @@ class PypmWrapper:
     deviceMap = {}
     inputNames = {}
     outputNames = {}
+    cachePath = None
     _channels = {}
+    _listeners = []
 
     @classmethod
     def initialize(cls):
@@ -29,61 +145,177 @@ class PypmWrapper:
         if cls.initialized:
             return
         pypm.Initialize()
-        cls._gatherDeviceInfo()
+        if not cls._loadCache():
+            cls._gatherDeviceInfo()
+            cls._saveCache()
         cls.initialized = True
 
+    @classmethod
+    def rescan(cls, force=False):
+        """
+        Find devices added or removed since the last scan, reopening or
+        closing handles returned by getInput() and getOutput() to match.
+        Listeners (see addListener) are called with the lists of
+        C{(kind, name)} pairs added and removed, which are also returned.
+
+        PortMidi only enumerates devices when it is initialized, so unless
+        the backend sets C{HOTPLUG} (as L{bl.virtualmidi} does) this
+        terminates and reinitializes it, and every open handle is reopened.
+        Streams opened directly with pypm are lost, as is everything queued
+        on the handles: input not yet read and output waiting for its
+        timestamp, such as the pulses of a L{ClockSender}. Rescanning is
+        therefore never done automatically, and raises C{RuntimeError}
+        while a ClockSender is running unless C{force} is True.
+        """
+        cls.initialize()
+        reinitialize = not getattr(pypm, 'HOTPLUG', False)
+        if reinitialize and _runningClockSenders and not force:
+            raise RuntimeError('Rescanning would drop the pulses queued by '
+                               'running ClockSenders')
+        before = cls._deviceNames()
+        handles = cls._channels.values()
+        if reinitialize:
+            for handle in handles:
+                handle.close()
+            pypm.Terminate()
+            pypm.Initialize()
+        cls._gatherDeviceInfo()
+        cls._saveCache()
+        for handle in handles:
+            devno = handle.devno
+            if handle.name is not None:
+                devno = cls.deviceMap.get(handle.name, {}).get(handle.kind)
+            if reinitialize or devno != handle.devno:
+                handle.reopen(devno)
+        after = cls._deviceNames()
+        added = sorted(after - before)
+        removed = sorted(before - after)
+        for listener in list(cls._listeners):
+            listener(added, removed)
+        return (added, removed)
+
+    @classmethod
+    def addListener(cls, listener):
+        """
+        Call C{listener(added, removed)} after each rescan.
+        """
+        cls._listeners.append(listener)
+
+    @classmethod
+    def removeListener(cls, listener):
+        cls._listeners.remove(listener)
+
+    @classmethod
+    def _deviceNames(cls):
+        return set((kind, name) for (name, m) in cls.deviceMap.items()
+                   for kind in ('input', 'output') if m[kind] is not None)
+
     @classmethod
     def _gatherDeviceInfo(cls):
+        deviceMap = {}
         for devno in range(pypm.CountDevices()):
             info = pypm.GetDeviceInfo(devno)
 
             insouts = {'output': None, 'input': None}
-            m = cls.deviceMap.setdefault(info[1], insouts)
+            m = deviceMap.setdefault(info[1], insouts)
             if info[3]:
-                cls.outputs.append(devno)
                 m['output'] = devno
             if info[2]:
-                cls.inputs.append(devno)
                 m['input'] = devno
+        cls._setDeviceMap(deviceMap)
 
+    @classmethod
+    def _setDeviceMap(cls, deviceMap):
+        cls.deviceMap = deviceMap
         cls.inputNames = dict(
-                (v['input'], k) for (k, v) in cls.deviceMap.items()
+                (v['input'], k) for (k, v) in deviceMap.items()
                 if v['input'] is not None
         )
         cls.outputNames = dict(
-                (v['output'], k) for (k, v) in cls.deviceMap.items()
+                (v['output'], k) for (k, v) in deviceMap.items()
                 if v['output'] is not None
         )
+        cls.inputs = sorted(cls.inputNames)
+        cls.outputs = sorted(cls.outputNames)
+
+    @classmethod
+    def _loadCache(cls):
+        if cls.cachePath is None or not os.path.exists(cls.cachePath):
+            return False
+        try:
+            with open(cls.cachePath) as f:
+                cache = json.load(f)
+            count = cache['count']
+            deviceMap = dict((str(name), m)
+                             for (name, m) in cache['devices'].items())
+        except (IOError, ValueError, KeyError, AttributeError):
+            debug('Ignoring bad midi device cache: %s' % cls.cachePath)
+            return False
+        if count != pypm.CountDevices():
+            return False
+        cls._setDeviceMap(deviceMap)
+        return True
+
+    @classmethod
+    def _saveCache(cls):
+        if cls.cachePath is None:
+            return
+        cache = {'count': pypm.CountDevices(), 'devices': cls.deviceMap}
+        try:
+            with open(cls.cachePath, 'w') as f:
+                json.dump(cache, f)
+        except IOError:
+            debug('Could not write midi device cache: %s' % cls.cachePath)
+
+    @classmethod
+    def _lookup(cls, dev, kind):
+        # Return (devno, name) for a device number or name, checking
+        # entries which may have come from the cache against the device.
+        if not isinstance(dev, basestring):
+            names = cls.inputNames if kind == 'input' else cls.outputNames
+            return (dev, names.get(dev))
+        no = cls.deviceMap[dev][kind]
+        info = pypm.GetDeviceInfo(no) if no is not None else None
+        if info is None or info[1] != dev or not info[_infoIndex[kind]]:
+            cls._gatherDeviceInfo()
+            cls._saveCache()
+            no = cls.deviceMap[dev][kind]
+        return (no, dev)
+
+    @classmethod
+    def _open(cls, dev, kind, latency=0):
+        (no, name) = cls._lookup(dev, kind)
+        key = (kind, name if name is not None else no)
+        if key not in cls._channels:
+            cls._channels[key] = DeviceHandle(kind, no, name, latency)
+        handle = cls._channels[key]
+        if handle.latency != latency:
+            raise ValueError('%s %r is already open with latency %s' % (
+                kind, dev, handle.latency))
+        return handle
 
     @classmethod
     def getInput(cls, dev):
         """
         Get an input with devive number 'dev' - dev may also be string matching
         the target device. If the input was previously loaded this will return
-        the cached device.
+        the cached device (a L{DeviceHandle}).
         """
-        no = dev
-        if isinstance(dev, basestring):
-            no = cls.deviceMap[dev]['input']
-        key = ('input', no)
-        if key not in cls._channels:
-            cls._channels[key] = pypm.Input(no)
-        return cls._channels[key]
+        return cls._open(dev, 'input')
 
     @classmethod
-    def getOutput(cls, dev):
+    def getOutput(cls, dev, latency=0):
         """
         Get output with devive number 'dev' - dev may also be string matching
         the target device. If the output was previously loaded this will return
-        the cached device.
+        the cached device (a L{DeviceHandle}).
+
+        The output is opened with a latency of C{latency} milliseconds, which
+        must be non-zero for PortMidi to honour the timestamps of events (as
+        a L{ClockSender} needs). An output can only be opened with one
+        latency.
         """
-        no = dev
-        if isinstance(dev, basestring):
-            no = cls.deviceMap[dev]['output']
-        key = ('output', no)
-        if key not in cls._channels:
-            cls._channels[key] = pypm.Output(no)
-        return cls._channels[key]
+        return cls._open(dev, 'output', latency)
 
     @classmethod
     def printDeviceSummary(cls, printer=None):
@@ -102,6 +334,7 @@ class PypmWrapper:
 
 
 initialize = init = PypmWrapper.initialize
+rescan = PypmWrapper.rescan
 getInput = PypmWrapper.getInput
 getOutput = PypmWrapper.getOutput
 printDeviceSummary = PypmWrapper.printDeviceSummary
@@ -122,8 +355,8 @@ for i in range(16):
     _add_global('NOTEON_CHAN%d' % no, 2, 0x90 + i)
     _add_global('POLYAFTERTOUCH_CHAN%d' % no, 2, 0xA0 + i)
     _add_global('CONTROLCHANGE_CHAN%d' % no, 2, 0xB0 + i)
-    _add_global('PROGRAMCHANGE_CHAN%d' % no, 2, 0xC0 + i)
-    _add_global('CHANAFTERTOUCH_CHAN%d' % no, 2, 0xD0 + i)
+    _add_global('PROGRAMCHANGE_CHAN%d' % no, 1, 0xC0 + i)
+    _add_global('CHANAFTERTOUCH_CHAN%d' % no, 1, 0xD0 + i)
     _add_global('PITCHWHEEL_CHAN%d' % no, 2, 0xE0 + i)
 
 _add_global('SYSTEMEXCL', 2, 0xf0)
@@ -146,9 +379,62 @@ del _add_global
 
 # pyflakes
 START = globals()['START']
+STOP = globals()['STOP']
+CONTINUE = globals()['CONTINUE']
+SONGPOSPOINTER = globals()['SONGPOSPOINTER']
 TIMINGCLOCK = globals()['TIMINGCLOCK']
 
 
+def interestStatuses(interests):
+    """
+    Return the set of status bytes matching C{interests}, an iterable of
+    C{(type, channel)} pairs. The type is the lower-cased name of a channel
+    message type without its channel (C{'noteon'}, C{'controlchange'}, ...)
+    or of a system message (C{'timingclock'}, C{'start'}, ...). A channel of
+    None matches all channels; it is ignored for system messages.
+    """
+    statuses = set()
+    for (type, channel) in interests:
+        for (func, funcname) in FUNCTIONS.iteritems():
+            tokens = funcname.split('_')
+            if len(tokens) == 2 and tokens[1].startswith('CHAN'):
+                if tokens[0].lower() != type:
+                    continue
+                if channel is not None and int(tokens[1][4:]) != channel:
+                    continue
+            elif funcname.lower() != type:
+                continue
+            statuses.add(func)
+    return statuses
+
+
+_allStatuses = tuple(range(256))
+
+
+def handlerStatuses(handler):
+    """
+    Return the status bytes a handler should receive: those named by its
+    C{statuses()} method, or all of them for handlers without one (such as
+    plain functions).
+    """
+    statuses = getattr(handler, 'statuses', None)
+    if statuses is None:
+        return _allStatuses
+    return statuses()
+
+
+def buildRoutes(handlers):
+    """
+    Return a routing table for C{handlers}: a list, indexed by status
+    byte, of tuples of the handlers for each status.
+    """
+    routes = [[] for i in range(256)]
+    for handler in handlers:
+        for status in handlerStatuses(handler):
+            routes[status].append(handler)
+    return [tuple(route) for route in routes]
+
+
 class MidiDispatcher(object):
     """
     Dispatcher for events received from a midi input channel.
@@ -161,12 +447,31 @@ class MidiDispatcher(object):
             print event
         disp = MidiDispatcher(input, [debug_event, NoteOnOffHandler(instr)])
         disp.start()
+
+    Messages are routed by status byte: each handler only receives the
+    messages it is interested in (see L{handlerStatuses}). The routing table
+    is rebuilt when C{handlers} or the interests of a L{MidiHandler} change.
     """
 
     def __init__(self, midiInput, handlers, clock=None):
         self.clock = getClock(clock)
         self.midiInput = midiInput
         self.handlers = handlers
+        self._routes = None
+        self._routed = None
+        self._interestsChanged = None
+
+    def routes(self):
+        """
+        Return the routing table: a list of the handlers for each status
+        byte.
+        """
+        if (self._routes is None or self._routed != self.handlers or
+                self._interestsChanged != MidiHandler.interestsChanged):
+            self._interestsChanged = MidiHandler.interestsChanged
+            self._routes = buildRoutes(self.handlers)
+            self._routed = list(self.handlers)
+        return self._routes
 
     def start(self):
         """
@@ -184,12 +489,215 @@ class MidiDispatcher(object):
         Call all our handlers with buffered events (max of 32 per call
         are processed).
         """
+        routes = self.routes()
         for message in self.midiInput.Read(32):
-            for call in self.handlers:
+            for call in routes[message[0][0]]:
+                call(message)
+
+
+class TickStamper(object):
+    """
+    Convert pypm timestamps (milliseconds on the PortMidi clock) to
+    C{(tick, subtick)} pairs on a clock: the tick at or before the event
+    and the fraction of a tick after it.
+
+    The reference point is taken by anchor(), which should be called on the
+    reactor thread (generally once per tick); stamp() may be called from any
+    thread.
+    """
+
+    def __init__(self, clock=None):
+        self.clock = getClock(clock)
+        self.anchor()
+
+    def anchor(self):
+        clock = self.clock
+        # Assigned as one tuple so other threads never see a partial update
+        self._anchor = (pypm.Time(), clock.ticks, clock.tempo.tpm / 60000.)
+
+    def stamp(self, timestamp):
+        (ms, ticks, rate) = self._anchor
+        t = ticks + (timestamp - ms) * rate
+        tick = int(math.floor(t))
+        return (tick, t - tick)
+
+
+class MidiReader(threading.Thread):
+    """
+    A daemon thread which drains a midi input into C{queue} (a
+    C{collections.deque}) as C{[packet, timestamp, (tick, subtick)]}
+    messages, stamped by a L{TickStamper}. The input is polled every
+    C{interval} seconds while idle.
+
+    If C{thru} is a routing table (see L{buildRoutes}) each message is also
+    passed to its thru handlers on this thread as soon as it is read, before
+    it is queued.
+    """
+
+    bufferSize = 1024
+
+    def __init__(self, midiInput, queue, stamper, interval=0.001, thru=None):
+        threading.Thread.__init__(self, name='MidiReader')
+        self.daemon = True
+        self.midiInput = midiInput
+        self.queue = queue
+        self.stamper = stamper
+        self.interval = interval
+        self.thru = thru
+        self._stopped = threading.Event()
+
+    def read(self):
+        """
+        Read all messages waiting on the input, returning the number read.
+        """
+        append = self.queue.append
+        stamp = self.stamper.stamp
+        thru = self.thru
+        count = 0
+        while 1:
+            messages = self.midiInput.Read(self.bufferSize)
+            if not messages:
+                return count
+            for (packet, timestamp) in messages:
+                message = [packet, timestamp, stamp(timestamp)]
+                if thru is not None:
+                    for call in thru[packet[0]]:
+                        call(message)
+                append(message)
+            count += len(messages)
+
+    def run(self):
+        while not self._stopped.isSet():
+            if not self.read():
+                time.sleep(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+
+
+class ThreadedMidiDispatcher(MidiDispatcher):
+    """
+    A MidiDispatcher which reads its input on a L{MidiReader} thread, so
+    bursts are never held back and each message keeps the time it arrived.
+    Every tick, all messages queued so far are delivered to the handlers as
+    C{[packet, timestamp, (tick, subtick)]}.
+
+    Handlers in C{thru} are called on the reader thread as soon as each
+    message arrives, for monitoring with no added latency - like a hardware
+    MIDI thru - while the handlers still get the tick-stamped copy on the
+    next tick (to record it, say). Thru handlers must be safe to call from
+    another thread, which most handlers and instruments are not: a
+    L{ChordHandler}, a L{bl.instrument.voices.VoiceManager} or anything
+    scheduling on the clock must not be used thru. A L{MonitorHandler}
+    playing fluidsynth instruments is safe, as is one playing
+    L{MidiOutInstrument}s, which write events sent from the reader thread
+    immediately rather than buffering them for the tick (use outputs from
+    L{getOutput}, which lock around writes, if other code writes to them).
+    Instruments played thru should not have recorders, which would run on
+    the reader thread; record from the handlers instead.
+
+    While idle the reader polls the input every C{interval} seconds. The
+    default of a millisecond keeps the added latency low at the cost of a
+    thousand wakeups a second; a longer interval trades latency for CPU.
+
+    Example usage:
+
+        disp = ThreadedMidiDispatcher(getInput(3), [ChordHandler(callback)],
+                                      thru=[MonitorHandler({1: piano})])
+        disp.start()
+        ...
+        disp.stop()
+    """
+
+    def __init__(self, midiInput, handlers, clock=None, interval=0.001,
+                 thru=None):
+        MidiDispatcher.__init__(self, midiInput, handlers, clock)
+        if thru is None:
+            thru = []
+        self.interval = interval
+        self.thru = thru
+        self.queue = deque()
+        self.stamper = TickStamper(self.clock)
+        self.reader = MidiReader(midiInput, self.queue, self.stamper,
+                                 interval)
+        self._event = None
+
+    def start(self):
+        """
+        Start the reader thread and deliver queued messages from the next
+        tick. Changes to C{thru} take effect when the dispatcher is started.
+        """
+        self.stamper.anchor()
+        if self.thru:
+            self.reader.thru = buildRoutes(self.thru)
+        self.reader.start()
+        self._event = self.clock.schedule(self).startAfterTicks(1, 1)
+
+    def stop(self, timeout=1):
+        """
+        Stop delivering messages and stop the reader thread, waiting up to
+        C{timeout} seconds for it to finish. The dispatcher may be started
+        again.
+        """
+        if self._event is not None:
+            self._event.stop()
+            self._event = None
+        reader = self.reader
+        reader.stop()
+        if reader.isAlive() and reader is not threading.currentThread():
+            reader.join(timeout)
+            if reader.isAlive():
+                log.msg('MidiReader did not stop within %s seconds' % timeout)
+        self.reader = MidiReader(self.midiInput, self.queue, self.stamper,
+                                 self.interval)
+
+    def __call__(self):
+        """
+        Call all our handlers with every message queued by the reader.
+        """
+        self.stamper.anchor()
+        queue = self.queue
+        routes = self.routes()
+        for i in xrange(len(queue)):
+            message = queue.popleft()
+            for call in routes[message[0][0]]:
                 call(message)
 
 
 class MidiHandler(object):
+    """
+    Base class for handlers which dispatch midi messages to methods named
+    after their function - see __call__.
+
+    The dispatch table, mapping each status byte to a method, its channel
+    and its arity, is built on the first message.
+
+    Set C{interests} to a list of C{(type, channel)} pairs (see
+    L{interestStatuses}) to only handle those messages - for example
+    C{[('noteon', 1), ('noteoff', 1)]}. By default every channel message with
+    a method is handled. System messages are only handled if named in
+    C{interests}, by a method of the same name (C{timingclock}, C{start},
+    ...) called with the message's data bytes and the timestamp.
+    """
+
+    # Incremented whenever the interests of a handler are set, so that
+    # dispatchers know to rebuild their routes
+    interestsChanged = 0
+    _interests = None
+    _statusTable = None
+
+    def _setInterests(self, interests):
+        for (type, channel) in interests or ():
+            if type not in _channelTypes and type not in _systemTypes:
+                raise ValueError('Unknown MIDI message type: %r' % (type,))
+            if type in _systemTypes and getattr(self, type, None) is None:
+                raise ValueError('%r has no method for %s messages' % (
+                    self, type))
+        self._interests = interests
+        self._statusTable = None
+        MidiHandler.interestsChanged += 1
+
+    interests = property(lambda self: self._interests, _setInterests)
 
     def __call__(self, message):
         """
@@ -199,21 +707,57 @@ class MidiHandler(object):
         this will be the first argument.  After the first optional channel
         argument, remaining positional arguments are passed to the method in
         the same order as specified in MIDI.  Not all MIDI functions need to be
-        supplied or implemented in subclass.
-        """
-        packet, timestamp = message
-        func, arg1, arg2, _pad = packet
-        args = [arg1, arg2][:FUNCTION_ARITY.get(func, 0)]
-        args.append(timestamp)
-        funcname = FUNCTIONS[func]
-        tokens = funcname.split('_')
-        if len(tokens) == 2:
+        supplied or implemented in subclass; messages without a method (and
+        system messages not named in C{interests}) are ignored.
+        """
+        packet = message[0]
+        table = self._statusTable
+        if table is None:
+            table = self._buildStatusTable()
+        (method, channel, arity) = table[packet[0]]
+        if arity == 2:
+            method(channel, packet[1], packet[2], message[1])
+        elif arity == 1:
+            method(channel, packet[1], message[1])
+        elif method is not None:
+            # A system message: its data bytes, if any, and the timestamp
+            size = _systemDataSizes.get(packet[0], 0)
+            method(*(list(packet[1:1 + size]) + [message[1]]))
+
+    def statuses(self):
+        """
+        Return the status bytes this handler has a method for (the no-op
+        noteon and noteoff of this base class don't count).
+        """
+        table = self._statusTable
+        if table is None:
+            table = self._buildStatusTable()
+        return [status for status in range(256) if table[status][0]]
+
+    def _buildStatusTable(self):
+        table = [(None, None, 0)] * 256
+        interests = None
+        if self.interests is not None:
+            interests = interestStatuses(self.interests)
+        for (func, funcname) in FUNCTIONS.iteritems():
+            if interests is not None and func not in interests:
+                continue
+            tokens = funcname.split('_')
+            if len(tokens) != 2 or not tokens[1].startswith('CHAN'):
+                if interests is not None:
+                    table[func] = (getattr(self, funcname.lower()), None, 0)
+                continue
             type, channel = tokens
-            channel = int(channel[4:])
             method = getattr(self, type.lower(), None)
             if method is None:
                 debug('No handler defined for midi event of type: %s' % type)
-            method(channel, *args)
+                continue
+            if getattr(method, 'im_func', None) in _noops:
+                # Not overridden: nothing to dispatch
+                continue
+            table[func] = (method, int(channel[4:]), FUNCTION_ARITY[func])
+        self._statusTable = table
+        return table
 
     def noteon(self, channel, note, velocity, timestamp):
         pass
@@ -222,6 +766,17 @@ class MidiHandler(object):
         pass
 
 
+_noops = (MidiHandler.noteon.im_func, MidiHandler.noteoff.im_func)
+
+# Names of channel and system message types, as in interests
+_channelTypes = set(name.split('_')[0].lower()
+                    for name in FUNCTIONS.itervalues() if '_CHAN' in name)
+_systemTypes = set(name.lower()
+                   for name in FUNCTIONS.itervalues() if '_CHAN' not in name)
+# Data bytes of system messages which have any
+_systemDataSizes = {0xF1: 1, 0xF2: 2, 0xF3: 1}
+
+
 class _DummyInstrument:
 
     @classmethod
@@ -265,24 +820,32 @@ class ChordHandler(MidiHandler):
     A chord handler is a simple MidiHandler which recognizes chords and sends
     to its callback.
 
-    todo: Currently this implementation doesn't care about channels; but this
-    behavior should likely change in the near future.
+    Notes are taken from channel C{channel}, or from all channels if
+    C{channel} is None. Setting C{channel} updates the handler's interests.
     """
 
-    def __init__(self, callback, sustain=False):
+    def __init__(self, callback, sustain=False, channel=None):
         """
         callback: handler to receive chords
         sustain: if True, only call our callback with noteon events
+        channel: the channel (1-16) to take notes from, or None for all
         """
         self.callback = callback
         self.sustain = sustain
+        self.channel = channel
         self._chord = []
 
+    def _setChannel(self, channel):
+        self._channel = channel
+        self.interests = [('noteon', channel), ('noteoff', channel)]
+
+    channel = property(lambda self: self._channel, _setChannel)
+
     def noteon(self, channel, note, velocity, timestamp):
         """
         Add note to chord and call our callback with updated chord.
 
-        Note that channel, velocity and timestamp arguments are ignored.
+        Note that velocity and timestamp arguments are ignored.
         """
         debug('noteon channel=%s note=%s velocity=%s t=%s' % (
                         channel, note, velocity, timestamp))
@@ -297,7 +860,7 @@ class ChordHandler(MidiHandler):
         If the attribute `sustain` is `True` then we do not
         call callback with the updated chord.
 
-        Note that channel, velocity and timestamp arguments are ignored.
+        Note that velocity and timestamp arguments are ignored.
         """
         debug('noteoff channel=%s note=%s velocity=%s t=%s' % (
                         channel, note, velocity, timestamp))
@@ -336,34 +899,291 @@ class NoteEventHandler(MidiHandler):
         self.noteoffCallback(note)
 
 
+# ClockSenders sending pulses, which a rescan would drop
+_runningClockSenders = set()
+
+
 class ClockSender(object):
     """
-    A simple midi beat clock sender which can be used to synchronize external
-    MIDI devices.
+    A midi beat clock sender which can be used to synchronize external MIDI
+    devices.
+
+    Clock pulses (24 per quarter note) are not sent as they happen. Instead,
+    at the start of each measure, the pulses of the measure C{lookahead}
+    measures ahead are written in one batch. Their timestamps are computed
+    from the tempo and counted from a fixed anchor, so reactor jitter does
+    not reach the receiving devices and timestamps do not drift. The output
+    must be opened with a latency (see L{getOutput}) for PortMidi to honour
+    the timestamps. On an output opened with zero latency, pulses are
+    instead written on each tick as they fall due, with the reactor's
+    jitter. Starting or resuming again while pulses are still queued follows
+    on from them (after a STOP, if one has not been sent).
+
+    The attribute C{pulses} is the song position in pulses sent so far.
     """
 
-    def __init__(self, midiOut, clock=None):
+    def __init__(self, midiOut, clock=None, lookahead=1):
         self.clock = getClock(clock)
         self.midiOut = midiOut
-        self._started = False
+        self.lookahead = lookahead
+        self.pulses = 0
+        self.running = False
+        self._stopping = False
+        self._call = None
+        self._beginCall = None
+        self._bpm = None
+        self._anchorTime = 0
+        self._anchorPulse = 0
+        # Timestamp following the last pulse (or STOP) written
+        self._sentUntil = 0
 
     def start(self):
         """
-        Start the ClockSender - on the next measure begin sending MIDI beat
-        clock events.  The first run will send a START and TIMINGCLOCK event.
-        Subsequent calls (24 per quarter note), will send bare TIMINGCLOCK
-        events.
+        Start the ClockSender - on the next measure send a START event and
+        begin sending MIDI beat clock events from the start of the song.
+        """
+        self._begin([[START]], 0)
+
+    def resume(self):
+        """
+        On the next measure, send a SONGPOSPOINTER event with the song
+        position at which we stopped and a CONTINUE event, and begin sending
+        MIDI beat clock events again. If the STOP event of a stop() has not
+        been sent yet, just keep on sending pulses.
+
+        The song position pointer is 14 bits, so positions after 16383
+        sixteenth notes are sent as 16383.
+        """
+        if self._stopping and self._call is not None:
+            self._stopping = False
+            return
+        sixteenths = min(self.pulses // 6, 0x3FFF)
+        self._begin([[SONGPOSPOINTER, sixteenths & 0x7F, sixteenths >> 7],
+                     [CONTINUE]])
+
+    def stop(self):
+        """
+        Send a STOP event at the end of the pulses already sent (that is,
+        at the end of the current measure or the one after, depending on
+        C{lookahead} - or on the next tick when pulses are written on each
+        tick).
         """
+        self._stopping = True
+
+    @property
+    def timestamped(self):
+        """
+        Whether pulses are written ahead with timestamps: False if the output
+        is known to have been opened with zero latency.
+        """
+        return getattr(self.midiOut, 'latency', None) != 0
+
+    def _begin(self, messages, pulses=None):
         nm = self.clock.meter.nm
-        n = self.clock.meter.dtt
-        self._event = self.clock.schedule(self).startAfterTicks(
+        if self._beginCall is not None and self._beginCall.active():
+            self._beginCall.cancel()
+        self._beginCall = self.clock.callLater(
             nm(self.clock.ticks, 1) - self.clock.ticks,
-            n(1, 96))
+            self._run, messages, pulses)
 
-    def __call__(self):
-        # START and TIMINGCLOCK are added to globals during module
-        # initialization - see a() defined and deleted above.
-        if not self._started:
-            self.midiOut.Write([[[START], pypm.Time()]])
-            self._started = True
-        self.midiOut.Write([[[TIMINGCLOCK], pypm.Time()]])
+    def _run(self, messages, pulses):
+        self._beginCall = None
+        now = pypm.Time()
+        # Follow on from pulses (or a STOP) already written, which can still
+        # be queued if we were stopped or restarted within the lookahead.
+        anchor = max(now, self._sentUntil)
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+            # The STOP of a stop() hasn't been sent
+            messages = [[STOP]] + messages
+        self._call = None
+        self._stopping = False
+        if pulses is not None:
+            self.pulses = pulses
+        self.running = True
+        _runningClockSenders.add(self)
+        if not self.timestamped:
+            self.midiOut.Write([[message, now] for message in messages])
+            self._startTick = self.clock.ticks
+            self._startPulse = self.pulses
+            self._tick()
+            return
+        self._bpm = None
+        self._anchorTime = anchor
+        self._anchorPulse = self.pulses
+        events = [[message, anchor] for message in messages]
+        measures = self.lookahead + 1
+        for i in range(measures):
+            events.extend(self._measure())
+            if self._sentUntil - now >= measures * self._msPerMeasure():
+                break
+        self.midiOut.Write(events)
+        self._call = self.clock.callLater(self.clock.meter.ticksPerMeasure,
+                                          self._advance)
+
+    def _advance(self):
+        self._call = None
+        if self._stopping:
+            self._stopping = False
+            self.running = False
+            _runningClockSenders.discard(self)
+            self.midiOut.Write([[[STOP], self._sentUntil]])
+            return
+        self.midiOut.Write(self._measure())
+        self._call = self.clock.callLater(self.clock.meter.ticksPerMeasure,
+                                          self._advance)
+
+    def _tick(self):
+        # Write the pulses due by this tick, for outputs which don't honour
+        # timestamps
+        self._call = None
+        now = pypm.Time()
+        self._sentUntil = now
+        if self._stopping:
+            self._stopping = False
+            self.running = False
+            _runningClockSenders.discard(self)
+            self.midiOut.Write([[[STOP], now]])
+            return
+        due = (self._startPulse + 1 + (self.clock.ticks - self._startTick) *
+               24 // self.clock.tempo.tpb)
+        if due > self.pulses:
+            self.midiOut.Write([[[TIMINGCLOCK], now]
+                                for i in range(self.pulses, due)])
+            self.pulses = due
+        self._call = self.clock.callLater(1, self._tick)
+
+    def _time(self, pulse):
+        return int(round(self._anchorTime +
+                         (pulse - self._anchorPulse) * self._msPerPulse))
+
+    def _pulsesPerMeasure(self):
+        return self.clock.meter.ticksPerMeasure * 24 // self.clock.tempo.tpb
+
+    def _msPerMeasure(self):
+        return self._pulsesPerMeasure() * self._msPerPulse
+
+    def _measure(self):
+        # Clock events for the next measure's worth of pulses
+        bpm = self.clock.tempo.bpm
+        if bpm != self._bpm:
+            if self._bpm is not None:
+                self._anchorTime = self._time(self.pulses)
+                self._anchorPulse = self.pulses
+            self._bpm = bpm
+            self._msPerPulse = 60000. / (bpm * 24)
+        count = self._pulsesPerMeasure()
+        start = self.pulses
+        self.pulses += count
+        self._sentUntil = self._time(self.pulses)
+        return [[[TIMINGCLOCK], self._time(pulse)]
+                for pulse in range(start, start + count)]
+
+
+class MidiOutInstrument(object):
+    """
+    An instrument sending to a pypm output on MIDI channel C{channel}
+    (1-16).
+
+    Events are buffered and all events of a tick are sent with one C{Write}
+    once the clock has finished processing the tick, timestamped C{latency}
+    milliseconds after the first event of the tick. Note that PortMidi only
+    honours timestamps if the output was opened with a non-zero latency. If
+    C{buffered} is False, each event is written immediately, as are events
+    sent from a L{MidiReader} thread (by thru handlers), which must not
+    touch the buffer or the clock.
+
+    Example:
+
+        init()
+        synth = MidiOutInstrument(getOutput('IAC Bus 1'), channel=2)
+        player = Player(synth, Random(60, 64, 67), R(60, 80, 100),
+                        interval=(1, 16))
+    """
+    implements(IMIDIInstrument)
+
+    # Maximum events in one Write
+    maxWrite = 1024
+
+    def __init__(self, midiOut, channel=1, clock=None, latency=0,
+                 buffered=True):
+        self.midiOut = midiOut
+        self.channel = channel
+        self.clock = getClock(clock)
+        self.latency = latency
+        self.buffered = buffered
+        self._buffer = []
+        self._timestamp = None
+        self._flushCall = None
+
+    def noteon(self, note, velocity=80):
+        if note is None:
+            return
+        self._send(0x90 + self.channel - 1, note, velocity)
+
+    playnote = noteon
+
+    def noteoff(self, note):
+        if note is None:
+            return
+        self._send(0x80 + self.channel - 1, note, 0)
+
+    stopnote = noteoff
+
+    def chordon(self, notes, velocity=80):
+        for note in notes:
+            self.noteon(note, velocity)
+
+    playchord = chordon
+
+    def chordoff(self, notes):
+        for note in notes:
+            self.noteoff(note)
+
+    stopchord = chordoff
+
+    def controlChange(self, vibrato=None, pan=None, expression=None,
+                      sustain=None, reverb=None, chorus=None, **other):
+        """
+        Send control changes. Besides the controls named in
+        L{IMIDIInstrument}, C{volume} is supported; other controls are
+        ignored.
+        """
+        other.update(vibrato=vibrato, pan=pan, expression=expression,
+                     sustain=sustain, reverb=reverb, chorus=chorus)
+        status = 0xB0 + self.channel - 1
+        for (name, value) in sorted(other.iteritems()):
+            if value is not None and name in CONTROLS:
+                self._send(status, CONTROLS[name], value)
+
+    def pitchBend(self, value):
+        """
+        Send a pitch bend of C{value} in [-8192, 8191], 0 being no bend.
+        """
+        value += 8192
+        self._send(0xE0 + self.channel - 1, value & 0x7F, value >> 7)
+
+    def _send(self, status, data1, data2):
+        if (not self.buffered or
+                isinstance(threading.currentThread(), MidiReader)):
+            self.midiOut.Write([[[status, data1, data2],
+                                 pypm.Time() + self.latency]])
+            return
+        if not self._buffer:
+            self._timestamp = pypm.Time() + self.latency
+            # The underlying reactor runs this after the current tick
+            self._flushCall = self.clock.reactor.callLater(0, self.flush)
+        self._buffer.append([[status, data1, data2], self._timestamp])
+
+    def flush(self):
+        """
+        Write all buffered events. This is called for you after each tick
+        with events.
+        """
+        if self._flushCall is not None and self._flushCall.active():
+            self._flushCall.cancel()
+        self._flushCall = None
+        events = self._buffer
+        self._buffer = []
+        for i in range(0, len(events), self.maxWrite):
+            self.midiOut.Write(events[i:i + self.maxWrite])
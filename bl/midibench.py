@@ -0,0 +1,130 @@
+"""
+Benchmarks for MIDI input dispatch over L{bl.virtualmidi} loopbacks.
+
+Measures the throughput of a L{MidiDispatcher} driving a L{ChordHandler} and
+a L{MonitorHandler}, and the input-to-output latency of monitoring: the time
+from writing a note to an input loopback until the MonitorHandler's
+instrument has written it to an output loopback and it can be read back -
+both dispatched on the tick and as a thru handler of a L{MidiReader}.
+
+Run with:
+
+    python -m bl.midibench -n 100000
+
+Without PortMidi installed, set C{BL_MIDI_BACKEND=virtual} so bl.midi can be
+imported.
+"""
+import optparse
+import time
+from collections import deque
+
+from bl import virtualmidi
+from bl.midi import (MidiDispatcher, ChordHandler, MonitorHandler,
+                     MidiOutInstrument, MidiReader, TickStamper, buildRoutes)
+
+
+__all__ = ['notes', 'benchmarkDispatch', 'benchmarkLatency', 'main']
+
+
+def notes(count, channel=1):
+    """
+    Return C{count} alternating noteon and noteoff events on C{channel}
+    over a rising and falling run of notes.
+    """
+    events = []
+    for i in xrange(count // 2):
+        note = 36 + i % 48
+        events.append([[0x90 + channel - 1, note, 100], 0])
+        events.append([[0x80 + channel - 1, note, 0], 0])
+    return events
+
+
+def _loopback(name):
+    virtualmidi.Initialize()
+    if name not in virtualmidi._ports:
+        virtualmidi.addLoopback(name)
+    for devno in range(virtualmidi.CountDevices()):
+        info = virtualmidi.GetDeviceInfo(devno)
+        if info[1] == name and info[2]:
+            inputNo = devno
+        if info[1] == name and info[3]:
+            outputNo = devno
+    return (virtualmidi.Input(inputNo), virtualmidi.Output(outputNo))
+
+
+def _monitor(midiOut):
+    instr = MidiOutInstrument(midiOut, buffered=False)
+    return MonitorHandler({1: instr})
+
+
+def benchmarkDispatch(handler, count=10000):
+    """
+    Write C{count} events to a loopback and time a L{MidiDispatcher}
+    delivering them to C{handler}. Returns events per second.
+    """
+    (midiIn, midiOut) = _loopback('bench input')
+    dispatcher = MidiDispatcher(midiIn, [handler])
+    midiOut.Write(notes(count))
+    start = time.time()
+    while midiIn.Poll():
+        dispatcher()
+    return count / (time.time() - start)
+
+
+def benchmarkLatency(count=1000, thru=False):
+    """
+    Time C{count} round trips of a note through a L{MidiDispatcher} and
+    L{MonitorHandler}: input loopback, dispatch, output loopback. If
+    C{thru} is True the MonitorHandler is instead called by a
+    L{MidiReader} as a thru handler. Returns the mean and maximum latency
+    in microseconds. This does not include the wait for the next tick of
+    a dispatcher.
+    """
+    (midiIn, inputOut) = _loopback('bench input')
+    (outputIn, midiOut) = _loopback('bench output')
+    if thru:
+        reader = MidiReader(midiIn, deque(), TickStamper(),
+                            thru=buildRoutes([_monitor(midiOut)]))
+        dispatcher = reader.read
+    else:
+        dispatcher = MidiDispatcher(midiIn, [_monitor(midiOut)])
+    while outputIn.Read(1024):
+        pass
+    events = notes(count)
+    latencies = []
+    for event in events:
+        start = time.time()
+        inputOut.Write([event])
+        dispatcher()
+        while not outputIn.Read(1):
+            pass
+        latencies.append((time.time() - start) * 1000000)
+    return (sum(latencies) / len(latencies), max(latencies))
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--count', dest='count', default=100000,
+                      type='int', help='Events per throughput run')
+    parser.add_option('-l', '--latency-count', dest='latencyCount',
+                      default=10000, type='int',
+                      help='Round trips per latency run')
+    opts, args = parser.parse_args()
+
+    print 'Dispatch throughput (%d events)' % opts.count
+    rate = benchmarkDispatch(lambda message: None, opts.count)
+    print '... MidiDispatcher: %.0f events/s' % rate
+    rate = benchmarkDispatch(ChordHandler(lambda chord: None), opts.count)
+    print '... ChordHandler: %.0f events/s' % rate
+    (ignored, midiOut) = _loopback('bench output')
+    rate = benchmarkDispatch(_monitor(midiOut), opts.count)
+    print '... MonitorHandler: %.0f events/s' % rate
+    print 'Monitor latency (%d round trips)' % opts.latencyCount
+    (mean, worst) = benchmarkLatency(opts.latencyCount)
+    print '... MidiDispatcher: mean %.1f us, max %.1f us' % (mean, worst)
+    (mean, worst) = benchmarkLatency(opts.latencyCount, thru=True)
+    print '... thru: mean %.1f us, max %.1f us' % (mean, worst)
+
+
+if __name__ == '__main__':
+    main()
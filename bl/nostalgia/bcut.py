@@ -15,38 +15,40 @@ def explode(notes, factor=2):
     return notes2
 
 
-def cut(notes, aprob=0.25, bprob=0.25):
+def cut(notes, aprob=0.25, bprob=0.25, rng=None):
+    if rng is None:
+        rng = random
     size = len(notes)
     m = size / 2
-    if random.random() <= bprob:
-        if random.random() <= 0.5:  # half chop
-            slice = _cut(notes[m:])
+    if rng.random() <= bprob:
+        if rng.random() <= 0.5:  # half chop
+            slice = _cut(notes[m:], rng)
             notes = notes[:m] + slice
         else:  # quarter chop
             s = m + m / 2
-            if random.random() <= bprob:
-                slice = _cut(notes[s:])
+            if rng.random() <= bprob:
+                slice = _cut(notes[s:], rng)
                 notes = notes[:s] + slice
             else:
-                slice = _cut(notes[m:s])
+                slice = _cut(notes[m:s], rng)
                 notes = notes[:m] + slice + notes[s:]
 
-    if random.random() <= aprob:
-        if random.random() <= 0.5:
-            slice = _cut(notes[:m])
+    if rng.random() <= aprob:
+        if rng.random() <= 0.5:
+            slice = _cut(notes[:m], rng)
             notes = slice + notes[m:]
         else:
             s = m / 2
-            if random.random() <= bprob:
-                slice = _cut(notes[:s])
+            if rng.random() <= bprob:
+                slice = _cut(notes[:s], rng)
                 notes = slice + notes[s:]
             else:
-                slice = _cut(notes[s:m])
+                slice = _cut(notes[s:m], rng)
                 notes = notes[:s] + slice + notes[m:]
     return notes
 
 
-def _cut(notes):
+def _cut(notes, rng):
     size = len(notes)
     if notes[0] == N:
         for (first, note) in enumerate(notes):
@@ -56,10 +58,10 @@ def _cut(notes):
         notes = (notes[:first + 1] * repeat)[:size]
         notes.extend([N] * (size - len(notes)))
         return notes
-    if size >= 8 and random.random() <= 0.10:
+    if size >= 8 and rng.random() <= 0.10:
         rv = notes[:4] * (size / 4)
         return rv
-    if size >= 4 and random.random() <= 0.75:
+    if size >= 4 and rng.random() <= 0.75:
         rv = notes[:2] * (size / 2)
         return rv
     rv = [notes[0]] * size
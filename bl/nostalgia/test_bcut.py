@@ -1,3 +1,5 @@
+import random
+
 from twisted.trial.unittest import TestCase
 
 from bl.ugen import N
@@ -27,3 +29,10 @@ class BcutTestCase(TestCase):
         for i in range(512):
             chopped = cut(s)
             self.assertEquals(len(chopped), 32)
+
+    def test_cut_rng(self):
+        s = explode([1, N, 2, N, N, 3, 4, N], 4)
+        a = random.Random(1234)
+        b = random.Random(1234)
+        for i in range(64):
+            self.assertEquals(cut(s, rng=a), cut(s, rng=b))
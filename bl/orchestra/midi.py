@@ -1,7 +1,7 @@
 from itertools import cycle
 
 from bl.utils import getClock
-from bl.instrument.interfaces import IMIDIInstrument
+from bl.instrument.interfaces import IMIDIInstrument, IVoiceManager
 from bl.orchestra.base import (SchedulePlayer, schedule, childSchedule,
                                timing, OneSchedulePlayerMixin)
 
@@ -77,6 +77,9 @@ class Player(OneSchedulePlayerMixin):
     def _scheduleNoteoff(self, note, when):
         if when is None:
             return
+        if IVoiceManager.providedBy(self.instr):
+            # The voice manager queues releases itself
+            return self.instr.releaseLater(note, when)
         self.clock.callLater(when, self.noteoff, note)
 
 
@@ -1,17 +1,75 @@
 """
 A Player for pyo Pyo instances
 """
-from bl.utils import getClock
+from __future__ import absolute_import
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from bl.utils import getClock, exhaustCall
 from bl.orchestra.base import (SchedulePlayer, OneSchedulePlayerMixin,
                                timing, schedule)
 
 
+__all__ = ['PyoPlayer', 'BlockPyoPlayer', 'sigTo', 'dataTableReader']
+
+
+# pyo class -> {parameter name: setter method name}
+_setterNames = {}
+
+_missing = object()
+
+
+def _gatherSetterNames(pyo):
+    cls = type(pyo)
+    names = _setterNames.get(cls)
+    if names is None:
+        names = {}
+        for attr in dir(pyo):
+            if attr.startswith('_'):
+                continue
+            setter = 'set%s' % attr.capitalize()
+            if callable(getattr(cls, setter, None)):
+                names[attr] = setter
+        _setterNames[cls] = names
+    return names
+
+
+def sigTo(value, time):
+    """
+    Default ramp factory for PyoPlayer's smoothed mode: a pyo C{SigTo} which
+    starts at C{value} and ramps to new targets over C{time} seconds.
+    """
+    from pyo import SigTo
+    return SigTo(value, time=time, init=value)
+
+
+def dataTableReader(size, duration):
+    """
+    Default table factory for BlockPyoPlayer: a pyo C{DataTable} of C{size}
+    values and a looping, non-interpolating C{TableRead} which plays the table
+    once every C{duration} seconds.
+    """
+    from pyo import DataTable, TableRead
+    table = DataTable(size)
+    reader = TableRead(table, freq=1. / duration, loop=1, interp=1)
+    return table, reader
+
+
 class PyoPlayer(OneSchedulePlayerMixin):
     """
     A pyo player. This is more specifically a Player for PyoObject instances
     whose parameters can be modulated. Just pass parameters as dict to
     constructor - a value in the dict may be a callable ugen.
 
+    Setters are only called when a parameter's value changes. Parameters named
+    in C{smooth} (a C{dict} of parameter names to ramp times in seconds) are
+    instead bound once to a ramp object made by C{rampFactory} (a pyo C{SigTo}
+    by default) and subsequent values are handed to the ramp as targets,
+    letting pyo interpolate between them.
+
     Example:
 
         from pyo import midiToHz, Sine, Server
@@ -28,15 +86,22 @@ class PyoPlayer(OneSchedulePlayerMixin):
         player.resumePlaying()
     """
 
-    def __init__(self, pyo, time=None, interval=(1, 8), clock=None, args=None):
+    def __init__(self, pyo, time=None, interval=(1, 8), clock=None, args=None,
+                 smooth=None, rampFactory=sigTo):
         if args is None:
             args = {}
+        if smooth is None:
+            smooth = {}
         self.pyo = pyo
         self._gatherMethods()
         self.clock = getClock(clock)
         self.time = timing(self.clock, time, interval)
         sched = schedule(self.time, self.modulate, args)
         self.args = args
+        self.smooth = smooth
+        self.rampFactory = rampFactory
+        self._values = {}
+        self._ramps = {}
         self.schedulePlayer = SchedulePlayer(sched, self.clock)
 
     def updateArgs(self, **args):
@@ -44,14 +109,141 @@ class PyoPlayer(OneSchedulePlayerMixin):
         return self
 
     def modulate(self, **args):
+        values = self._values
         for name in args:
             v = args[name]
             if type(v) is tuple:
                 v = list(v)
-            self._methods[name](v)
+            if values.get(name, _missing) == v:
+                continue
+            values[name] = v
+            ramp = self._ramps.get(name)
+            if ramp is not None:
+                ramp.setValue(v)
+            elif name in self.smooth:
+                ramp = self._ramps[name] = self.rampFactory(
+                    v, self.smooth[name])
+                self._methods[name](ramp)
+            else:
+                self._methods[name](v)
 
     def _gatherMethods(self):
         self._methods = {}
-        for attr in dir(self.pyo):
-            setter = getattr(self.pyo, 'set%s' % attr.capitalize())
-            self._methods[attr] = setter
+        for (attr, setter) in _gatherSetterNames(self.pyo).iteritems():
+            self._methods[attr] = getattr(self.pyo, setter)
+
+
+class BlockPyoPlayer(PyoPlayer):
+    """
+    A PyoPlayer which modulates parameters a measure at a time. At the start
+    of each measure the time and args ugens are evaluated for the whole
+    measure into NumPy arrays (one value per tick) which are loaded into one
+    table per parameter. Each parameter is bound once to a reader of its table
+    so the audio engine plays the modulation itself, rather than Python
+    calling a setter for every event. Values must be scalars.
+
+    Tables and readers are made by C{tableFactory(size, duration)} which
+    should return a C{(table, reader)} pair; see L{dataTableReader}.
+
+    Example:
+
+        player = BlockPyoPlayer(sine, interval=(1, 32),
+                                args={'freq': freqArp, 'mul': R(0.1, 0.2)})
+        player.resumePlaying()
+    """
+
+    def __init__(self, pyo, time=None, interval=(1, 8), clock=None, args=None,
+                 tableFactory=dataTableReader):
+        if numpy is None:
+            raise ImportError('BlockPyoPlayer requires numpy')
+        PyoPlayer.__init__(self, pyo, time, interval, clock, args)
+        self.tableFactory = tableFactory
+        self._tables = {}
+        self._bound = set()
+        self._when = None
+        self._position = 0
+        self._event = None
+
+    def resumePlaying(self):
+        """
+        Resume (or start) loading blocks on the next measure.
+        """
+        ticks = self.clock.untilNextMeasure()
+        self._event = self.clock.schedule(self.loadBlock).startAfterTicks(
+            ticks, self.clock.meter.ticksPerMeasure)
+
+    def pausePlaying(self):
+        """
+        Pause on the next measure, holding each parameter at its last value.
+        """
+        self.clock.callAfterMeasures(0, self._pause)
+
+    def _pause(self):
+        if self._event is not None:
+            self._event.stop()
+            self._event = None
+        for name in self._bound:
+            self._tables[name][1].stop()
+            self._methods[name](self._values[name])
+        self._bound.clear()
+
+    def renderBlock(self, size):
+        """
+        Evaluate the time and args ugens for the next C{size} ticks, returning
+        a C{dict} of parameter names to NumPy arrays of C{size} values. A
+        parameter holds its last value until its next event.
+        """
+        start = self._position
+        end = start + size
+        events = []
+        while 1:
+            if self._when is None:
+                self._when = exhaustCall(self.time)
+            if self._when >= end:
+                break
+            events.append((max(self._when, start) - start,
+                           dict((k, exhaustCall(v))
+                                for (k, v) in self.args.iteritems())))
+            self._when = None
+        self._position = end
+        blocks = {}
+        for name in self.args:
+            offsets = []
+            values = []
+            for (offset, args) in events:
+                v = args[name]
+                if type(v) in (list, tuple):
+                    raise ValueError('BlockPyoPlayer cannot modulate %s with '
+                                     'multichannel value %r' % (name, v))
+                offsets.append(offset)
+                values.append(v)
+            last = self._values.get(name, values[0] if values else None)
+            if last is None:
+                continue
+            if not offsets or offsets[0]:
+                offsets.insert(0, 0)
+                values.insert(0, last)
+            offsets.append(size)
+            blocks[name] = numpy.repeat(numpy.array(values, dtype=float),
+                                        numpy.diff(offsets))
+            self._values[name] = values[-1]
+        return blocks
+
+    def loadBlock(self):
+        """
+        Render the coming measure and load it into the parameter tables.
+        This is called at the start of every measure while playing.
+        """
+        size = self.clock.meter.ticksPerMeasure
+        duration = size * 60. / self.clock.tempo.tpm
+        for (name, block) in self.renderBlock(size).iteritems():
+            if name not in self._tables:
+                self._tables[name] = self.tableFactory(size, duration)
+            (table, reader) = self._tables[name]
+            table.replace(block.tolist())
+            if name in self._bound:
+                reader.reset()
+            else:
+                reader.play()
+                self._methods[name](reader)
+                self._bound.add(name)
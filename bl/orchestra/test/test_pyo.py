@@ -1,10 +1,11 @@
 from itertools import cycle
 
-from twisted.trial.unittest import TestCase
+from twisted.trial.unittest import TestCase, SkipTest
 
 from bl.scheduler import BeatClock
 from bl.testlib import ClockRunner, TestReactor
-from bl.orchestra.pyo import PyoPlayer
+from bl.orchestra import pyo as pyoplayer
+from bl.orchestra.pyo import PyoPlayer, BlockPyoPlayer
 
 
 class DummyPyoObject(object):
@@ -23,7 +24,50 @@ class DummyPyoObject(object):
         self.calls.append(('setMul', mul))
 
     def __dir__(self):
-        return ['mul', 'freq']
+        return ['mul', 'freq', 'phase', '_private']
+
+
+class DummyRamp(object):
+
+    def __init__(self, value, time):
+        self.value = value
+        self.time = time
+        self.targets = []
+
+    def setValue(self, value):
+        self.targets.append(value)
+
+
+class DummyTable(object):
+
+    def __init__(self, size, duration):
+        self.size = size
+        self.duration = duration
+        self.values = None
+
+    def replace(self, values):
+        self.values = values
+
+
+class DummyTableReader(object):
+
+    def __init__(self, table):
+        self.table = table
+        self.calls = []
+
+    def play(self):
+        self.calls.append('play')
+
+    def stop(self):
+        self.calls.append('stop')
+
+    def reset(self):
+        self.calls.append('reset')
+
+
+def dummyTableReader(size, duration):
+    table = DummyTable(size, duration)
+    return table, DummyTableReader(table)
 
 
 class PyoPlayerTestCase(TestCase, ClockRunner):
@@ -64,7 +108,8 @@ class PyoPlayerTestCase(TestCase, ClockRunner):
                            args={'freq': cycle([(1, 2)]).next})
         player.resumePlaying()
         self.runTicks(96)
-        expected = [('setFreq', [1, 2]), ('setFreq', [1, 2])]
+        # Unchanged values are not set again on the second measure
+        expected = [('setFreq', [1, 2])]
         self.assertEquals(pyo.calls, expected)
 
     def test_updateArgs_init_chaining(self):
@@ -72,3 +117,108 @@ class PyoPlayerTestCase(TestCase, ClockRunner):
         player = PyoPlayer(pyo, interval=(1, 4),
                            clock=self.clock).updateArgs(freq=cycle([1]).next)
         self.assert_(player.args)
+
+    def test_setter_names_cached_per_class(self):
+        pyoplayer._setterNames.pop(DummyPyoObject, None)
+        PyoPlayer(DummyPyoObject())
+        self.assertEquals(pyoplayer._setterNames[DummyPyoObject],
+                          {'freq': 'setFreq', 'mul': 'setMul'})
+        pyoplayer._setterNames[DummyPyoObject] = {'freq': 'setFreq'}
+        pyo = DummyPyoObject()
+        player = PyoPlayer(pyo)
+        self.assertEquals(player._methods, {'freq': pyo.setFreq})
+        pyoplayer._setterNames.pop(DummyPyoObject)
+
+    def test_unchanged_values_skipped(self):
+        pyo = DummyPyoObject()
+        player = PyoPlayer(pyo, interval=(1, 8),
+                           clock=self.clock,
+                           args={'freq': cycle([1, 1, 2, 2]).next,
+                                 'mul': cycle([0.5]).next})
+        player.resumePlaying()
+        self.runTicks(96)
+        self.assertEquals(sorted(pyo.calls),
+                          [('setFreq', 1), ('setFreq', 1), ('setFreq', 1),
+                           ('setFreq', 2), ('setFreq', 2), ('setMul', 0.5)])
+
+    def test_smoothed_modulation(self):
+        pyo = DummyPyoObject()
+        player = PyoPlayer(pyo, interval=(1, 4),
+                           clock=self.clock,
+                           args={'freq': cycle([1, 2, 2, 3]).next,
+                                 'mul': cycle([0.5, 0.25]).next},
+                           smooth={'freq': 0.05},
+                           rampFactory=DummyRamp)
+        player.resumePlaying()
+        self.runTicks(96)
+        ramp = pyo.freq
+        self.failUnless(isinstance(ramp, DummyRamp))
+        self.assertEquals((ramp.value, ramp.time), (1, 0.05))
+        self.assertEquals(ramp.targets, [2, 3, 1])
+        self.assertEquals(pyo.calls,
+                          [('setMul', 0.5), ('setFreq', ramp),
+                           ('setMul', 0.25), ('setMul', 0.5),
+                           ('setMul', 0.25), ('setMul', 0.5)])
+
+
+class BlockPyoPlayerTestCase(TestCase, ClockRunner):
+
+    def setUp(self):
+        if pyoplayer.numpy is None:
+            raise SkipTest('numpy not installed')
+        self.clock = BeatClock(reactor=TestReactor())
+
+    def test_renderBlock(self):
+        pyo = DummyPyoObject()
+        player = BlockPyoPlayer(pyo, interval=(1, 4), clock=self.clock,
+                                args={'freq': cycle([1, 2, 3]).next},
+                                tableFactory=dummyTableReader)
+        block = player.renderBlock(96)
+        self.assertEquals(block['freq'].tolist(),
+                          [1] * 24 + [2] * 24 + [3] * 24 + [1] * 24)
+        block = player.renderBlock(48)
+        self.assertEquals(block['freq'].tolist(), [2] * 24 + [3] * 24)
+        self.failIf(pyo.calls)
+
+    def test_renderBlock_holds_values(self):
+        pyo = DummyPyoObject()
+        player = BlockPyoPlayer(pyo, interval=(3, 4), clock=self.clock,
+                                args={'freq': cycle([1, 2]).next},
+                                tableFactory=dummyTableReader)
+        self.assertEquals(player.renderBlock(96)['freq'].tolist(),
+                          [1] * 72 + [2] * 24)
+        self.assertEquals(player.renderBlock(96)['freq'].tolist(),
+                          [2] * 48 + [1] * 48)
+
+    def test_multichannel_values_rejected(self):
+        player = BlockPyoPlayer(DummyPyoObject(), clock=self.clock,
+                                args={'freq': cycle([(1, 2)]).next},
+                                tableFactory=dummyTableReader)
+        self.assertRaises(ValueError, player.renderBlock, 96)
+
+    def test_loads_tables_once_per_measure(self):
+        pyo = DummyPyoObject()
+        player = BlockPyoPlayer(pyo, interval=(1, 32), clock=self.clock,
+                                args={'freq': cycle([1, 2, 3, 4]).next,
+                                      'mul': cycle([0.5, 0.25]).next},
+                                tableFactory=dummyTableReader)
+        player.resumePlaying()
+        self.runTicks(96 * 2)
+        freqReader, mulReader = pyo.freq, pyo.mul
+        # Parameters are bound to their readers once
+        self.assertEquals(sorted(pyo.calls),
+                          [('setFreq', freqReader), ('setMul', mulReader)])
+        self.assertEquals(freqReader.calls, ['play', 'reset', 'reset'])
+        self.assertEquals(freqReader.table.size, 96)
+        self.assertEquals(freqReader.table.duration, 2.0)
+        self.assertEquals(freqReader.table.values, [1., 1., 1., 2., 2., 2.,
+                                                    3., 3., 3., 4., 4., 4.] * 8)
+        self.assertEquals(mulReader.table.values,
+                          ([0.5] * 3 + [0.25] * 3) * 16)
+        player.pausePlaying()
+        pyo.calls = []
+        self.runTicks(96)
+        self.assertEquals(freqReader.calls[-1], 'stop')
+        self.assertEquals(sorted(pyo.calls), [('setFreq', 4), ('setMul', 0.25)])
+        self.runTicks(96)
+        self.assertEquals(freqReader.calls[-1], 'stop')
@@ -10,8 +10,13 @@ class LoopRecorder(object):
     Up to 10 recorded loops can be fetched from a FIFO buffer.  When a new loop
     is recorded it is added to the buffer and the oldest is removed if capacity
     exceeds 10.
+
+    If C{recorder} is set, it is also called with C{(loopRecorder, 'record',
+    event=event)} for every event recorded (see L{bl.smf.SMFWriter}).
     """
 
+    recorder = None
+
     def __init__(self, measures=1, clock=None, meter=None):
         self.clock = getClock(clock)
         if meter is None:
@@ -28,6 +33,8 @@ class LoopRecorder(object):
         recorded events create a loop different from the past loop, add to
         recorded stack.
         """
+        if self.recorder is not None:
+            self.recorder(self, 'record', event=event)
         ticks = self.clock.ticks
         ticksper = self.meter.ticksPerMeasure * self.meter.measure(ticks)
         if (ticks - self._last_ticks) >= self.period and self._buffer:
@@ -0,0 +1,74 @@
+"""
+Seedable random number streams.
+
+Random ugens and arps (see bl.ugen, bl.arp) take an optional C{rng}
+argument: any object with the interface of C{random.Random}. A
+L{RandomStreams} derives one such stream per name (generally one per player)
+from a single session seed so that a whole render can be reproduced - or
+cached and fanned out across processes - given only that seed.
+
+Example:
+
+    >>> from bl.ugen import Random
+    >>> streams = RandomStreams(1234)
+    >>> drums = Random(36, 38, 42, rng=streams.stream('drums'))
+    >>> streams.seeds()
+    {'drums': 15316074085052272999L}
+"""
+import random
+import hashlib
+
+
+__all__ = ['deriveSeed', 'RandomStreams']
+
+
+def deriveSeed(seed, name):
+    """
+    Derive a seed for stream C{name} from the session C{seed}. Unlike
+    C{hash()}, the derivation is stable across processes and platforms.
+    """
+    digest = hashlib.sha1('%r:%s' % (seed, name)).hexdigest()
+    return int(digest[:16], 16)
+
+
+class RandomStreams(object):
+    """
+    A registry of named C{random.Random} streams derived from a session seed.
+
+    If C{seed} is not given, a session seed is drawn from the system's source
+    of randomness; either way it is available as the attribute C{seed}.
+    """
+
+    def __init__(self, seed=None):
+        self.reset(seed)
+
+    def reset(self, seed=None):
+        """
+        Reset the session seed. Streams handed out previously are reseeded in
+        place, so ugens holding them replay from the start of their sequence.
+        """
+        if seed is None:
+            seed = random.SystemRandom().getrandbits(32)
+        self.seed = seed
+        streams = getattr(self, '_streams', {})
+        self._seeds = {}
+        for (name, stream) in streams.items():
+            self._seeds[name] = deriveSeed(seed, name)
+            stream.seed(self._seeds[name])
+        self._streams = streams
+
+    def stream(self, name):
+        """
+        Get the stream for C{name}, creating it if this is the first request.
+        Repeated calls with the same C{name} return the same stream.
+        """
+        if name not in self._streams:
+            self._seeds[name] = deriveSeed(self.seed, name)
+            self._streams[name] = random.Random(self._seeds[name])
+        return self._streams[name]
+
+    def seeds(self):
+        """
+        Return a C{dict} mapping stream names to their derived seeds.
+        """
+        return dict(self._seeds)
@@ -10,6 +10,7 @@ from twisted.internet.selectreactor import SelectReactor
 from twisted.internet.task import LoopingCall
 
 from bl.debug import DEBUG
+from bl.rng import RandomStreams
 
 
 __all__ = ['Tempo', 'Beat', 'Meter', 'standardMeter', 'BeatClock',
@@ -212,7 +213,7 @@ class BeatClock(SelectReactor, SynthControllerMixin):
     syncClock = None
 
     def __init__(self, tempo=TEMPO_120_24, meter=None, meters=(), reactor=None,
-                 syncClockClass=None, default=False):
+                 syncClockClass=None, default=False, seed=None):
         """
         tempo: The tempo object (default: Tempo(120, 24))
         meter: Meter used by the clock - default to Meter(4,4,tempo=tempo)
@@ -225,6 +226,8 @@ class BeatClock(SelectReactor, SynthControllerMixin):
         default: If True, BeatClock.defaultClock will be set to the instance -
             this is used by other components to get the default global
             BeatClock.
+        seed: The session seed from which per-player random number streams
+            are derived (see rng()). If None, a seed is chosen at random.
         """
         global clock
         self.tempo = tempo
@@ -240,6 +243,7 @@ class BeatClock(SelectReactor, SynthControllerMixin):
         if not reactor:
             from twisted.internet import reactor
         self.reactor = reactor
+        self.streams = RandomStreams(seed)
         if default or (self.defaultClock is None):
             BeatClock.defaultClock = self
             clock = self
@@ -405,6 +409,26 @@ class BeatClock(SelectReactor, SynthControllerMixin):
         event = ScheduledEvent(self, _f, *args, **kwargs)
         return event
 
+    def rng(self, name):
+        """
+        Get the random number stream for C{name} (generally a player name),
+        derived from this clock's session seed. Pass the stream as the C{rng}
+        argument of random ugens and arps to make a render reproducible.
+
+        @param name: The name of the stream
+        """
+        return self.streams.stream(name)
+
+    def seeds(self):
+        """
+        Report the seeds in use this session: a C{dict} with the session
+        seed under the key C{'session'} and a C{dict} of derived seeds by
+        stream name under C{'streams'}. Two renders with the same session seed
+        and schedule produce identical results.
+        """
+        return {'session': self.streams.seed,
+                'streams': self.streams.seeds()}
+
     def callWhenRunning(self, *a, **kw):
         return self.reactor.callWhenRunning(*a, **kw)
 
@@ -0,0 +1,528 @@
+"""
+Standard MIDI File (SMF) export and playback.
+
+An L{SMFWriter} records events from instruments (as an instrument's
+C{recorder}) or from a L{bl.recorder.LoopRecorder} (as its C{recorder}) and
+streams them to a type 1 MIDI file: one track per recorded object plus a
+conductor track holding tempo changes. Events are encoded as they arrive and
+spooled to temporary files through a bounded buffer, so memory use does not
+grow with the length of the recording; close() assembles the file.
+
+Example:
+
+    >>> writer = SMFWriter('set.mid')
+    >>> piano.recorder = writer
+    >>> drums.recorder = writer
+    >>> ...
+    >>> writer.close()
+
+L{loadSMF} reads a MIDI file into per-track NumPy arrays which an
+L{SMFPlayer} plays on the clock:
+
+    >>> player = SMFPlayer(loadSMF('backing.mid'), {1: bass, 2: keys})
+    >>> player.resumePlaying()
+    >>> player.seek(96 * 16)
+"""
+import os
+import mmap
+import struct
+import tempfile
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from bl.utils import getClock
+from bl.instrument.interfaces import CONTROLS
+
+
+__all__ = ['SMFWriter', 'varlen', 'loadSMF', 'SMF', 'SMFTrack', 'SMFPlayer']
+
+
+END_OF_TRACK = '\x00\xff\x2f\x00'
+
+
+def varlen(value):
+    """
+    Encode C{value} as an SMF variable-length quantity.
+    """
+    encoded = [value & 0x7F]
+    value >>= 7
+    while value:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.reverse()
+    return bytearray(encoded)
+
+
+def _clamp(value, maximum=127):
+    """
+    C{value} as an C{int} limited to 0 to C{maximum}, the range of a MIDI
+    data byte by default.
+    """
+    return max(0, min(int(value), maximum))
+
+
+class _TrackSpool(object):
+    """
+    The encoded events of one track: a buffer of at most C{bufferSize} bytes
+    in front of a temporary spool file.
+    """
+
+    def __init__(self, startTicks, bufferSize):
+        self.lastTicks = startTicks
+        self.bufferSize = bufferSize
+        self.buffer = bytearray()
+        self.spool = tempfile.TemporaryFile()
+        self.size = 0
+        self._runningStatus = None
+
+    def write(self, ticks, status, data):
+        """
+        Append an event at C{ticks}: a channel message if C{status} is
+        below 0xF0, otherwise a meta or system message whose C{data}
+        follows the status byte as is.
+        """
+        buffer = self.buffer
+        buffer += varlen(max(0, ticks - self.lastTicks))
+        self.lastTicks = max(ticks, self.lastTicks)
+        if status < 0xF0:
+            if status != self._runningStatus:
+                buffer.append(status)
+                self._runningStatus = status
+        else:
+            buffer.append(status)
+            self._runningStatus = None
+        buffer += data
+        if len(buffer) >= self.bufferSize:
+            self.flush()
+
+    def flush(self):
+        self.spool.write(self.buffer)
+        self.size += len(self.buffer)
+        self.buffer = bytearray()
+
+    def copyTo(self, fd, blockSize=65536):
+        self.flush()
+        fd.write(struct.pack('>4sL', 'MTrk', self.size + len(END_OF_TRACK)))
+        self.spool.seek(0)
+        while 1:
+            block = self.spool.read(blockSize)
+            if not block:
+                break
+            fd.write(block)
+        fd.write(END_OF_TRACK)
+        self.spool.close()
+
+
+class SMFWriter(object):
+    """
+    A recorder writing a type 1 Standard MIDI File to C{path}. The file's
+    time division is the clock's ticks per beat, so ticks are written as is
+    and delta times are counted from the tick the writer was created.
+
+    As an instrument recorder it is called with C{(object, commandname,
+    **arguments)}: noteon, noteoff, controlChange and pitchBend commands are
+    written to the track for C{object}, on the object's (0-based) C{channel}
+    if it has one. As a LoopRecorder's recorder, events which are MIDI
+    packets (C{[status, data1, data2]} or pypm messages C{[packet,
+    timestamp]}) are written as is; other events are ignored.
+
+    Each track holds at most C{bufferSize} bytes in memory.
+    """
+
+    def __init__(self, path, clock=None, bufferSize=65536):
+        self.path = path
+        self.clock = getClock(clock)
+        self.bufferSize = bufferSize
+        self.startTicks = self.clock.ticks
+        self.closed = False
+        self._tempo = None
+        self._conductor = _TrackSpool(self.startTicks, bufferSize)
+        self._tracks = {}
+        self._order = []
+        meter = self.clock.meter
+        denominator = {1: 0, 2: 1, 4: 2, 8: 3, 16: 4, 32: 5}.get(
+            meter.division, 2)
+        # A metronome click every beat: 24 MIDI clocks per quarter note
+        clocks = 96 // (1 << denominator)
+        self._conductor.write(self.startTicks, 0xFF, bytearray(
+            [0x58, 4, meter.length, denominator, clocks, 8]))
+        self._checkTempo(self.startTicks)
+
+    def __call__(self, object, commandname, **arguments):
+        if self.closed:
+            raise ValueError('SMFWriter for %s is closed' % self.path)
+        ticks = self.clock.ticks
+        self._checkTempo(ticks)
+        (track, channel) = self._track(object)
+        if commandname == 'noteon':
+            note = arguments['note']
+            if note is not None:
+                track.write(ticks, 0x90 | channel, bytearray(
+                    [_clamp(note), _clamp(arguments['velocity'])]))
+        elif commandname == 'noteoff':
+            note = arguments['note']
+            if note is not None:
+                track.write(ticks, 0x80 | channel,
+                            bytearray([_clamp(note), 0]))
+        elif commandname == 'controlChange':
+            for (name, value) in sorted(arguments.iteritems()):
+                if value is not None and name in CONTROLS:
+                    track.write(ticks, 0xB0 | channel,
+                                bytearray([CONTROLS[name], _clamp(value)]))
+        elif commandname == 'pitchBend':
+            value = _clamp(arguments['value'] + 8192, 0x3FFF)
+            track.write(ticks, 0xE0 | channel,
+                        bytearray([value & 0x7F, value >> 7]))
+        elif commandname == 'record':
+            packet = arguments['event']
+            if type(packet) in (list, tuple) and packet and type(
+                    packet[0]) in (list, tuple):
+                packet = packet[0]
+            if (type(packet) in (list, tuple) and packet and
+                    type(packet[0]) is int and 0x80 <= packet[0] < 0xF0):
+                status = packet[0]
+                size = 1 if 0xC0 <= status < 0xE0 else 2
+                track.write(ticks, status, bytearray(packet[1:1 + size]))
+
+    def _track(self, object):
+        entry = self._tracks.get(object)
+        if entry is None:
+            track = _TrackSpool(self.startTicks, self.bufferSize)
+            name = getattr(object, 'sfpath', None)
+            if name:
+                name = os.path.basename(name)
+            else:
+                name = type(object).__name__
+            name = str(name)[:127]
+            track.write(self.startTicks, 0xFF,
+                        bytearray([0x03, len(name)]) + name)
+            channel = getattr(object, 'channel', None)
+            if type(channel) is not int:
+                channel = len(self._order)
+            entry = self._tracks[object] = (track, channel % 16)
+            self._order.append(entry)
+        return entry
+
+    def _checkTempo(self, ticks):
+        bpm = self.clock.tempo.bpm
+        if bpm != self._tempo:
+            self._tempo = bpm
+            microseconds = int(round(60000000. / bpm))
+            self._conductor.write(ticks, 0xFF, bytearray(
+                [0x51, 3]) + struct.pack('>L', microseconds)[1:])
+
+    def flush(self):
+        """
+        Move all buffered events to the spool files.
+        """
+        self._conductor.flush()
+        for (track, channel) in self._order:
+            track.flush()
+
+    def close(self):
+        """
+        Write the MIDI file and remove the spool files.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        fd = open(self.path, 'wb')
+        try:
+            fd.write(struct.pack('>4sLHHH', 'MThd', 6, 1,
+                                 len(self._order) + 1, self.clock.tempo.tpb))
+            self._conductor.copyTo(fd)
+            for (track, channel) in self._order:
+                track.copyTo(fd)
+        finally:
+            fd.close()
+
+
+def _readVarlen(data, position):
+    value = 0
+    while 1:
+        byte = ord(data[position])
+        position += 1
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            return (value, position)
+
+
+class SMFTrack(object):
+    """
+    The channel messages of a track as NumPy arrays: C{ticks} (absolute, in
+    the file's division), C{status}, C{data1} and C{data2}.
+    """
+
+    def __init__(self, name, ticks, status, data1, data2):
+        self.name = name
+        self.ticks = ticks
+        self.status = status
+        self.data1 = data1
+        self.data2 = data2
+
+    def __len__(self):
+        return len(self.ticks)
+
+
+class SMF(object):
+    """
+    A loaded MIDI file: C{division} (ticks per beat), C{tracks} (a list of
+    L{SMFTrack}s) and C{tempos}, a list of C{(tick, bpm)} tempo changes.
+    """
+
+    def __init__(self, format, division, tracks, tempos):
+        self.format = format
+        self.division = division
+        self.tracks = tracks
+        self.tempos = tempos
+
+
+def loadSMF(path):
+    """
+    Load the Standard MIDI File at C{path}. The file is read through a
+    memory map and each track's channel messages are collected into arrays,
+    without building a Python object per event. SysEx and meta events other
+    than track names and tempo changes are skipped.
+    """
+    if numpy is None:
+        raise ImportError('loadSMF requires numpy')
+    fd = open(path, 'rb')
+    try:
+        data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        fd.close()
+    try:
+        (kind, length, format, count, division) = struct.unpack(
+            '>4sLHHH', data[:14])
+        if kind != 'MThd':
+            raise ValueError('%s is not a MIDI file' % path)
+        if division & 0x8000:
+            raise ValueError('SMPTE time division is not supported')
+        position = 8 + length
+        tracks = []
+        tempos = []
+        while position + 8 <= len(data) and len(tracks) < count:
+            (kind, length) = struct.unpack('>4sL',
+                                           data[position:position + 8])
+            start = position + 8
+            position = start + length
+            if kind == 'MTrk':
+                tracks.append(_parseTrack(data, start, position, tempos))
+    finally:
+        data.close()
+    tempos.sort()
+    return SMF(format, division, tracks, tempos)
+
+
+def _parseTrack(data, position, end, tempos):
+    name = None
+    tick = 0
+    running = None
+    ticks = array('l')
+    statuses = array('B')
+    data1 = array('B')
+    data2 = array('B')
+    while position < end:
+        (delta, position) = _readVarlen(data, position)
+        tick += delta
+        byte = ord(data[position])
+        if byte == 0xFF:
+            kind = ord(data[position + 1])
+            (length, position) = _readVarlen(data, position + 2)
+            payload = data[position:position + length]
+            position += length
+            running = None
+            if kind == 0x2F:
+                break
+            elif kind == 0x51:
+                microseconds = struct.unpack('>L', '\x00' + payload)[0]
+                tempos.append((tick, 60000000. / microseconds))
+            elif kind == 0x03 and name is None:
+                name = payload
+        elif byte in (0xF0, 0xF7):
+            (length, position) = _readVarlen(data, position + 1)
+            position += length
+            running = None
+        else:
+            if byte & 0x80:
+                running = byte
+                position += 1
+            elif running is None:
+                raise ValueError('Data byte without status at %d' % position)
+            ticks.append(tick)
+            statuses.append(running)
+            data1.append(ord(data[position]))
+            if 0xC0 <= running < 0xE0:
+                data2.append(0)
+                position += 1
+            else:
+                data2.append(ord(data[position + 1]))
+                position += 2
+    return SMFTrack(name,
+                    numpy.frombuffer(ticks, dtype=ticks.typecode),
+                    numpy.frombuffer(statuses, dtype=numpy.uint8),
+                    numpy.frombuffer(data1, dtype=numpy.uint8),
+                    numpy.frombuffer(data2, dtype=numpy.uint8))
+
+
+_CONTROL_NAMES = dict((v, k) for (k, v) in CONTROLS.iteritems())
+
+
+class SMFPlayer(object):
+    """
+    Play the tracks of an L{SMF} on L{IMIDIInstrument}s: C{instruments} is
+    a C{dict} of track indexes to instruments, or one instrument for every
+    track. Tracks without an instrument are skipped.
+
+    Ticks of the file are scaled to the clock's ticks per beat; the clock's
+    tempo is left as is. Each track keeps a cursor into its arrays and has
+    one delayed call pending for its next event, so playing does not create
+    generators or dicts per event. seek() is a binary search per track.
+
+    Control changes are sent with the names in L{IMIDIInstrument} where there
+    is one; other controls are ignored. Sounding notes are stopped on pause
+    and seek.
+    """
+
+    def __init__(self, smf, instruments, clock=None):
+        self.smf = smf
+        self.clock = getClock(clock)
+        tpb = self.clock.tempo.tpb
+        if not isinstance(instruments, dict):
+            instruments = dict((i, instruments)
+                               for i in range(len(smf.tracks)))
+        self.instruments = instruments
+        self.position = 0
+        self.playing = False
+        self._origin = 0
+        self._tracks = []
+        for (index, track) in enumerate(smf.tracks):
+            if instruments.get(index) is None or not len(track):
+                continue
+            self._tracks.append(_TrackCursor(
+                instruments[index], track.ticks * tpb // smf.division,
+                track))
+
+    @property
+    def length(self):
+        """
+        The tick of the last event (in clock ticks).
+        """
+        return max([int(t.ticks[-1]) for t in self._tracks] or [0])
+
+    def resumePlaying(self):
+        """
+        Resume (or start) playing from the current position on the next
+        measure.
+        """
+        self.clock.callLater(self.clock.untilNextMeasure(), self.play)
+
+    def pausePlaying(self):
+        """
+        Pause playing on the next measure.
+        """
+        self.clock.callAfterMeasures(0, self.pause)
+
+    def play(self):
+        """
+        Immediately start playing from the current position.
+        """
+        if self.playing:
+            return
+        self.playing = True
+        self._origin = self.clock.ticks - self.position
+        for cursor in self._tracks:
+            self._scheduleTrack(cursor)
+
+    def pause(self):
+        """
+        Immediately stop playing, keeping the position.
+        """
+        if not self.playing:
+            return
+        self.position = self.clock.ticks - self._origin
+        self.playing = False
+        for cursor in self._tracks:
+            cursor.cancel()
+            cursor.stopNotes()
+
+    def seek(self, ticks):
+        """
+        Move to C{ticks} (in clock ticks from the start of the file).
+        """
+        playing = self.playing
+        if playing:
+            self.pause()
+        self.position = ticks
+        for cursor in self._tracks:
+            cursor.stopNotes()
+            cursor.index = int(numpy.searchsorted(cursor.ticks, ticks))
+        if playing:
+            self.play()
+
+    def _scheduleTrack(self, cursor):
+        if cursor.index >= cursor.count:
+            return
+        delta = cursor.ticks.item(cursor.index) + self._origin - \
+            self.clock.ticks
+        if delta <= 0:
+            self._playTrack(cursor)
+        else:
+            cursor.call = self.clock.callLater(delta, self._playTrack,
+                                               cursor)
+
+    def _playTrack(self, cursor):
+        cursor.call = None
+        now = self.clock.ticks - self._origin
+        ticks = cursor.ticks
+        index = cursor.index
+        while index < cursor.count and ticks.item(index) <= now:
+            cursor.send(index)
+            index += 1
+        cursor.index = index
+        self._scheduleTrack(cursor)
+
+
+class _TrackCursor(object):
+
+    def __init__(self, instrument, ticks, track):
+        self.instrument = instrument
+        self.ticks = ticks
+        self.count = len(ticks)
+        self.status = track.status
+        self.data1 = track.data1
+        self.data2 = track.data2
+        self.index = 0
+        self.call = None
+        self.sounding = set()
+
+    def send(self, index):
+        kind = self.status.item(index) & 0xF0
+        data1 = self.data1.item(index)
+        data2 = self.data2.item(index)
+        if kind == 0x90 and data2:
+            self.instrument.noteon(data1, data2)
+            self.sounding.add(data1)
+        elif kind == 0x80 or kind == 0x90:
+            self.instrument.noteoff(data1)
+            self.sounding.discard(data1)
+        elif kind == 0xB0:
+            name = _CONTROL_NAMES.get(data1)
+            if name is not None:
+                self.instrument.controlChange(**{name: data2})
+        elif kind == 0xE0:
+            self.instrument.pitchBend(((data2 << 7) | data1) - 8192)
+
+    def cancel(self):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+    def stopNotes(self):
+        for note in self.sounding:
+            self.instrument.noteoff(note)
+        self.sounding.clear()
@@ -40,6 +40,7 @@ class TestInstrument(object):
         self.plays = []
         self.stops = []
         self.cc = []
+        self.bends = []
 
     def noteon(self, note, velocity):
         self.plays.append(('note', self.clock.ticks, note, velocity))
@@ -63,3 +64,6 @@ class TestInstrument(object):
 
     def controlChange(self, **kwargs):
         self.cc.append((self.clock.ticks, kwargs))
+
+    def pitchBend(self, value):
+        self.bends.append((self.clock.ticks, value))
@@ -7,8 +7,8 @@ from bl.testlib import ClockRunner, TestReactor
 from bl import arp
 from bl.ugen import N
 from bl.scheduler import BeatClock, Tempo
-from bl.arp import (AscArp, DescArp, OrderedArp, RandomArp, OctaveArp,
-    Adder, PhraseRecordingArp, ArpMap, PatternArp, ChordPatternArp)
+from bl.arp import (AscArp, DescArp, OrderedArp, RevOrderedArp, RandomArp,
+    OctaveArp, Adder, PhraseRecordingArp, ArpMap, PatternArp, ChordPatternArp)
 from bl.arp import (SingleParadiddle, DoubleParadiddle, TripleParadiddle,
     ParadiddleDiddle)
 
@@ -53,7 +53,26 @@ class ArpTests(TestCase):
         arpeggio = []
         for i in range(8):
             arpeggio.append(self.randArp())
-        self.assertEquals(arpeggio, [2, 3, 0, 1, 0, 2, 1, 3])
+        self.assertEquals(arpeggio, [2, 1, 0, 3, 1, 3, 0, 2])
+
+    def test_randomArp_rng(self):
+        a = RandomArp(range(16), rng=random.Random(1234))
+        b = RandomArp(range(16), rng=random.Random(1234))
+        played = [a() for i in range(16)]
+        self.assertEquals(played, [b() for i in range(16)])
+        self.assertEquals(sorted(played), range(16))
+
+    def test_randomArp_reset(self):
+        a = RandomArp(range(8), rng=random.Random(1234))
+        played = [a() for i in range(3)]
+        a.reset(range(4, 12))
+        rest = [a() for i in range(8 - len([v for v in played if v >= 4]))]
+        self.assertEquals(sorted([v for v in played if v >= 4] + rest),
+                          range(4, 12))
+        a.reset([[1, 2], [3, 4]])
+        self.assertEquals(sorted([a(), a()]), [[1, 2], [3, 4]])
+        a.reset([])
+        self.assertEquals(a(), None)
 
     def test_numeric_sorting(self):
         """
@@ -66,6 +85,26 @@ class ArpTests(TestCase):
             arpeggio.append(ascarp())
         self.assertEquals(arpeggio, [1, 2, None, 3, 1, 2, None, 3])
 
+    def test_sortNumeric(self):
+        values = [3, N, 1.5, 2]
+        self.assertEquals(arp.sortNumeric(values), [1.5, N, 2, 3])
+        self.assertEquals(arp.sortNumeric(values, arp._descending),
+                          [3, N, 2, 1.5])
+        result = arp.sortNumeric(values)
+        result.append(4)
+        self.assertEquals(arp.sortNumeric(values), [1.5, N, 2, 3])
+        self.assertEquals(arp.sortNumeric([3.0, 1]), [1, 3.0])
+        self.assertEquals(arp.sortNumeric([3, 1.0]), [1.0, 3])
+        self.assertEquals(arp.sortNumeric([[2, 1], 3, 1]), [[2, 1], 1, 3])
+
+    def test_reset_same_values(self):
+        self.ascArp.reset([3, 1, 2, 0])
+        self.ascArp()
+        self.ascArp.reset([3, 1, 2, 0])
+        self.assertEquals(self.ascArp(), 1)
+        self.ascArp.reset([3, 1, 2, 4])
+        self.assertEquals(self.ascArp(), 3)
+
     def test_resetting(self):
         """
         Test various behaviors of resetting values on an arp midstream.
@@ -185,6 +224,87 @@ class ArpTests(TestCase):
              13, 14, 15, 16,
              25, 26, 27, 28])
 
+    def test_octave_arp_table(self):
+        for (values, kwargs) in [([1, 2, 3, 4], {}),
+                                 ([3, 1, None, 2], {'oscillate': True}),
+                                 ([1, 2, 3], {'direction': -1}),
+                                 ([1000, 2], {'octaves': 0})]:
+            compiled = OctaveArp(AscArp(), values, **kwargs)
+            dynamic = OctaveArp(AscArp(), values, **kwargs)
+            dynamic.maxTable = 0
+            played = []
+            expected = []
+
+            def play(n):
+                played.extend(compiled() for i in range(n))
+                expected.extend(dynamic() for i in range(n))
+
+            play(7)
+            self.assertTrue(compiled._table)
+            self.assertFalse(dynamic._table)
+            for a in (compiled, dynamic):
+                a.reset(values + [5])
+            play(9)
+            for a in (compiled, dynamic):
+                a.switch(DescArp())
+            play(7)
+            for a in (compiled, dynamic):
+                a.octaves = 1
+            play(30)
+            self.assertEquals(played, expected)
+
+    def test_octave_arp_inner_reset(self):
+        compiled = OctaveArp(OrderedArp([0, 1, 2]), octaves=1)
+        dynamic = OctaveArp(OrderedArp([0, 1, 2]), octaves=1)
+        dynamic.maxTable = 0
+        played = [compiled() for i in range(4)]
+        expected = [dynamic() for i in range(4)]
+        self.assertTrue(compiled._table)
+        for a in (compiled, dynamic):
+            a.arp.reset([40, 41, 42, 43])
+        played.extend(compiled() for i in range(6))
+        expected.extend(dynamic() for i in range(6))
+        for a in (compiled, dynamic):
+            a.arp.direction = -1
+        played.extend(compiled() for i in range(6))
+        expected.extend(dynamic() for i in range(6))
+        self.assertEquals(played, expected)
+        self.assertEquals(played[4:8], [53, 54, 43, 40])
+
+    def test_octave_arp_state(self):
+        compiled = OctaveArp(OrderedArp([0, 3, 8]), octaves=3)
+        dynamic = OctaveArp(OrderedArp([0, 3, 8]), octaves=3)
+        dynamic.maxTable = 0
+        played = [compiled() for i in range(4)]
+        expected = [dynamic() for i in range(4)]
+        self.assertTrue(compiled._table)
+        self.assertEquals((compiled.index, compiled.currentOctave), (1, 1))
+        for octaveArp in (compiled, dynamic):
+            octaveArp.currentOctave = 3
+        played.extend(compiled() for i in range(4))
+        expected.extend(dynamic() for i in range(4))
+        for octaveArp in (compiled, dynamic):
+            octaveArp.index = 0
+        played.extend(compiled() for i in range(4))
+        expected.extend(dynamic() for i in range(4))
+        self.assertEquals(played, expected)
+        self.assertEquals(played[4:6], [39, 44])
+
+    def test_octave_arp_direction(self):
+        octaveArp = OctaveArp(OrderedArp([0, 1, 2]), octaves=2)
+        self.assertEquals([octaveArp() for i in range(4)], [0, 1, 2, 12])
+        self.assertEquals(octaveArp.direction, 1)
+        octaveArp.direction = -1
+        self.assertEquals(octaveArp.direction, -1)
+        self.assertEquals([octaveArp() for i in range(5)],
+                          [13, 14, 0, 1, 2])
+        self.assertEquals([octaveArp() for i in range(3)], [24, 25, 26])
+
+    def test_octave_arp_dynamic(self):
+        octaveArp = OctaveArp(OrderedArp([1, lambda: 2]), octaves=1)
+        self.assertEquals([octaveArp() for i in range(4)], [1, 2, 13, 14])
+        self.assertFalse(octaveArp._table)
+
     def test_adder(self):
         arpeggio = []
         octaveArp = OctaveArp(AscArp(), [1, 2, 3, 4])
@@ -243,7 +363,50 @@ class ArpTests(TestCase):
         self.assertEqual(results, [2, 4, 6, 2, 4, 6])
         arpmap = ArpMap(lambda x: x * 2, RandomArp([1, 2, lambda: 3]))
         results = [arpmap() for i in range(6)]
-        self.assertEqual(results, [6, 4, 2, 6, 2, 6])
+        self.assertEqual(results, [6, 4, 2, 2, 4, 6])
+
+    def test_indexed_arp_table(self):
+        a = OrderedArp([60, 64, 67])
+        self.assertEquals(a._table.typecode, 'h')
+        self.assertEquals([a() for i in range(4)], [60, 64, 67, 60])
+        a.reset([60, [64, 67], None])
+        self.assertEquals(a._table, [60, [64, 67], None])
+        self.assertEquals([a() for i in range(3)], [[64, 67], None, 60])
+        a.reset([60, lambda: 62])
+        self.assertEquals(a._table, None)
+        self.assertEquals([a() for i in range(3)], [60, 62, 60])
+        a = RevOrderedArp([1, 2, 3])
+        self.assertEquals([a() for i in range(4)], [3, 2, 1, 3])
+
+    def test_indexed_arp_values_changed(self):
+        values = [60, 64, 67]
+        a = OrderedArp(values)
+        self.assertEquals([a() for i in range(4)], [60, 64, 67, 60])
+        a.values[1] = 65
+        self.assertEquals([a() for i in range(3)], [65, 67, 60])
+        values[2] = lambda: 70
+        self.assertEquals([a() for i in range(3)], [65, 70, 60])
+        self.assertEquals(a._table, None)
+        del values[1:]
+        self.assertEquals([a() for i in range(2)], [60, 60])
+
+    def test_reset_tuple(self):
+        a = OrderedArp((60, 64, 67))
+        table = a._table
+        a()
+        a.reset((60, 64, 67))
+        self.assertIdentical(a._table, table)
+        self.assertEquals(a.index, 1)
+
+    def test_octave_arp_values_changed(self):
+        inner = OrderedArp([0, 1, 2])
+        octaveArp = OctaveArp(inner, octaves=1)
+        self.assertEquals([octaveArp() for i in range(4)], [0, 1, 2, 12])
+        inner.values[1] = 5
+        self.assertEquals([octaveArp() for i in range(4)], [17, 14, 0, 5])
+        inner.values[0] = lambda: 7
+        self.assertEquals([octaveArp() for i in range(4)], [2, 19, 17, 14])
+        self.assertFalse(octaveArp._table)
 
     def test_pattern_arp(self):
         pattern = [0, 1, 2, 0, 0, 3, 2]
@@ -258,6 +421,20 @@ class ArpTests(TestCase):
         played = [arp() for i in range(8)]
         self.assertEqual(played, [1, 2, 3, 4, 1, 2, 3, 4])
 
+    def test_pattern_arp_table(self):
+        arp = PatternArp([1, 2, 3, 4], [0, 3, 1])
+        self.assertEquals(list(arp._table), [1, 4, 2])
+        played = [arp() for i in range(4)]
+        arp.reset([5, 6, 7, 8])
+        played.extend(arp() for i in range(3))
+        self.assertEqual(played, [1, 4, 2, 1, 8, 6, 5])
+        arp.reset([5, 6, 7])
+        self.assertEqual(arp._table, None)
+        self.assertRaises(IndexError, arp)
+        arp.resetPattern([0, [1, 2]])
+        self.assertEqual(arp._table, None)
+        self.assertEqual([arp() for i in range(3)], [5, [6, 7], 5])
+
     def test_chord_pattern_arp(self):
         pattern = [0, 1, 2, [1, 2, 3], 3, 2, 1]
         notes = [1, 2, 3, 4]
@@ -338,3 +515,50 @@ class PhraseRecordingArpTests(TestCase, ClockRunner):
         self.runTicks(96)
         phrase = phraseRecorder()
         self.failIf(phrase)
+
+    def test_unreleased_sustain(self):
+        self.runTicks(96)
+        self.phraseRecorder()
+        self.runTicks(24)
+        self.phraseRecorder.recordNoteOn(60, 100)
+        self.runTicks(72)
+        phrase = self.phraseRecorder()
+        self.assertEquals(self.phraseRecorder.elapsed, 96)
+        self.assertEquals(phrase, [(24, 60, 100, 72)])
+
+    def test_capacity(self):
+        phraseRecorder = PhraseRecordingArp(self.clock, capacity=4)
+        for note in range(60, 66):
+            phraseRecorder.recordNoteOn(note, 100)
+            self.runTicks(12)
+        phraseRecorder.recordNoteOff(60)
+        phraseRecorder.recordNoteOff(65)
+        self.failIf(self.flushLoggedErrors())
+        phrase = phraseRecorder()
+        self.assertEquals(len(phrase), 4)
+        self.assertEquals(list(phrase),
+            [(24, 62, 100, 48), (36, 63, 100, 36), (48, 64, 100, 24),
+             (60, 65, 100, 12)])
+        self.assertEquals(phrase[-1], (60, 65, 100, 12))
+        self.assertEquals(phrase[1:3], list(phrase)[1:3])
+        self.assertRaises(IndexError, lambda: phrase[4])
+
+    def test_unknown_noteoff(self):
+        self.phraseRecorder.recordNoteOff(60)
+        self.assertEquals(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def test_any_values(self):
+        self.phraseRecorder.recordNoteOn(60, 100)
+        self.phraseRecorder.recordNoteOn(None, 100)
+        self.runTicks(6)
+        self.phraseRecorder.recordNoteOn(60.5, 90.5)
+        self.phraseRecorder.recordNoteOn(200, 100)
+        self.runTicks(6)
+        self.phraseRecorder.recordNoteOff(None)
+        self.phraseRecorder.recordNoteOff(60.5)
+        self.phraseRecorder.recordNoteOff(200)
+        self.failIf(self.flushLoggedErrors())
+        self.runTicks(12)
+        self.assertEquals(self.phraseRecorder(), [
+            (0, 60, 100, 24), (0, None, 100, 12), (6, 60.5, 90.5, 6),
+            (6, 200, 100, 6)])
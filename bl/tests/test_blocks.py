@@ -0,0 +1,61 @@
+import random
+
+from twisted.trial.unittest import TestCase, SkipTest
+
+try:
+    import numpy
+    from bl.blocks import (CycleBlock, OscillateBlock, RandomBlock,
+                           RandomWalkBlock, WeightBlock, BlockReader)
+    [numpy]
+except ImportError:
+    numpy = None
+
+
+class BlockUGensTestCase(TestCase):
+
+    def setUp(self):
+        if numpy is None:
+            raise SkipTest('numpy not installed')
+
+    def test_CycleBlock(self):
+        c = CycleBlock(1, 2, 3, 4, 5)
+        self.assertEquals(c.block(7).tolist(), [1, 2, 3, 4, 5, 1, 2])
+        self.assertEquals(c.block(4).tolist(), [3, 4, 5, 1])
+
+    def test_OscillateBlock(self):
+        o = OscillateBlock(1, 2, 3, 4, 5)
+        self.assertEquals(o.block(10).tolist(), [1, 2, 3, 4, 5, 4, 3, 2, 1, 2])
+
+    def test_RandomBlock(self):
+        r = RandomBlock(1, 2, 3, rng=random.Random(1234))
+        values = r.block(300).tolist()
+        self.assertEquals(set(values), set([1, 2, 3]))
+        again = RandomBlock(1, 2, 3, rng=random.Random(1234))
+        self.assertEquals(again.block(300).tolist(), values)
+
+    def test_RandomWalkBlock(self):
+        walk = RandomWalkBlock([1, 2, 3, 4, 5], startIndex=0,
+                               rng=random.Random(1234))
+        values = walk.block(100).tolist() + walk.block(100).tolist()
+        self.assertEquals(values[0], 1)
+        for (a, b) in zip(values, values[1:]):
+            self.assertEquals(abs(a - b), 1)
+        self.assertEquals(set(values), set([1, 2, 3, 4, 5]))
+        walk = RandomWalkBlock([7])
+        self.assertEquals(walk.block(3).tolist(), [7, 7, 7])
+
+    def test_WeightBlock(self):
+        w = WeightBlock((60, 7000), (64, 2000), (67, 1000),
+                        rng=random.Random(1234))
+        values = w.block(10000).tolist()
+        self.assertApproximates(values.count(60), 7000, 300)
+        self.assertApproximates(values.count(64), 2000, 300)
+        self.assertApproximates(values.count(67), 1000, 300)
+        w.update((60, 0), (64, 0))
+        self.assertEquals(set(w.block(100).tolist()), set([67]))
+
+    def test_BlockReader(self):
+        reader = BlockReader(CycleBlock(1, 2, 3), size=2)
+        values = [reader() for i in range(7)]
+        self.assertEquals(values, [1, 2, 3, 1, 2, 3, 1])
+        self.assertIdentical(type(values[0]), int)
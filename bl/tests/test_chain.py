@@ -0,0 +1,70 @@
+import random
+from itertools import cycle
+
+from twisted.trial.unittest import TestCase
+
+from bl.arp import AscArp, DescArp, OrderedArp, OctaveArp, Adder, ArpMap
+from bl.chain import Chain
+
+
+class ChainTests(TestCase):
+
+    def test_matches_layered_arps(self):
+        double = lambda v: v * 2
+        adder = Adder(AscArp(), [1, 3, 2, 4])
+        adder.amount = 2
+        layered = ArpMap(double, OctaveArp(adder, oscillate=True))
+        chain = Chain(AscArp(), [1, 3, 2, 4]).add(2).octave(
+            oscillate=True).map(double)
+        self.assertEquals([chain() for i in range(40)],
+                          [layered() for i in range(40)])
+
+    def test_octave(self):
+        for (args, kwargs) in [((), {}), ((1,), {}), ((0,), {}),
+                               ((), {'direction': -1}),
+                               ((), {'oscillate': True})]:
+            layered = OctaveArp(AscArp(), [1, 2, 3, 4], *args, **kwargs)
+            chain = Chain(AscArp(), [1, 2, 3, 4]).octave(*args, **kwargs)
+            self.assertEquals([chain() for i in range(36)],
+                              [layered() for i in range(36)])
+
+    def test_add(self):
+        chain = Chain(OrderedArp([1, None, [1, 2]])).add(10)
+        self.assertEquals([chain() for i in range(3)], [11, None, [11, 12]])
+        chain = Chain(OrderedArp([1, 2])).add(cycle([10, 20]).next)
+        self.assertEquals([chain() for i in range(4)], [11, 22, 11, 22])
+
+    def test_exhausts_values(self):
+        chain = Chain(OrderedArp([1, lambda: 2])).map(lambda v: v + 1)
+        self.assertEquals([chain() for i in range(4)], [2, 3, 2, 3])
+
+    def test_zip(self):
+        chain = Chain(OrderedArp([60, 64])).zip(cycle([100, 80]).next,
+                                                lambda: lambda: 12)
+        self.assertEquals([chain() for i in range(2)],
+                          [(60, 100, 12), (64, 80, 12)])
+
+    def test_choose(self):
+        chain = Chain(OrderedArp([1])).choose(lambda: 2, lambda: 3,
+                                              rng=random.Random(1234))
+        values = [chain() for i in range(300)]
+        self.assertEquals(set(values), set([1, 2, 3]))
+        chain = Chain(OrderedArp([1])).choose(lambda: 2,
+                                              rng=random.Random(1234))
+        again = Chain(OrderedArp([1])).choose(lambda: 2,
+                                              rng=random.Random(1234))
+        self.assertEquals([chain() for i in range(32)],
+                          [again() for i in range(32)])
+
+    def test_reset_and_switch(self):
+        chain = Chain(AscArp(), [3, 1, 2]).add(1).octave(1)
+        self.assertEquals([chain() for i in range(4)], [2, 3, 4, 14])
+        chain.reset([10, 20])
+        self.assertEquals(chain.values, [10, 20])
+        self.assertEquals([chain() for i in range(3)], [23, 21, 11])
+        chain.switch(DescArp())
+        self.assertEquals([chain() for i in range(4)], [33, 23, 21, 11])
+
+    def test_empty(self):
+        chain = Chain(AscArp(), []).add(1).octave()
+        self.assertEquals(chain(), None)
@@ -1,18 +1,29 @@
+import json
+from collections import deque
+
+from zope.interface.verify import verifyObject
+
 from twisted.trial.unittest import TestCase, SkipTest
 
 from bl.testlib import ClockRunner, TestReactor, TestInstrument
 from bl.scheduler import BeatClock, Meter, Tempo
+from bl.instrument.interfaces import IMIDIInstrument
 
 try:
-    import pypm
-    from bl.midi import PypmWrapper, init, getInput, getOutput
+    from bl import midi, virtualmidi
+    from bl.midi import pypm
+    from bl.midi import PypmWrapper, init, rescan, getInput, getOutput
+    from bl.midi import DeviceHandle
     from bl.midi import MidiHandler, MidiDispatcher
+    from bl.midi import ThreadedMidiDispatcher, TickStamper, MidiReader
     from bl.midi import NoteOnOffHandler, ChordHandler, NoteEventHandler
-    from bl.midi import ClockSender
-    from bl.midi import printDeviceSummary
+    from bl.midi import ClockSender, MidiOutInstrument
+    from bl.midi import printDeviceSummary, interestStatuses, buildRoutes
     from bl.midi import (NOTEON_CHAN1, NOTEON_CHAN2,
         NOTEOFF_CHAN1, NOTEOFF_CHAN2,
-        NOTEON_CHAN3, NOTEOFF_CHAN3)
+        NOTEON_CHAN3, NOTEOFF_CHAN3, TIMINGCLOCK, MTC_QFRAME,
+        START, STOP, CONTINUE, SONGPOSPOINTER, PROGRAMCHANGE_CHAN2,
+        CHANAFTERTOUCH_CHAN2)
     [pypm]
 except ImportError:
     pypm = None
@@ -57,6 +68,8 @@ class PypmWrapperTests(TestCase):
         outb = getOutput(entry[0])
         self.assert_(outa)
         self.assertIdentical(outa, outb)
+        self.assertEquals(outa.latency, 0)
+        self.assertRaises(ValueError, getOutput, entry[0], latency=10)
 
     def test_init_idempodency(self):
         inputa = getInput(0)
@@ -71,6 +84,142 @@ class PypmWrapperTests(TestCase):
         self.assert_(messages)
 
 
+class RescanTests(TestCase):
+
+    def setUp(self):
+        checkPypm()
+        self.patch(midi, 'pypm', virtualmidi)
+        self.patch(virtualmidi, '_devices', [])
+        self.patch(virtualmidi, '_ports', {})
+        self.patch(midi, '_runningClockSenders', set())
+        for (name, value) in [('initialized', False), ('inputs', []),
+                              ('outputs', []), ('deviceMap', {}),
+                              ('inputNames', {}), ('outputNames', {}),
+                              ('cachePath', None), ('_channels', {}),
+                              ('_listeners', [])]:
+            self.patch(PypmWrapper, name, value)
+        virtualmidi.addLoopback('a')
+        virtualmidi.addLoopback('b')
+        init()
+
+    def test_initialize(self):
+        self.assertEquals(PypmWrapper.inputs, [0, 2])
+        self.assertEquals(PypmWrapper.outputs, [1, 3])
+        self.assertEquals(PypmWrapper.deviceMap,
+                          {'a': {'input': 0, 'output': 1},
+                           'b': {'input': 2, 'output': 3}})
+
+    def test_rescan(self):
+        changes = []
+        PypmWrapper.addListener(lambda *a: changes.append(a))
+        inputB = getInput('b')
+        outputB = getOutput('b')
+        virtualmidi.removeLoopback('a')
+        virtualmidi.addLoopback('c')
+        self.assertEquals(rescan(), ([('input', 'c'), ('output', 'c')],
+                                     [('input', 'a'), ('output', 'a')]))
+        self.assertEquals(changes, [([('input', 'c'), ('output', 'c')],
+                                     [('input', 'a'), ('output', 'a')])])
+        self.assertEquals(PypmWrapper.inputs, [0, 2])
+        self.assertEquals(PypmWrapper.inputNames, {0: 'b', 2: 'c'})
+        # Renumbered devices are reopened
+        self.assertEquals((inputB.devno, outputB.devno), (0, 1))
+        outputB.Write([[[0x90, 60, 100], 0]])
+        self.assertEquals(inputB.Read(1)[0][0], [0x90, 60, 100, 0])
+        self.assertIdentical(getInput('b'), inputB)
+
+    def test_unplug_replug(self):
+        inputA = getInput('a')
+        virtualmidi.removeLoopback('a')
+        rescan()
+        self.failIf(inputA.connected)
+        self.assertEquals(inputA.Read(32), [])
+        self.failIf(inputA.Poll())
+        virtualmidi.addLoopback('a')
+        rescan()
+        self.assert_(inputA.connected)
+        self.assertEquals(inputA.devno, 2)
+        getOutput('a').Write([[[0x90, 60, 100], 0]])
+        self.assert_(inputA.Poll())
+
+    def test_reinitialize(self):
+        self.patch(virtualmidi, 'HOTPLUG', False)
+        virtualmidi.removeLoopback('b')
+        output = getOutput('a')
+        stream = output.stream
+        # Terminate drops the loopbacks; Initialize adds the default one
+        self.assertEquals(rescan(), ([('input', 'bl loopback'),
+                                      ('output', 'bl loopback')],
+                                     [('input', 'a'), ('input', 'b'),
+                                      ('output', 'a'), ('output', 'b')]))
+        self.failIf(output.connected)
+        self.assertNotIdentical(output.stream, stream)
+        output = getOutput('bl loopback')
+        stream = output.stream
+        rescan()
+        self.assert_(output.connected)
+        self.assertNotIdentical(output.stream, stream)
+
+    def test_output_latency(self):
+        output = getOutput('b', latency=5)
+        self.assertEquals(output.stream.latency, 5)
+        virtualmidi.removeLoopback('a')
+        rescan()
+        # Reopened on the new device number with the same latency
+        self.assertEquals(output.devno, 1)
+        self.assertEquals(output.stream.latency, 5)
+
+    def test_running_clock_sender(self):
+        self.patch(virtualmidi, 'HOTPLUG', False)
+        sender = object()
+        midi._runningClockSenders.add(sender)
+        self.assertRaises(RuntimeError, rescan)
+        self.assertEquals(PypmWrapper.inputs, [0, 2])
+        rescan(force=True)
+        self.assertEquals(PypmWrapper.inputs, [0])
+        midi._runningClockSenders.discard(sender)
+        rescan()
+        # Without reinitializing, nothing queued is lost
+        self.patch(virtualmidi, 'HOTPLUG', True)
+        midi._runningClockSenders.add(sender)
+        rescan()
+
+    def test_cache(self):
+        path = self.mktemp()
+        self.patch(PypmWrapper, 'cachePath', path)
+        rescan()
+        self.assertEquals(json.load(open(path)),
+                          {'count': 4,
+                           'devices': {'a': {'input': 0, 'output': 1},
+                                       'b': {'input': 2, 'output': 3}}})
+        # Initializing from the cache queries no devices
+        self.patch(PypmWrapper, 'initialized', False)
+        self.patch(PypmWrapper, 'deviceMap', {})
+        queried = []
+        getDeviceInfo = virtualmidi.GetDeviceInfo
+        def GetDeviceInfo(devno):
+            queried.append(devno)
+            return getDeviceInfo(devno)
+        self.patch(virtualmidi, 'GetDeviceInfo', GetDeviceInfo)
+        init()
+        self.failIf(queried)
+        self.assertEquals(PypmWrapper.outputNames, {1: 'a', 3: 'b'})
+        # A stale entry is found when the device is opened
+        virtualmidi.removeLoopback('a')
+        virtualmidi.addLoopback('a')
+        self.assertEquals(getInput('a').devno, 2)
+        self.assertEquals(json.load(open(path))['devices']['a'],
+                          {'input': 2, 'output': 3})
+
+    def test_bad_cache(self):
+        path = self.mktemp()
+        open(path, 'w').write('{"count": ')
+        self.patch(PypmWrapper, 'cachePath', path)
+        self.patch(PypmWrapper, 'initialized', False)
+        init()
+        self.assertEquals(PypmWrapper.inputs, [0, 2])
+
+
 class FakeMidiInput:
 
     def __init__(self):
@@ -126,6 +275,138 @@ class MidiDispatcherTests(TestCase, ClockRunner):
         self.runTicks(1)
         self.failIf(self.handler.events)
 
+    def test_routing(self):
+        self.midiin._buffer[:] = [[[TIMINGCLOCK, 0, 0, 0], 1],
+                                  [[NOTEON_CHAN2, 60, 100, 0], 2],
+                                  [[NOTEOFF_CHAN2, 60, 0, 0], 3]]
+        chords = []
+        chordHandler = ChordHandler(chords.append, channel=1)
+        messages = []
+        self.dispatcher.handlers.extend([chordHandler, messages.append])
+        routes = self.dispatcher.routes()
+        self.assertEquals(routes[TIMINGCLOCK], (messages.append,))
+        self.assertEquals(routes[NOTEON_CHAN1],
+                          (self.handler, chordHandler, messages.append))
+        self.assertEquals(routes[NOTEOFF_CHAN1],
+                          (chordHandler, messages.append))
+        self.assertEquals(routes[NOTEON_CHAN2],
+                          (self.handler, messages.append))
+        self.runTicks(97)
+        self.assertEquals(len(messages), 3)
+        self.assertEquals(self.handler.events, [('noteon', 2, 60, 100, 2)])
+        self.failIf(chords)
+        self.dispatcher.handlers.remove(messages.append)
+        self.assertEquals(self.dispatcher.routes()[TIMINGCLOCK], ())
+        chordHandler.channel = 2
+        self.assertEquals(self.dispatcher.routes()[NOTEON_CHAN2],
+                          (self.handler, chordHandler))
+        self.assertEquals(self.dispatcher.routes()[NOTEON_CHAN1],
+                          (self.handler,))
+
+
+class FakeMillis:
+
+    def __init__(self):
+        self.ms = 0
+
+    def Time(self):
+        return self.ms
+
+
+class TickStamperTests(TestCase, ClockRunner):
+
+    def setUp(self):
+        checkPypm()
+        self.time = FakeMillis()
+        self.patch(pypm, 'Time', self.time.Time)
+        # 120 bpm, 24 ticks per beat: 48 ticks per second
+        self.clock = BeatClock(Tempo(120), reactor=TestReactor())
+        self.stamper = TickStamper(self.clock)
+
+    def assertStamp(self, timestamp, expected):
+        (tick, subtick) = self.stamper.stamp(timestamp)
+        self.assertEquals(tick, expected[0])
+        self.assertAlmostEqual(subtick, expected[1])
+
+    def test_stamp(self):
+        self.assertStamp(0, (0, 0))
+        self.assertStamp(1000, (48, 0))
+        self.assertStamp(1010, (48, 0.48))
+
+    def test_anchor(self):
+        self.runTicks(48)
+        self.time.ms = 2000
+        self.stamper.anchor()
+        self.assertStamp(3000, (96, 0))
+        self.assertStamp(1990, (47, 0.52))
+
+
+class ThreadedMidiDispatcherTests(TestCase, ClockRunner):
+
+    def setUp(self):
+        checkPypm()
+        self.time = FakeMillis()
+        self.patch(pypm, 'Time', self.time.Time)
+        self.clock = BeatClock(Tempo(120), reactor=TestReactor())
+        self.midiin = FakeMidiInput()
+        self.midiin._buffer.extend([[NOTEON_CHAN1, i % 128, 100, 0], i * 10]
+                                    for i in range(3000))
+        self.handler = TestHandler()
+        self.dispatcher = ThreadedMidiDispatcher(self.midiin, [self.handler],
+                                                 clock=self.clock)
+
+    def test_delivers_everything_queued(self):
+        self.assertEquals(self.dispatcher.reader.read(), 3000)
+        self.assertEquals(self.dispatcher.queue[1][:2],
+                          [[NOTEON_CHAN1, 1, 100, 0], 10])
+        self.assertEquals(self.dispatcher.queue[-1][2][0], 1439)
+        self.dispatcher()
+        self.assertEquals(len(self.handler.events), 3000)
+        self.assertEquals(self.handler.events[-1],
+                          ('noteon', 1, 2999 % 128, 100, 29990))
+        self.failIf(self.dispatcher.queue)
+
+    def test_thru(self):
+        thru = TestHandler()
+        self.dispatcher.reader.thru = buildRoutes([thru])
+        self.dispatcher.reader.read()
+        # Thru handlers get everything as it is read ...
+        self.assertEquals(len(thru.events), 3000)
+        self.assertEquals(thru.events[1], ('noteon', 1, 1, 100, 10))
+        self.failIf(self.handler.events)
+        # ... and the handlers still get it on the tick
+        self.dispatcher()
+        self.assertEquals(len(self.handler.events), 3000)
+
+    def test_start_thru(self):
+        thru = TestHandler()
+        self.dispatcher.thru.append(thru)
+        self.dispatcher.start()
+        reader = self.dispatcher.reader
+        self.assertEquals(reader.thru[NOTEON_CHAN1], (thru,))
+        self.assertEquals(reader.thru[NOTEOFF_CHAN1], ())
+        self.dispatcher.stop()
+        reader.join(1)
+
+    def test_start_stop(self):
+        self.dispatcher.start()
+        reader = self.dispatcher.reader
+        for i in range(1000):
+            self.runTicks(1)
+            if len(self.handler.events) == 3000:
+                break
+            reader.join(0.01)
+        self.dispatcher.stop()
+        # stop() waits for the reader to finish
+        self.failIf(reader.isAlive())
+        self.assertNotIdentical(self.dispatcher.reader, reader)
+        self.assertEquals(len(self.handler.events), 3000)
+
+    def test_stop_not_started(self):
+        reader = self.dispatcher.reader
+        self.dispatcher.stop()
+        self.assertNotIdentical(self.dispatcher.reader, reader)
+
 
 class NoteOnOffHandlerTests(TestCase):
 
@@ -163,6 +444,85 @@ class NoteOnOffHandlerTests(TestCase):
         self.failIf(self.instr2.stops)
 
 
+class MidiHandlerTests(TestCase):
+
+    def setUp(self):
+        checkPypm()
+        self.handler = TestHandler()
+
+    def test_dispatch(self):
+        self.handler([[NOTEON_CHAN2, 60, 100, 0], 5])
+        self.handler([[NOTEON_CHAN3, 64, 90, 0], 6, (0, 0.5)])
+        self.assertEquals(self.handler.events,
+                          [('noteon', 2, 60, 100, 5), ('noteon', 3, 64, 90, 6)])
+
+    def test_unhandled(self):
+        for status in (NOTEOFF_CHAN1, TIMINGCLOCK, MTC_QFRAME, 0xF9, 0x3C):
+            self.handler([[status, 60, 100, 0], 1])
+        self.failIf(self.handler.events)
+
+
+class InterestsTests(TestCase):
+
+    def setUp(self):
+        checkPypm()
+
+    def test_interestStatuses(self):
+        self.assertEquals(interestStatuses([('noteon', 2), ('timingclock', 1)]),
+                          set([NOTEON_CHAN2, TIMINGCLOCK]))
+        self.assertEquals(interestStatuses([('noteoff', None)]),
+                          set(range(0x80, 0x90)))
+        self.assertEquals(interestStatuses([('noteon', 17)]), set())
+
+    def test_handler_interests(self):
+        handler = TestHandler()
+        self.assertEquals(handler.statuses(), range(0x90, 0xA0))
+        handler = TestHandler()
+        handler.interests = [('noteon', 3), ('noteoff', 3)]
+        self.assertEquals(handler.statuses(), [NOTEON_CHAN3])
+        handler([[NOTEON_CHAN2, 60, 100, 0], 1])
+        handler([[NOTEON_CHAN3, 64, 100, 0], 2])
+        self.assertEquals(handler.events, [('noteon', 3, 64, 100, 2)])
+
+    def test_system_interests(self):
+        handler = TestHandler()
+        handler.timingclock = lambda timestamp: handler.events.append(
+            ('timingclock', timestamp))
+        handler.songpospointer = lambda lsb, msb, timestamp: (
+            handler.events.append(('songpospointer', lsb, msb, timestamp)))
+        handler.interests = [('noteon', 1), ('timingclock', None),
+                             ('songpospointer', None)]
+        self.assertEquals(handler.statuses(),
+                          [NOTEON_CHAN1, SONGPOSPOINTER, TIMINGCLOCK])
+        handler([[TIMINGCLOCK, 0, 0, 0], 1])
+        handler([[SONGPOSPOINTER, 32, 1, 0], 2])
+        handler([[NOTEON_CHAN1, 60, 100, 0], 3])
+        self.assertEquals(handler.events, [
+            ('timingclock', 1), ('songpospointer', 32, 1, 2),
+            ('noteon', 1, 60, 100, 3)])
+
+    def test_program_change(self):
+        handler = TestHandler()
+        handler.programchange = lambda channel, program, timestamp: (
+            handler.events.append(('programchange', channel, program,
+                                   timestamp)))
+        handler.chanaftertouch = lambda channel, pressure, timestamp: (
+            handler.events.append(('chanaftertouch', channel, pressure,
+                                   timestamp)))
+        handler([[PROGRAMCHANGE_CHAN2, 5, 0, 0], 1])
+        handler([[CHANAFTERTOUCH_CHAN2, 90, 0, 0], 2])
+        self.assertEquals(handler.events, [('programchange', 2, 5, 1),
+                                           ('chanaftertouch', 2, 90, 2)])
+
+    def test_invalid_interests(self):
+        handler = TestHandler()
+        self.assertRaises(ValueError, setattr, handler, 'interests',
+                          [('start', None)])
+        self.assertRaises(ValueError, setattr, handler, 'interests',
+                          [('noteonn', 1)])
+        self.assertIdentical(handler.interests, None)
+
+
 class ChordHandlerTests(TestCase):
 
     def setUp(self):
@@ -196,6 +556,21 @@ class ChordHandlerTests(TestCase):
         self.handler.noteoff(1, 67, 120, 0)
         self.assertEquals(self.chords, [[64, 67], [67], []])
 
+    def test_channel(self):
+        self.handler = ChordHandler(self.callback, channel=2)
+        self.handler([[NOTEON_CHAN1, 60, 100, 0], 1])
+        self.handler([[NOTEON_CHAN2, 64, 100, 0], 2])
+        self.handler([[NOTEOFF_CHAN1, 64, 0, 0], 3])
+        self.assertEquals(self.chords, [[64]])
+        self.assertEquals(self.handler.statuses(),
+                          [NOTEOFF_CHAN2, NOTEON_CHAN2])
+        self.handler.channel = 3
+        self.assertEquals(self.handler.statuses(),
+                          [NOTEOFF_CHAN3, NOTEON_CHAN3])
+        self.handler([[NOTEON_CHAN2, 67, 100, 0], 4])
+        self.handler([[NOTEON_CHAN3, 60, 100, 0], 5])
+        self.assertEquals(self.chords, [[64], [64, 60]])
+
     def test_noteoff_with_sustain(self):
         self.handler.sustain = 1
         self.handler.noteon(1, 60, 120, 0)
@@ -234,7 +609,8 @@ class FakeTime:
         self.clock = clock
 
     def Time(self):
-        return self.clock.ticks
+        # Milliseconds at the clock's current tempo
+        return int(self.clock.ticks * 60000. / self.clock.tempo.tpm)
 
 
 class ClockSenderTests(TestCase, ClockRunner):
@@ -244,19 +620,181 @@ class ClockSenderTests(TestCase, ClockRunner):
         tempo = Tempo(120)
         self.clock = BeatClock(tempo, reactor=TestReactor())
         self.patch(pypm, 'Time', FakeTime(self.clock).Time)
+        self.patch(midi, '_runningClockSenders', set())
         self.midiout = FakeMidiOutput()
         self.clockSender = ClockSender(self.midiout, clock=self.clock)
         self.clockSender.start()
 
     def test_sends(self):
         self.runTicks(96)
-        self.assertEquals(self.midiout._buffer, [[[[250], 96]], [[[248], 96]]])
+        # START and two measures of pulses (24 per quarter note) timestamped
+        # from the anchor at 2000 at 120 bpm (20.83 ms per pulse)
+        self.assertEquals(len(self.midiout._buffer), 1)
+        self.assertEquals(midi._runningClockSenders, set([self.clockSender]))
+        events = self.midiout._buffer[0]
+        self.assertEquals(events[0], [[START], 2000])
+        pulses = events[1:]
+        self.assertEquals(len(pulses), 192)
+        self.assertEquals(pulses[:4], [[[TIMINGCLOCK], 2000],
+                                       [[TIMINGCLOCK], 2021],
+                                       [[TIMINGCLOCK], 2042],
+                                       [[TIMINGCLOCK], 2063]])
+        self.assertEquals(pulses[-1], [[TIMINGCLOCK], 2000 + 4000 - 21])
         self.midiout._buffer[:] = []
+        self.runTicks(95)
+        self.assertEquals(self.midiout._buffer, [])
         self.runTicks(1)
-        self.assertEquals(self.midiout._buffer, [[[[248], 97]]])
+        # One more measure, continuing from the same anchor
+        self.assertEquals(len(self.midiout._buffer), 1)
+        pulses = self.midiout._buffer[0]
+        self.assertEquals(len(pulses), 96)
+        self.assertEquals(pulses[0], [[TIMINGCLOCK], 2000 + 4000])
+        self.assertEquals(self.clockSender.pulses, 288)
+
+    def test_tempo_change(self):
+        self.runTicks(96)
+        self.clock.setTempo(Tempo(60))
+        self.runTicks(96)
+        pulses = self.midiout._buffer[-1]
+        # Re-anchored at the end of the pulses already sent
+        self.assertEquals(pulses[0], [[TIMINGCLOCK], 2000 + 4000])
+        self.assertEquals(pulses[1], [[TIMINGCLOCK], 2000 + 4000 + 42])
+        self.assertEquals(pulses[-1], [[TIMINGCLOCK], 2000 + 4000 + 3958])
+
+    def test_stop_resume(self):
+        self.runTicks(96)
+        self.clockSender.stop()
+        self.runTicks(96)
+        self.assertEquals(self.midiout._buffer[-1],
+                          [[[STOP], 2000 + 4000]])
+        self.assertFalse(self.clockSender.running)
+        self.failIf(midi._runningClockSenders)
+        self.assertEquals(self.clockSender.pulses, 192)
         self.midiout._buffer[:] = []
+        self.runTicks(192)
+        self.assertEquals(self.midiout._buffer, [])
+        self.clockSender.resume()
+        self.runTicks(96)
+        events = self.midiout._buffer[0]
+        # Song position is counted in sixteenth notes
+        self.assertEquals(events[0], [[SONGPOSPOINTER, 32, 0], 10000])
+        self.assertEquals(events[1], [[CONTINUE], 10000])
+        self.assertEquals(events[2], [[TIMINGCLOCK], 10000])
+        self.assertEquals(len(events), 194)
+        self.assertEquals(self.clockSender.pulses, 384)
+
+    def test_resume_before_stop_sent(self):
+        self.runTicks(96)
+        self.clockSender.stop()
+        self.clockSender.resume()
+        self.runTicks(192)
+        # No STOP, song position or duplicate pulses: just the next measures
+        self.assertEquals(len(self.midiout._buffer), 3)
+        pulses = self.midiout._buffer[0][1:]
+        for events in self.midiout._buffer[1:]:
+            pulses.extend(events)
+        self.assertEquals([event[0] for event in pulses],
+                          [[TIMINGCLOCK]] * 384)
+        times = [event[1] for event in pulses]
+        self.assertEquals(times, sorted(set(times)))
+        self.assertEquals(self.clockSender.pulses, 384)
+
+    def test_stop_start_within_lookahead(self):
+        self.runTicks(96)
+        self.clockSender.stop()
+        self.runTicks(48)
+        self.clockSender.start()
+        self.runTicks(48)
+        # The restart follows on from the pulses already queued and the STOP
+        self.assertEquals(len(self.midiout._buffer), 3)
+        self.assertEquals(self.midiout._buffer[1], [[[STOP], 2000 + 4000]])
+        events = self.midiout._buffer[2]
+        self.assertEquals(events[:2], [[[START], 2000 + 4000],
+                                       [[TIMINGCLOCK], 2000 + 4000]])
+        # Only enough pulses to fill the lookahead
+        self.assertEquals(len(events), 1 + 96)
+        self.assertEquals(self.clockSender.pulses, 96)
+        self.midiout._buffer[:] = []
+        self.runTicks(96)
+        self.assertEquals(self.midiout._buffer[0][0],
+                          [[TIMINGCLOCK], 2000 + 6000])
+
+    def test_restart(self):
+        self.runTicks(96)
+        self.clockSender.start()
+        self.runTicks(96)
+        events = self.midiout._buffer[-1]
+        # STOP and START after the pulses already queued
+        self.assertEquals(events[:3], [[[STOP], 2000 + 6000],
+                                       [[START], 2000 + 6000],
+                                       [[TIMINGCLOCK], 2000 + 6000]])
+        self.assertEquals(len(events), 2 + 96)
+        self.assertEquals(self.clockSender.pulses, 96)
+
+    def test_song_position_limit(self):
+        clockSender = ClockSender(self.midiout, clock=self.clock)
+        clockSender.pulses = 6 * 0x4000 + 12
+        self.clockSender.stop()
+        clockSender.resume()
+        self.runTicks(96)
+        events = [events for events in self.midiout._buffer
+                  if events[0][0][0] == SONGPOSPOINTER]
+        self.assertEquals(events[0][0][0], [SONGPOSPOINTER, 0x7F, 0x7F])
+
+
+class VirtualClockSenderTests(TestCase, ClockRunner):
+
+    def setUp(self):
+        checkPypm()
+        self.clock = BeatClock(Tempo(120), reactor=TestReactor())
+        self.patch(midi, 'pypm', virtualmidi)
+        self.patch(midi, '_runningClockSenders', set())
+        self.patch(virtualmidi, 'Time', FakeTime(self.clock).Time)
+        self.patch(virtualmidi, '_devices', [])
+        self.patch(virtualmidi, '_ports', {})
+        virtualmidi.Initialize()
+        self.midiin = virtualmidi.Input(0)
+
+    def read(self):
+        return [message[0][0] for message in self.midiin.Read(1024)]
+
+    def test_latency(self):
+        output = DeviceHandle('output', 1, latency=10)
+        clockSender = ClockSender(output, clock=self.clock)
+        self.assert_(clockSender.timestamped)
+        clockSender.start()
+        self.runTicks(96)
+        # Held by the output until due
+        self.assertEquals(self.read(), [])
+        self.runTicks(12)
+        self.assertEquals(self.read(), [START] + [TIMINGCLOCK] * 12)
         self.runTicks(1)
-        self.assertEquals(self.midiout._buffer, [[[[248], 98]]])
+        self.assertEquals(self.read(), [TIMINGCLOCK])
+
+    def test_no_latency(self):
+        output = DeviceHandle('output', 1)
+        clockSender = ClockSender(output, clock=self.clock)
+        self.failIf(clockSender.timestamped)
+        clockSender.start()
+        self.runTicks(96)
+        # Written on each tick instead of ahead
+        self.assertEquals(self.read(), [START, TIMINGCLOCK])
+        self.runTicks(1)
+        self.assertEquals(self.read(), [TIMINGCLOCK])
+        self.runTicks(23)
+        self.assertEquals(self.read(), [TIMINGCLOCK] * 23)
+        self.assertEquals(clockSender.pulses, 25)
+        clockSender.stop()
+        self.runTicks(1)
+        self.assertEquals(self.read(), [STOP])
+        self.failIf(clockSender.running)
+        self.runTicks(1)
+        self.assertEquals(self.read(), [])
+        clockSender.resume()
+        self.runTicks(70)
+        self.assertEquals(self.read(),
+                          [SONGPOSPOINTER, CONTINUE, TIMINGCLOCK])
+        self.assertEquals(clockSender.pulses, 26)
 
 
 class NoteEventHandlerTests(TestCase):
@@ -278,3 +816,83 @@ class NoteEventHandlerTests(TestCase):
         self.handler.noteoff(1, 60, 120, 0)
         self.assertEquals(self.events, [
                 ('noteon', 60, 120), ('noteon', 64, 100), ('noteoff', 60)])
+
+
+class MidiOutInstrumentTests(TestCase, ClockRunner):
+
+    def setUp(self):
+        checkPypm()
+        self.time = FakeMillis()
+        self.time.ms = 1000
+        self.patch(pypm, 'Time', self.time.Time)
+        self.clock = BeatClock(Tempo(120), reactor=TestReactor())
+        self.midiout = FakeMidiOutput()
+        self.instr = MidiOutInstrument(self.midiout, channel=2,
+                                       clock=self.clock, latency=20)
+
+    def flush(self):
+        scheduled = self.clock.reactor.scheduled
+        self.assertEquals(len(scheduled), 1)
+        (later, f, a, k) = scheduled.pop()
+        self.assertEquals(later, 0)
+        f(*a, **k)
+
+    def test_interface(self):
+        verifyObject(IMIDIInstrument, self.instr)
+
+    def test_buffers_tick(self):
+        self.instr.noteon(60, 100)
+        self.time.ms = 1005
+        self.instr.chordon([64, 67], 90)
+        self.instr.noteoff(None)
+        self.failIf(self.midiout._buffer)
+        self.flush()
+        self.assertEquals(self.midiout._buffer, [
+            [[[0x91, 60, 100], 1020], [[0x91, 64, 90], 1020],
+             [[0x91, 67, 90], 1020]]])
+        self.instr.chordoff([60, 64])
+        self.flush()
+        self.assertEquals(self.midiout._buffer[1],
+            [[[0x81, 60, 0], 1025], [[0x81, 64, 0], 1025]])
+
+    def test_controlChange_pitchBend(self):
+        self.instr.controlChange(pan=64, sustain=127, volume=100, foo=1)
+        self.instr.pitchBend(0)
+        self.instr.pitchBend(-8192)
+        self.instr.pitchBend(8191)
+        self.flush()
+        self.assertEquals([event[0] for event in self.midiout._buffer[0]], [
+            [0xB1, 10, 64], [0xB1, 64, 127], [0xB1, 7, 100],
+            [0xE1, 0, 64], [0xE1, 0, 0], [0xE1, 127, 127]])
+
+    def test_unbuffered(self):
+        self.instr.buffered = False
+        self.instr.noteon(60, 100)
+        self.instr.noteoff(60)
+        self.assertEquals(self.midiout._buffer, [
+            [[[0x91, 60, 100], 1020]], [[[0x81, 60, 0], 1020]]])
+        self.failIf(self.clock.reactor.scheduled)
+
+    def test_thru(self):
+        midiin = FakeMidiInput()
+        midiin._buffer.append([[NOTEON_CHAN2, 60, 100, 0], 0])
+        queue = deque()
+        reader = MidiReader(midiin, queue, TickStamper(self.clock),
+                            thru=buildRoutes([NoteOnOffHandler(
+                                {2: self.instr})]))
+        reader.start()
+        for i in range(1000):
+            if queue:
+                break
+            reader.join(0.01)
+        reader.stop()
+        reader.join(1)
+        # Played on the reader thread: written at once, not buffered
+        self.assertEquals(self.midiout._buffer, [[[[0x91, 60, 100], 1020]]])
+        self.failIf(self.clock.reactor.scheduled)
+
+    def test_large_flush(self):
+        self.instr.chordon(range(128) * 10, 100)
+        self.flush()
+        self.assertEquals([len(events) for events in self.midiout._buffer],
+                          [1024, 256])
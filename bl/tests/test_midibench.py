@@ -0,0 +1,40 @@
+from twisted.trial.unittest import TestCase, SkipTest
+
+from bl import virtualmidi
+
+try:
+    from bl import midi
+    from bl.midi import ChordHandler
+    from bl.midibench import notes, benchmarkDispatch, benchmarkLatency
+except ImportError:
+    midi = None
+
+
+class MidiBenchTests(TestCase):
+
+    def setUp(self):
+        if midi is None:
+            raise SkipTest('pypm not installed')
+        self.patch(midi, 'pypm', virtualmidi)
+        self.patch(virtualmidi, '_devices', [])
+        self.patch(virtualmidi, '_ports', {})
+
+    def test_notes(self):
+        self.assertEquals(notes(4, channel=2),
+                          [[[0x91, 36, 100], 0], [[0x81, 36, 0], 0],
+                           [[0x91, 37, 100], 0], [[0x81, 37, 0], 0]])
+
+    def test_benchmarkDispatch(self):
+        chords = []
+        rate = benchmarkDispatch(ChordHandler(chords.append), 100)
+        self.assert_(rate > 0)
+        self.assertEquals(len(chords), 100)
+        self.assertEquals(chords[:2], [[36], []])
+
+    def test_benchmarkLatency(self):
+        (mean, worst) = benchmarkLatency(10)
+        self.assert_(0 < mean <= worst)
+
+    def test_benchmarkLatency_thru(self):
+        (mean, worst) = benchmarkLatency(10, thru=True)
+        self.assert_(0 < mean <= worst)
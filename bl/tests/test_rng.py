@@ -0,0 +1,53 @@
+import random
+
+from twisted.trial.unittest import TestCase
+
+from bl.rng import RandomStreams, deriveSeed
+
+
+class RandomStreamsTests(TestCase):
+
+    def test_deriveSeed(self):
+        self.assertEquals(deriveSeed(1234, 'drums'), deriveSeed(1234, 'drums'))
+        self.assertNotEquals(deriveSeed(1234, 'drums'),
+                             deriveSeed(1234, 'bass'))
+        self.assertNotEquals(deriveSeed(1234, 'drums'),
+                             deriveSeed(4321, 'drums'))
+
+    def test_streams_are_reproducible(self):
+        a = RandomStreams(1234)
+        b = RandomStreams(1234)
+        draws_a = [a.stream('drums').random() for i in range(8)]
+        # Creating other streams does not disturb the drums stream
+        b.stream('bass').random()
+        draws_b = [b.stream('drums').random() for i in range(8)]
+        self.assertEquals(draws_a, draws_b)
+
+    def test_stream_identity(self):
+        streams = RandomStreams(1234)
+        self.assertIdentical(streams.stream('drums'), streams.stream('drums'))
+        self.failUnless(isinstance(streams.stream('drums'), random.Random))
+
+    def test_seeds(self):
+        streams = RandomStreams(1234)
+        self.assertEquals(streams.seeds(), {})
+        streams.stream('drums')
+        streams.stream('bass')
+        self.assertEquals(streams.seeds(),
+                          {'drums': deriveSeed(1234, 'drums'),
+                           'bass': deriveSeed(1234, 'bass')})
+
+    def test_reset(self):
+        streams = RandomStreams(1234)
+        drums = streams.stream('drums')
+        first = [drums.random() for i in range(4)]
+        streams.reset(1234)
+        self.assertEquals([drums.random() for i in range(4)], first)
+        streams.reset(99)
+        self.assertEquals(streams.seed, 99)
+        self.assertEquals(streams.seeds(), {'drums': deriveSeed(99, 'drums')})
+        self.assertNotEquals([drums.random() for i in range(4)], first)
+
+    def test_random_session_seed(self):
+        streams = RandomStreams()
+        self.failIf(streams.seed is None)
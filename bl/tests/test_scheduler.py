@@ -179,6 +179,17 @@ class ClockTests(TestCase, ClockRunner):
                     (120, 'f1'), (144, 'f1'), (168, 'f1')]
         self.assertEquals(called, expected)
 
+    def test_rng(self):
+        clock = BeatClock(Tempo(120), reactor=TestReactor(), seed=1234)
+        other = BeatClock(Tempo(120), reactor=TestReactor(), seed=1234)
+        self.assertIdentical(clock.rng('drums'), clock.rng('drums'))
+        self.assertEquals([clock.rng('drums').random() for i in range(4)],
+                          [other.rng('drums').random() for i in range(4)])
+        clock.rng('bass')
+        seeds = clock.seeds()
+        self.assertEquals(seeds['session'], 1234)
+        self.assertEquals(sorted(seeds['streams']), ['bass', 'drums'])
+
     def test_setTempo(self):
         self.clock.setTempo(Tempo(60))
         interval_before = 60. / self.clock.tempo.tpm
@@ -0,0 +1,238 @@
+import struct
+
+from twisted.trial.unittest import TestCase, SkipTest
+
+from bl.scheduler import BeatClock, Tempo, Meter
+from bl.testlib import ClockRunner, TestReactor, TestInstrument
+from bl.recorder import LoopRecorder
+from bl.smf import SMFWriter, varlen, loadSMF, SMFPlayer, numpy
+
+
+class FakeInstrument(object):
+
+    def __init__(self, channel, sfpath):
+        self.channel = channel
+        self.sfpath = sfpath
+
+
+def readChunks(path):
+    data = open(path, 'rb').read()
+    chunks = []
+    while data:
+        (kind, length) = struct.unpack('>4sL', data[:8])
+        chunks.append((kind, data[8:8 + length]))
+        data = data[8 + length:]
+    return chunks
+
+
+class VarlenTests(TestCase):
+
+    def test_varlen(self):
+        self.assertEquals(varlen(0), bytearray([0]))
+        self.assertEquals(varlen(0x7F), bytearray([0x7F]))
+        self.assertEquals(varlen(0x80), bytearray([0x81, 0]))
+        self.assertEquals(varlen(0x3FFF), bytearray([0xFF, 0x7F]))
+        self.assertEquals(varlen(0x200000), bytearray([0x81, 0x80, 0x80, 0]))
+
+
+class SMFWriterTests(TestCase, ClockRunner):
+
+    def setUp(self):
+        self.clock = BeatClock(Tempo(120), reactor=TestReactor())
+        self.runTicks(10)
+        self.path = self.mktemp()
+
+    def test_write(self):
+        writer = SMFWriter(self.path, self.clock)
+        piano = FakeInstrument(2, '/sf2/piano.sf2')
+        writer(piano, 'noteon', note=60, velocity=100)
+        self.runTicks(24)
+        writer(piano, 'noteon', note=None, velocity=100)
+        writer(piano, 'noteoff', note=60)
+        writer(piano, 'controlChange', pan=64, sustain=None, ignored={})
+        self.runTicks(200)
+        writer(piano, 'pitchBend', value=0)
+        writer.close()
+        chunks = readChunks(self.path)
+        self.assertEquals([kind for (kind, data) in chunks],
+                          ['MThd', 'MTrk', 'MTrk'])
+        self.assertEquals(struct.unpack('>HHH', chunks[0][1]), (1, 2, 24))
+        self.assertEquals(chunks[1][1],
+            '\x00\xff\x58\x04\x04\x02\x18\x08'
+            '\x00\xff\x51\x03\x07\xa1\x20'
+            '\x00\xff\x2f\x00')
+        self.assertEquals(chunks[2][1],
+            '\x00\xff\x03\x09piano.sf2'
+            '\x00\x92\x3c\x64'
+            '\x18\x82\x3c\x00'
+            '\x00\xb2\x0a\x40'
+            '\x81\x48\xe2\x00\x40'
+            '\x00\xff\x2f\x00')
+
+    def test_time_signature(self):
+        tempo = Tempo(120, 96)
+        clock = BeatClock(tempo, meter=Meter(6, 8, tempo=tempo),
+                          reactor=TestReactor())
+        SMFWriter(self.path, clock).close()
+        chunks = readChunks(self.path)
+        # 12 MIDI clocks (an eighth note) per metronome click
+        self.assertEquals(chunks[1][1][:8],
+                          '\x00\xff\x58\x04\x06\x03\x0c\x08')
+
+    def test_clamp_values(self):
+        writer = SMFWriter(self.path, self.clock)
+        piano = FakeInstrument(0, 'piano')
+        writer(piano, 'noteon', note=130, velocity=200)
+        writer(piano, 'noteon', note=-1, velocity=300)
+        writer(piano, 'noteoff', note=128)
+        writer(piano, 'controlChange', pan=128, sustain=-5)
+        writer(piano, 'pitchBend', value=9000)
+        writer(piano, 'pitchBend', value=-9000)
+        writer.close()
+        chunks = readChunks(self.path)
+        self.assertEquals(chunks[2][1],
+            '\x00\xff\x03\x05piano'
+            '\x00\x90\x7f\x7f'
+            '\x00\x00\x7f'
+            '\x00\x80\x7f\x00'
+            '\x00\xb0\x0a\x7f'
+            '\x00\x40\x00'
+            '\x00\xe0\x7f\x7f'
+            '\x00\x00\x00'
+            '\x00\xff\x2f\x00')
+
+    def test_tracks_and_tempo(self):
+        writer = SMFWriter(self.path, self.clock, bufferSize=4)
+        a = FakeInstrument(None, 'a')
+        b = FakeInstrument(None, 'b')
+        for i in range(100):
+            writer(a, 'noteon', note=60, velocity=100)
+            writer(b, 'noteon', note=64, velocity=100)
+            self.runTicks(1)
+        self.clock.tempo = Tempo(60)
+        writer(a, 'noteoff', note=60)
+        writer.close()
+        chunks = readChunks(self.path)
+        self.assertEquals(len(chunks), 4)
+        self.assertEquals(chunks[1][1][-11:],
+                          '\x64\xff\x51\x03\x0f\x42\x40\x00\xff\x2f\x00')
+        # Running status after the first note
+        self.assertEquals(chunks[2][1][5:13],
+                          '\x00\x90\x3c\x64\x01\x3c\x64\x01')
+        self.assertEquals(chunks[3][1][5:9], '\x00\x91\x40\x64')
+        self.assertEquals(len(chunks[2][1]), 5 + 4 + 99 * 3 + 4 + 4)
+        self.assertRaises(ValueError, writer, a, 'noteoff', note=60)
+
+    def test_loop_recorder(self):
+        writer = SMFWriter(self.path, self.clock)
+        loopRecorder = LoopRecorder(1, self.clock)
+        loopRecorder.recorder = writer
+        loopRecorder.record([[0x90, 60, 100, 0], 1234])
+        loopRecorder.record('not midi')
+        self.runTicks(1)
+        loopRecorder.record([0xC0, 5, 0])
+        writer.close()
+        self.assertEquals(loopRecorder.latch(), None)
+        chunks = readChunks(self.path)
+        self.assertEquals(chunks[2][1],
+            '\x00\xff\x03\x0cLoopRecorder'
+            '\x00\x90\x3c\x64\x01\xc0\x05\x00\xff\x2f\x00')
+
+
+class SMFPlayerTests(TestCase, ClockRunner):
+
+    def setUp(self):
+        if numpy is None:
+            raise SkipTest('numpy not installed')
+        self.clock = BeatClock(Tempo(120), reactor=TestReactor())
+        self.path = self.mktemp()
+        writer = SMFWriter(self.path, self.clock)
+        piano = FakeInstrument(0, 'piano')
+        bass = FakeInstrument(1, 'bass')
+        for i in range(16):
+            writer(piano, 'noteon', note=60 + i, velocity=100)
+            if not i % 4:
+                writer(bass, 'noteon', note=36 + i, velocity=90)
+            self.runTicks(6)
+            writer(piano, 'noteoff', note=60 + i)
+            if i % 4 == 3:
+                writer(bass, 'noteoff', note=36 + i - 3)
+            self.runTicks(6)
+        writer(piano, 'controlChange', pan=10)
+        writer(piano, 'pitchBend', value=-100)
+        writer.close()
+        self.clock = BeatClock(Tempo(120), reactor=TestReactor())
+        self.piano = TestInstrument(self.clock)
+        self.bass = TestInstrument(self.clock)
+
+    def test_load(self):
+        smf = loadSMF(self.path)
+        self.assertEquals((smf.format, smf.division), (1, 24))
+        self.assertEquals(smf.tempos, [(0, 120.0)])
+        self.assertEquals([track.name for track in smf.tracks],
+                          [None, 'piano', 'bass'])
+        piano = smf.tracks[1]
+        self.assertEquals(len(piano), 34)
+        self.assertEquals(list(piano.ticks[:4]), [0, 6, 12, 18])
+        self.assertEquals(list(piano.status[:2]), [0x90, 0x80])
+        self.assertEquals(list(piano.data1[-2:]), [10, 0x1C])
+        self.assertEquals(list(piano.data2[-2:]), [10, 0x3F])
+        self.assertEquals(list(smf.tracks[2].status[:2]), [0x91, 0x81])
+
+    def test_parse_messages(self):
+        track = ('\x00\xff\x03\x01t'
+                 '\x00\xf0\x03\x7e\x7f\xf7'
+                 '\x00\xc0\x05'
+                 '\x81\x00\x90\x3c\x40'
+                 '\x00\x3c\x00'
+                 '\x00\xff\x51\x03\x0f\x42\x40'
+                 '\x00\xff\x2f\x00')
+        fd = open(self.path, 'wb')
+        fd.write(struct.pack('>4sLHHH', 'MThd', 6, 0, 1, 96))
+        fd.write(struct.pack('>4sL', 'MTrk', len(track)) + track)
+        fd.close()
+        smf = loadSMF(self.path)
+        (track,) = smf.tracks
+        self.assertEquals(track.name, 't')
+        self.assertEquals(list(track.ticks), [0, 128, 128])
+        self.assertEquals(list(track.status), [0xC0, 0x90, 0x90])
+        self.assertEquals(list(track.data1), [5, 60, 60])
+        self.assertEquals(list(track.data2), [0, 64, 0])
+        self.assertEquals(smf.tempos, [(128, 60.0)])
+
+    def test_play(self):
+        player = SMFPlayer(loadSMF(self.path), {1: self.piano, 2: self.bass},
+                           self.clock)
+        self.assertEquals(player.length, 192)
+        self.runTicks(1)
+        player.resumePlaying()
+        self.runTicks(95 + 24)
+        self.assertEquals(self.piano.plays[:2],
+            [('note', 96, 60, 100), ('note', 108, 61, 100)])
+        self.assertEquals(self.piano.stops[:1], [('note', 102, 60)])
+        self.assertEquals(self.bass.plays, [('note', 96, 36, 90)])
+        self.runTicks(168)
+        self.assertEquals(len(self.piano.plays), 16)
+        self.assertEquals(len(self.bass.stops), 4)
+        self.assertEquals(self.piano.cc, [(288, {'pan': 10})])
+        self.assertEquals(self.piano.bends, [(288, -100)])
+
+    def test_seek_and_pause(self):
+        player = SMFPlayer(loadSMF(self.path), self.piano, self.clock)
+        player.seek(120)
+        player.play()
+        self.assertEquals(self.piano.plays, [('note', 0, 70, 100)])
+        self.runTicks(3)
+        player.pause()
+        self.assertEquals(self.piano.stops, [('note', 3, 70)])
+        self.assertEquals(player.position, 123)
+        self.runTicks(10)
+        self.assertEquals(len(self.piano.plays), 1)
+        player.play()
+        self.runTicks(9)
+        self.assertEquals(self.piano.plays[1:], [('note', 22, 71, 100)])
+        player.seek(0)
+        self.assertEquals(self.piano.stops[1:],
+                          [('note', 16, 70), ('note', 22, 71)])
+        self.assertEquals(self.piano.plays[2:],
+                          [('note', 22, 60, 100), ('note', 22, 36, 90)])
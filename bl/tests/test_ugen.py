@@ -2,8 +2,9 @@ import random
 
 from twisted.trial.unittest import TestCase
 
+from bl.rng import RandomStreams
 from bl.ugen import (N, R, Random, RandomPhrase, RP, RandomWalk, RW, Weight, W,
-                     C, Cycle, O, Oscillate)
+                     C, Cycle, O, Oscillate, Markov)
 
 
 class UGensTestCase(TestCase):
@@ -71,5 +72,109 @@ class UGensTestCase(TestCase):
         self.assertIdentical(W, Weight)
         a = W((60, 10), (64, 1), (67, 2), (69, 1))
         results = [a() for i in range(15)]
-        self.assertEqual(results, [60, 60, 60, 60, 67, 60, 60, 67, 60, 60, 69,
-                                   64, 60, 64, 60])
+        self.assertEqual(results, [60, 69, 60, 64, 67, 60, 69, 64, 60, 67, 60,
+                                   67, 64, 69, 67])
+
+    def test_Weight_distribution(self):
+        a = W((60, 7000), (64, 2000), (67, 1000))
+        counts = {60: 0, 64: 0, 67: 0}
+        for i in range(10000):
+            counts[a()] += 1
+        self.assertApproximates(counts[60], 7000, 300)
+        self.assertApproximates(counts[64], 2000, 300)
+        self.assertApproximates(counts[67], 1000, 300)
+
+    def test_Weight_reweight(self):
+        a = W((60, 1), (64, 1))
+        self.assertEqual(a.weights, [(60, 1), (64, 1)])
+        a.reweight(60, 0)
+        self.assertEqual(set(a() for i in range(32)), set([64]))
+        a.update((64, 0), (67, 2.5))
+        self.assertEqual(a.weights, [(60, 0), (64, 0), (67, 2.5)])
+        self.assertEqual(set(a() for i in range(32)), set([67]))
+        a.reweight(67, 0)
+        self.assertEqual(a(), None)
+        self.assertRaises(ValueError, a.reweight, 60, -1)
+
+    def test_rng_streams(self):
+        """
+        Random ugens draw from the given rng instead of the global random
+        module: the same stream seed yields the same results.
+        """
+        def render(seed):
+            streams = RandomStreams(seed)
+            r = R(1, 2, 3, 4, 5, rng=streams.stream('r'))
+            p = RP([[1, 2], [3, 4]], rng=streams.stream('p'))
+            walk = RW([1, 2, 3, 4, 5], rng=streams.stream('walk'))
+            w = W((60, 10), (64, 1), (67, 2), rng=streams.stream('w'))
+            return [(r(), p(), walk(), w()) for i in range(32)]
+
+        first = render(1234)
+        random.seed(99)
+        self.assertEquals(render(1234), first)
+        self.assertNotEquals(render(4321), first)
+
+
+class MarkovTestCase(TestCase):
+
+    def setUp(self):
+        random.seed(0)
+
+    def test_deterministic_chain(self):
+        m = Markov(1)
+        m.train([1, 2, 3, 1, 2, 3])
+        self.assertEquals(m.states, 3)
+        first = m()
+        results = [first] + [m() for i in range(8)]
+        expected = {1: 2, 2: 3, 3: 1}
+        for (a, b) in zip(results, results[1:]):
+            self.assertEquals(b, expected[a])
+
+    def test_order(self):
+        m = Markov(2)
+        m.train([1, 1, 2, 1, 1, 2, 1, 1, 2])
+        self.assertEquals(m.states, 3)
+        self.assertEquals(sorted(m._transitions), [(1, 1), (1, 2), (2, 1)])
+        self.assertEquals(m._transitions[(1, 1)].symbols, [2])
+
+    def test_probabilities(self):
+        m = Markov(1)
+        m.train([0, 1] * 3 + [0, 2])
+        entry = m._transitions[(0,)]
+        counts = {1: 0, 2: 0}
+        for i in range(4000):
+            counts[entry.sample(random)] += 1
+        self.assertApproximates(counts[1], 3000, 200)
+        self.assertApproximates(counts[2], 1000, 200)
+
+    def test_incremental_training(self):
+        m = Markov(1)
+        self.assertEquals(m(), None)
+        m.train([1, 2])
+        self.assertEquals([m() for i in range(4)], [2, 2, 2, 2])
+        m.train([2, 3, 1])
+        self.assertEquals(set(m() for i in range(64)), set([1, 2, 3]))
+
+    def test_chords(self):
+        m = Markov(1)
+        m.train([[60, 64], [62, 65]])
+        self.assertEquals(m(), (62, 65))
+
+    def test_pruning(self):
+        m = Markov(1, maxStates=8)
+        m.train(range(4) * 10)
+        m.train(range(100, 110))
+        self.assertEquals(m.states, 6)
+        for state in [(0,), (1,), (2,), (3,)]:
+            self.assert_(state in m._transitions)
+
+    def test_training_sources(self):
+        m = Markov(1)
+        m.trainPhrase([(0, 60, 100, 12), (24, 64, 100, 12)])
+        m.trainRecording([(0, 'noteon', {'note': 64, 'velocity': 100}),
+                          (12, 'noteoff', {'note': 64}),
+                          (24, 'noteon', {'note': 67, 'velocity': 100})])
+        m.trainLoop([(67, 0), (60, 24)])
+        self.assertEquals(m._transitions[(60,)].symbols, [64])
+        self.assertEquals(m._transitions[(64,)].symbols, [67])
+        self.assertEquals(m._transitions[(67,)].symbols, [60])
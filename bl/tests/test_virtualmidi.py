@@ -0,0 +1,82 @@
+from twisted.trial.unittest import TestCase, SkipTest
+
+from bl import virtualmidi
+
+try:
+    from bl.midi import MidiDispatcher, ChordHandler
+except ImportError:
+    MidiDispatcher = None
+
+
+class FakeMillis:
+
+    def __init__(self):
+        self.ms = 0
+
+    def Time(self):
+        return self.ms
+
+
+class VirtualMidiTests(TestCase):
+
+    def setUp(self):
+        self.time = FakeMillis()
+        self.patch(virtualmidi, 'Time', self.time.Time)
+        self.patch(virtualmidi, '_devices', [])
+        self.patch(virtualmidi, '_ports', {})
+        virtualmidi.Initialize()
+
+    def test_initialize(self):
+        self.assertEquals(virtualmidi.CountDevices(), 2)
+        self.assertEquals(virtualmidi.GetDeviceInfo(0),
+                          ('virtual', 'bl loopback', 1, 0, 0))
+        self.assertEquals(virtualmidi.GetDeviceInfo(1),
+                          ('virtual', 'bl loopback', 0, 1, 0))
+        self.assertIdentical(virtualmidi.GetDeviceInfo(2), None)
+        virtualmidi.Initialize()
+        self.assertEquals(virtualmidi.CountDevices(), 2)
+
+    def test_addLoopback(self):
+        self.assertEquals(virtualmidi.addLoopback('other'), (2, 3))
+        self.assertRaises(ValueError, virtualmidi.addLoopback, 'other')
+        self.assertRaises(ValueError, virtualmidi.Input, 3)
+        self.assertRaises(ValueError, virtualmidi.Output, 2)
+        virtualmidi.Output(3).Write([[[0x90, 60, 100], 0]])
+        self.assertEquals(virtualmidi.Input(0).Read(32), [])
+        self.assertEquals(virtualmidi.Input(2).Read(32),
+                          [[[0x90, 60, 100, 0], 0]])
+
+    def test_loopback(self):
+        midiIn = virtualmidi.Input(0)
+        midiOut = virtualmidi.Output(1)
+        self.assertFalse(midiIn.Poll())
+        self.time.ms = 10
+        midiOut.Write([[[0x90, 60, 100], 0], [[0xF8], 5],
+                       [[0x80, 60, 0], 0]])
+        self.assertTrue(midiIn.Poll())
+        self.assertEquals(midiIn.Read(2), [[[0x90, 60, 100, 0], 10],
+                                           [[0xF8, 0, 0, 0], 10]])
+        self.assertEquals(midiIn.Read(2), [[[0x80, 60, 0, 0], 10]])
+        self.assertFalse(midiIn.Poll())
+
+    def test_latency(self):
+        midiIn = virtualmidi.Input(0)
+        midiOut = virtualmidi.Output(1, latency=5)
+        midiOut.Write([[[0x90, 64, 100], 10], [[0x90, 60, 100], 0]])
+        self.assertEquals(midiIn.Read(32), [])
+        self.time.ms = 5
+        self.assertEquals(midiIn.Read(32), [[[0x90, 60, 100, 0], 5]])
+        self.time.ms = 20
+        self.assertEquals(midiIn.Read(32), [[[0x90, 64, 100, 0], 15]])
+
+    def test_dispatch(self):
+        if MidiDispatcher is None:
+            raise SkipTest('pypm not installed')
+        chords = []
+        dispatcher = MidiDispatcher(virtualmidi.Input(0),
+                                    [ChordHandler(chords.append)])
+        virtualmidi.Output(1).Write([[[0x90, 60, 100], 0],
+                                     [[0x90, 64, 100], 0],
+                                     [[0x80, 60, 0], 0]])
+        dispatcher()
+        self.assertEquals(chords, [[60], [60, 64], [64]])
@@ -1,9 +1,11 @@
 import random
+from array import array
+from bisect import bisect_right
 from itertools import cycle
 
 
 __all__ = ['N', 'Cycle', 'C', 'Random', 'R', 'RandomPhrase', 'RP',
-           'RandomWalk', 'RW', 'W', 'Weight', 'Oscillate', 'O']
+           'RandomWalk', 'RW', 'W', 'Weight', 'Oscillate', 'O', 'Markov']
 
 
 class _Nothing(object):
@@ -55,36 +57,37 @@ def Oscillate(*c):
 O = Oscillate
 
 
-def Random(*c):
-    return _sample(random.choice, c)
+def Random(*c, **kw):
+    rng = kw.get('rng') or random
+    return _sample(rng.choice, c)
 
 
 R = Random
 
 
-def _randomPhraseGen(phrases):
+def _randomPhraseGen(phrases, rng):
     while 1:
-        phrase = random.choice(phrases)
+        phrase = rng.choice(phrases)
         for next in phrase:
             yield next
 
 
-def RandomPhrase(phrases=(), length=None):
+def RandomPhrase(phrases=(), length=None, rng=None):
     if length is not None:
         for phrase in phrases:
             if len(phrase) != length:
                 raise ValueError('Phrase %s is not of specified length: %s' %
                                 (phrase, length))
-    return _randomPhraseGen(phrases).next
+    return _randomPhraseGen(phrases, rng or random).next
 
 
 RP = RandomPhrase
 
 
-def _randomWalk(sounds, startIndex=None):
+def _randomWalk(sounds, startIndex, rng):
     ct = len(sounds)
     if startIndex is None:
-        index = random.randint(0, ct - 1)
+        index = rng.randint(0, ct - 1)
     else:
         index = startIndex
     direction = 1
@@ -95,29 +98,235 @@ def _randomWalk(sounds, startIndex=None):
         elif index == ct - 1:
             direction = -1
         else:
-            if random.randint(0, 1):
+            if rng.randint(0, 1):
                 direction *= -1
         index += direction
 
 
-def RandomWalk(sounds, startIndex=None):
-    return _randomWalk(sounds, startIndex).next
+def RandomWalk(sounds, startIndex=None, rng=None):
+    return _randomWalk(sounds, startIndex, rng or random).next
 
 
 RW = RandomWalk
 
 
-def _weighted(*notes):
-    ws = []
-    for (note, weight) in notes:
-        ws.extend([note for w in range(weight)])
-    random.shuffle(ws)
-    return ws
+class Weight(object):
+    """
+    Choose randomly from notes given with weights as C{(note, weight)} pairs.
+
+    Draws use Vose's alias method: constant time regardless of the weights,
+    with the alias table rebuilt in linear time (lazily, on the next draw)
+    after weights are changed with L{reweight} or L{update}. An alternate
+    random number stream may be given with the keyword argument C{rng}.
+
+    Example:
+
+        >>> w = W((60, 10), (64, 1), (67, 2), (69, 1))
+        >>> w.reweight(64, 5)
+        >>> w.update((60, 0), (72, 3))
+    """
+
+    def __init__(self, *weights, **kw):
+        self.rng = kw.get('rng') or random
+        self._notes = []
+        self._weights = []
+        self.update(*weights)
+
+    @property
+    def weights(self):
+        return zip(self._notes, self._weights)
+
+    def reweight(self, note, weight):
+        """
+        Set the weight for C{note}, adding C{note} if it is new.
+        """
+        if weight < 0:
+            raise ValueError('Negative weight for %s: %s' % (note, weight))
+        try:
+            self._weights[self._notes.index(note)] = weight
+        except ValueError:
+            self._notes.append(note)
+            self._weights.append(weight)
+        self._table = None
+
+    def update(self, *weights):
+        """
+        Set weights for several notes given as C{(note, weight)} pairs.
+        """
+        for (note, weight) in weights:
+            self.reweight(note, weight)
+
+    def _build(self):
+        count = len(self._weights)
+        total = float(sum(self._weights))
+        if not total:
+            return ()
+        scaled = [w * count / total for w in self._weights]
+        prob = [1.0] * count
+        alias = range(count)
+        small = [i for (i, p) in enumerate(scaled) if p < 1]
+        large = [i for (i, p) in enumerate(scaled) if p >= 1]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] = (scaled[l] + scaled[s]) - 1
+            if scaled[l] < 1:
+                small.append(l)
+            else:
+                large.append(l)
+        return (count, prob, alias)
 
-
-def Weight(*weights):
-    ws = _weighted(*weights)
-    return R(*ws)
+    def __call__(self):
+        if self._table is None:
+            self._table = self._build()
+        if not self._table:
+            return
+        count, prob, alias = self._table
+        u = self.rng.random() * count
+        index = int(u)
+        if u - index >= prob[index]:
+            index = alias[index]
+        return self._notes[index]
 
 
 W = Weight
+
+
+class _Transitions(object):
+    """
+    Sparse transition counts out of one state, with a cumulative
+    distribution rebuilt lazily after training.
+    """
+    __slots__ = ('symbols', 'counts', 'cumulative', 'index')
+
+    def __init__(self):
+        self.symbols = []
+        self.counts = array('l')
+        self.cumulative = None
+        self.index = {}
+
+    @property
+    def total(self):
+        return sum(self.counts)
+
+    def add(self, symbol):
+        i = self.index.get(symbol)
+        if i is None:
+            self.index[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+            self.counts.append(1)
+        else:
+            self.counts[i] += 1
+        self.cumulative = None
+
+    def sample(self, rng):
+        if self.cumulative is None:
+            self.cumulative = cumulative = array('l')
+            total = 0
+            for count in self.counts:
+                total += count
+                cumulative.append(total)
+        cumulative = self.cumulative
+        return self.symbols[bisect_right(cumulative,
+                                         rng.random() * cumulative[-1])]
+
+
+class Markov(object):
+    """
+    A Markov chain ugen of order C{order}: each value is chosen based on the
+    C{order} values before it, with the probabilities of the sequences it was
+    trained on. Training may continue while the ugen is played.
+
+    If C{maxStates} is given, the rarest states (those seen least during
+    training) are pruned whenever there are more than C{maxStates}, leaving
+    three quarters of C{maxStates}. When the chain reaches a state with no
+    transitions it restarts from a random known state. An alternate random
+    number stream may be given as C{rng}.
+
+    Example:
+
+        >>> m = Markov(2)
+        >>> m.train([60, 62, 64, 62, 60, 62, 64, 65, 64, 62])
+        >>> m.trainPhrase(phraseRecorder.phrase)
+        >>> player = Player(piano, m, interval=(1, 8))
+    """
+
+    def __init__(self, order=1, maxStates=None, rng=None):
+        self.order = order
+        self.maxStates = maxStates
+        self.rng = rng or random
+        self._transitions = {}
+        self._state = None
+
+    @property
+    def states(self):
+        return len(self._transitions)
+
+    def train(self, sequence):
+        """
+        Train on C{sequence}, an iterable of values. Lists are converted to
+        tuples so chords may be used as values.
+        """
+        order = self.order
+        transitions = self._transitions
+        history = ()
+        for value in sequence:
+            if type(value) is list:
+                value = tuple(value)
+            if len(history) == order:
+                entry = transitions.get(history)
+                if entry is None:
+                    entry = transitions[history] = _Transitions()
+                entry.add(value)
+                history = history[1:]
+            history += (value,)
+        if self.maxStates is not None and len(transitions) > self.maxStates:
+            self.prune(self.maxStates * 3 // 4)
+
+    def trainPhrase(self, phrase):
+        """
+        Train on the notes of a phrase from L{bl.arp.PhraseRecordingArp}: a
+        sequence of C{(when, note, velocity, sustain)} tuples.
+        """
+        self.train(note for (when, note, velocity, sustain) in phrase)
+
+    def trainRecording(self, events):
+        """
+        Train on the notes played in a recording from
+        L{bl.instrument.fsynth.Recorder}: a sequence of
+        C{(ticks, command, arguments)} tuples.
+        """
+        self.train(arguments['note'] for (ticks, command, arguments) in events
+                   if command == 'noteon')
+
+    def trainLoop(self, loop):
+        """
+        Train on the events of a loop from L{bl.recorder.LoopRecorder}: a
+        sequence of C{(event, elapsed)} tuples.
+        """
+        self.train(event for (event, elapsed) in loop)
+
+    def prune(self, maxStates):
+        """
+        Drop the rarest states until at most C{maxStates} remain.
+        """
+        transitions = self._transitions
+        if len(transitions) <= maxStates:
+            return
+        ranked = sorted(transitions, key=lambda state: transitions[state].total)
+        for state in ranked[:len(transitions) - maxStates]:
+            del transitions[state]
+
+    def __call__(self):
+        transitions = self._transitions
+        entry = transitions.get(self._state)
+        if entry is None:
+            if not transitions:
+                return
+            self._state = self.rng.choice(transitions.keys())
+            entry = transitions[self._state]
+        value = entry.sample(self.rng)
+        self._state = self._state[1:] + (value,)
+        return value
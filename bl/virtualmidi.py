@@ -0,0 +1,178 @@
+"""
+A pure-Python stand-in for pypm with in-process loopback ports.
+
+Implements the part of the pypm API used by L{bl.midi}: Initialize,
+Terminate, CountDevices, GetDeviceInfo, Time, Input (Read and Poll) and
+Output (Write). Each loopback is a pair of devices with the same name -
+messages written to the output are read from the input. As with PortMidi,
+an output opened with a non-zero latency holds each message until its
+timestamp plus the latency; with zero latency messages are delivered at
+once, stamped with the time they were written.
+
+bl.midi uses this module instead of pypm if the environment variable
+C{BL_MIDI_BACKEND} is set to C{virtual} (or after
+C{bl.midi.setBackend(virtualmidi)}), so MIDI code can be run and load-tested
+without devices or PortMidi:
+
+    >>> from bl import virtualmidi
+    >>> virtualmidi.Initialize()
+    >>> (i, o) = virtualmidi.addLoopback('test')
+    >>> virtualmidi.Output(o).Write([[[0x90, 60, 100], 0]])
+    >>> virtualmidi.Input(i).Read(32)
+    [[[144, 60, 100, 0], 0]]
+"""
+import heapq
+import itertools
+import threading
+import time
+
+
+__all__ = ['Initialize', 'Terminate', 'CountDevices', 'GetDeviceInfo',
+           'Time', 'Input', 'Output', 'addLoopback', 'removeLoopback',
+           'DEFAULT_LOOPBACK', 'HOTPLUG']
+
+
+DEFAULT_LOOPBACK = 'bl loopback'
+
+# Devices may be added and removed without reinitializing
+HOTPLUG = True
+
+# Device info tuples are (interface, name, input, output, opened) as in pypm
+_devices = []
+# name -> _Port shared by the input and output of a loopback
+_ports = {}
+_start = time.time()
+
+
+class _Port(object):
+    """
+    The messages in flight on one loopback: a heap of
+    C{(due, serial, message)} guarded by a lock, as the input is generally
+    read on another thread than the output is written on.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = []
+        self.serials = itertools.count()
+
+    def put(self, message, due):
+        with self.lock:
+            heapq.heappush(self.pending, (due, next(self.serials), message))
+
+    def get(self, length):
+        now = Time()
+        messages = []
+        with self.lock:
+            pending = self.pending
+            while pending and len(messages) < length and pending[0][0] <= now:
+                messages.append(heapq.heappop(pending)[2])
+        return messages
+
+    def ready(self):
+        pending = self.pending
+        return bool(pending) and pending[0][0] <= Time()
+
+
+def Initialize():
+    """
+    Initialize the backend, adding the default loopback if no devices have
+    been added yet.
+    """
+    if not _devices:
+        addLoopback(DEFAULT_LOOPBACK)
+
+
+def Terminate():
+    """
+    Remove all devices.
+    """
+    del _devices[:]
+    _ports.clear()
+
+
+def CountDevices():
+    return len(_devices)
+
+
+def GetDeviceInfo(devno):
+    if 0 <= devno < len(_devices):
+        return _devices[devno]
+
+
+def Time():
+    """
+    Milliseconds since the module was loaded.
+    """
+    return int((time.time() - _start) * 1000)
+
+
+def addLoopback(name):
+    """
+    Add a loopback named C{name}, returning the device numbers of its input
+    and output.
+    """
+    if name in _ports:
+        raise ValueError('Loopback already exists: %r' % (name,))
+    _ports[name] = _Port()
+    _devices.append(('virtual', name, 1, 0, 0))
+    _devices.append(('virtual', name, 0, 1, 0))
+    return (len(_devices) - 2, len(_devices) - 1)
+
+
+def removeLoopback(name):
+    """
+    Remove the loopback named C{name}. Devices after it are renumbered, as
+    PortMidi's are when it is reinitialized. Open ports keep working but are
+    no longer connected to devices.
+    """
+    del _ports[name]
+    _devices[:] = [info for info in _devices if info[1] != name]
+
+
+def _port(devno, kind):
+    info = GetDeviceInfo(devno)
+    if info is None or not info[2 if kind == 'input' else 3]:
+        raise ValueError('Invalid %s device number: %r' % (kind, devno))
+    return _ports[info[1]]
+
+
+class Input(object):
+
+    def __init__(self, devno, bufsize=1024):
+        self.devno = devno
+        self._port = _port(devno, 'input')
+
+    def Read(self, length):
+        """
+        Return up to C{length} messages due on the loopback, as
+        C{[[status, data1, data2, data3], timestamp]}.
+        """
+        return self._port.get(length)
+
+    def Poll(self):
+        return self._port.ready()
+
+
+class Output(object):
+
+    def __init__(self, devno, latency=0):
+        self.devno = devno
+        self.latency = latency
+        self._port = _port(devno, 'output')
+
+    def Write(self, events):
+        """
+        Write C{events}, a list of C{[packet, timestamp]} where packet is
+        a list of up to four bytes.
+        """
+        put = self._port.put
+        latency = self.latency
+        for (packet, timestamp) in events:
+            packet = (list(packet) + [0, 0, 0])[:4]
+            if latency:
+                due = timestamp + latency
+                put([packet, due], due)
+            else:
+                now = Time()
+                put([packet, now], now)